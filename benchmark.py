@@ -0,0 +1,473 @@
+"""Benchmarks the uncontested.py and matchGeo.py pipelines on synthetic data.
+
+Makes candidate files shaped like the Secretary of State's (TOWN, OFFICE,
+DIST#, DECLARATION, PARTY, CITY) and a voter file and match table shaped
+like the ones matchGeo uses, then times and memory-profiles each stage
+separately. Results are saved as JSON, one file per run, so runs from
+different versions can be compared.
+
+Usage:
+    python benchmark.py [--scale town|state|full] [--repeat N]
+    python benchmark.py --compare old_results.json new_results.json
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+try:
+    import resource  # Not on Windows; memory isn't measured there
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uncontested'))
+
+import matchGeo
+import uncontested
+
+# Sizes of the synthetic data, from one town's election up to 50 years statewide
+SCALES = {
+    'town': {'towns': 1, 'years': 1, 'voters': 10000},
+    'state': {'towns': 39, 'years': 1, 'voters': 100000},
+    'full': {'towns': 39, 'years': 50, 'voters': 800000}
+}
+RESULTS_DIR = 'benchmarks'  # Where result files are saved
+SEED = 2016  # Same seed = same data, so runs are comparable
+
+TOWNS = ['BARRINGTON', 'BRISTOL', 'BURRILLVILLE', 'CENTRAL FALLS', 'CHARLESTOWN',
+    'COVENTRY', 'CRANSTON', 'CUMBERLAND', 'EAST GREENWICH', 'EAST PROVIDENCE',
+    'EXETER', 'FOSTER', 'GLOCESTER', 'HOPKINTON', 'JAMESTOWN', 'JOHNSTON',
+    'LINCOLN', 'LITTLE COMPTON', 'MIDDLETOWN', 'NARRAGANSETT', 'NEW SHOREHAM',
+    'NEWPORT', 'NORTH KINGSTOWN', 'NORTH PROVIDENCE', 'NORTH SMITHFIELD',
+    'PAWTUCKET', 'PORTSMOUTH', 'PROVIDENCE', 'RICHMOND', 'SCITUATE',
+    'SMITHFIELD', 'SOUTH KINGSTOWN', 'TIVERTON', 'WARREN', 'WARWICK',
+    'WEST GREENWICH', 'WEST WARWICK', 'WESTERLY', 'WOONSOCKET']
+
+# (OFFICE, DIST#, number of districts, max. candidates per seat); '#' is the district
+LOCAL_OFFICES = [
+    ('MAYOR', '', 1, 3),
+    ('TOWN MODERATOR', '', 1, 2),
+    ('CITY COUNCIL DISTRICT #', '', 9, 3),
+    ('TOWN COUNCIL VOTE FOR 5', '', 1, 2),
+    ('SCHOOL COMMITTEE VOTE FOR 3', '', 1, 2),
+    ('NON-PARTISAN SCHOOL COMMITTEE DISTRICT #', '', 5, 2),
+    ('DISTRICT COMMITTEE', '#', 4, 2)
+]
+STATE_OFFICES = [
+    ('SENATOR IN GENERAL ASSEMBLY', '#', 38, 3),
+    ('REPRESENTATIVE IN GENERAL ASSEMBLY', '#', 75, 3),
+    ('REPRESENTATIVE IN CONGRESS', '#', 2, 4),
+    ('GOVERNOR', 'Statewide', 1, 5),
+    ('STATE COMMITTEE WITHOUT PARTY MARKS OR DESIGNATION', '#', 10, 2)
+]
+PARTIES = ['Democrat', 'Republican', 'Moderate', 'Independent']
+STREETS = ['MAIN ST', 'ELM ST', 'BROAD ST', 'HOPE ST', 'ATWELLS AVE', 'WESTMINSTER ST',
+    'THAYER ST', 'PLAINFIELD PIKE', 'RESERVOIR AVE', 'POST RD', 'COUNTY RD', 'WATER ST']
+
+
+def runBenchmarks(scale='town', repeat=3, results_dir=RESULTS_DIR, data_dir=None):
+    """Times each stage of both pipelines and saves the results.
+
+    Each run of a stage happens in its own process (where possible), so the
+    peak memory it reports is the stage's alone. The data each stage
+    starts from is made before the process starts, so it isn't counted.
+
+    Args:
+        scale: (Optional) Key of SCALES, or a dict like its values.
+        repeat: (Optional) Number of times each stage is run; the fastest
+            run is reported.
+        results_dir: (Optional) Folder to save the results file in.
+        data_dir: (Optional) Folder for the synthetic data. By default, a
+            temporary folder that's removed afterwards.
+
+    Returns:
+        A dict of the results (see saveResults).
+
+    Side effect:
+        Saves a new file (JSON) in results_dir.
+    """
+
+    params = SCALES[scale] if (scale in SCALES) else scale
+    keep_data = data_dir is not None
+    data_dir = os.path.abspath(data_dir or tempfile.mkdtemp(prefix='benchmark'))
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    results_dir = os.path.abspath(results_dir)
+    cwd = os.getcwd()
+    os.chdir(data_dir)  # getDateFromName expects file names without folders
+    try:
+        print 'Making data in:', data_dir
+        candidate_files = makeCandidateFiles('.', params['towns'], params['years'])
+        (match_table, voter_table) = makeGeoFiles('.', params['voters'], params['towns'])
+        stages = []
+        stages += benchmarkUncontested(candidate_files, repeat)
+        stages += benchmarkMatchGeo(match_table, voter_table, repeat)
+    finally:
+        os.chdir(cwd)
+        if not keep_data:
+            shutil.rmtree(data_dir)
+
+    results = {
+        'scale': scale if (scale in SCALES) else 'custom',
+        'params': params,
+        'repeat': repeat,
+        'stages': stages
+    }
+    saveResults(results, results_dir)
+    return results
+
+
+def benchmarkUncontested(candidate_files, repeat):
+    """Benchmarks the stages of uncontested.py (see runBenchmarks).
+
+    Returns:
+        A list of stage results (see timeStage).
+    """
+
+    rows = {}  # Keys = file names, values = lists of row dicts
+    for file_name in candidate_files:
+        with open(file_name, 'r') as f:
+            rows[file_name] = list(csv.DictReader(f))
+    n_rows = sum(len(r) for r in rows.values())
+    dates = dict((f, uncontested.convertDate(uncontested.getDateFromName(f)))
+        for f in candidate_files)
+
+    def mapOffices():
+        uncontested.parseOffice.clear()
+        for file_rows in rows.values():
+            for row in file_rows:
+                uncontested.mapOffice(dict(row))
+
+    def compileAll():
+        uncontested.parseOffice.clear()
+        return [uncontested.compileCandidates((dict(row) for row in rows[f]), dates[f])
+            for f in candidate_files]
+
+    compiled = compileAll()
+    elections_dict = dict((dates[f], {'races': races, 'date': dates[f]})
+        for (f, (races, _)) in zip(candidate_files, compiled))
+    elections_list = [race for (_, races_list) in compiled for race in races_list]
+
+    def calculateAll():
+        for (f, (races, _)) in zip(candidate_files, compiled):
+            uncontested.calculateContested(races, dates[f])
+
+    def saveUncRates():
+        header = ['location'] + sorted(elections_dict)
+        data = uncontested.prepForCSV(uncontested.getUncRates(elections_list), 'location')
+        uncontested.saveCSV('unc_rates.csv', data, header)
+
+    return [
+        timeStage('mapOffice', mapOffices, repeat, n_rows),
+        timeStage('compileCandidates', compileAll, repeat, n_rows),
+        timeStage('calculateContested', calculateAll, repeat, len(elections_list)),
+        timeStage('getUncRates', lambda: uncontested.getUncRates(elections_list),
+            repeat, len(elections_list)),
+        timeStage('saveCSV', saveUncRates, repeat, len(elections_list)),
+        timeStage('saveJSON', lambda: uncontested.saveJSON('elections.json', elections_dict),
+            repeat, n_rows),
+        timeStage('readCandidatesFile', lambda: [uncontested.readCandidatesFile(f)
+            for f in candidate_files], repeat, n_rows),
+        timeStage('readCandidatesFile (lean)', lambda: [uncontested.readCandidatesFile(f, lean=True)
+            for f in candidate_files], repeat, n_rows),
+        timeStage('readAllElections', lambda: uncontested.readAllElections(
+            'cand_*.csv', makeCSV=False, cache_dir=None), repeat, n_rows),
+        timeStage('readAllElections (exports)', lambda: uncontested.readAllElections(
+            'cand_*.csv', makeJSON=True, cache_dir=None), repeat, n_rows),
+        timeStage('readAllElections (exports, background)', lambda: uncontested.readAllElections(
+            'cand_*.csv', makeJSON=True, cache_dir=None, background=True), repeat, n_rows)
+    ]
+
+
+def benchmarkMatchGeo(match_table, voter_table, repeat):
+    """Benchmarks the geocode join for each of matchGeo's methods (see runBenchmarks).
+
+    The 'index' method is run after the index file is built, so it's timed
+    as it would be on every run after the first.
+
+    Returns:
+        A list of stage results (see timeStage).
+    """
+
+    with open(voter_table, 'r') as f:
+        n_voters = sum(1 for _ in f) - 1
+
+    def join(method):
+        return lambda: matchGeo.matchGeo(match_table, voter_table, method=method)
+
+    stages = [timeStage('matchGeo (hash)', join('hash'), repeat, n_voters),
+        timeStage('matchGeo (merge)', join('merge'), repeat, n_voters)]
+    matchGeo.openGeoIndex(match_table).close()  # Builds the index
+    stages.append(timeStage('matchGeo (index)', join('index'), repeat, n_voters))
+    return stages
+
+
+def timeStage(name, f, repeat=3, items=None):
+    """Times a function and measures how much memory it needs.
+
+    Args:
+        name: String name of the stage.
+        f: Function that runs the stage (with no arguments).
+        repeat: (Optional) Number of times to run f.
+        items: (Optional) Number of rows/races/etc. the stage handles, for
+            reporting a rate.
+
+    Returns:
+        A dict with the stage's name, the time of every run and of the fastest
+        ('seconds'), its peak memory in KB above what it started with
+        ('peak_memory_kb'; None where it can't be measured), 'items' and
+        'items_per_second'.
+    """
+
+    print '\nBenchmarking:', name
+    runs = [runOnce(f) for _ in range(repeat)]
+    seconds = min(r[0] for r in runs)
+    memory = [r[1] for r in runs if r[1] is not None]
+    return {
+        'stage': name,
+        'seconds': seconds,
+        'runs': [r[0] for r in runs],
+        'peak_memory_kb': max(memory) if (memory) else None,
+        'items': items,
+        'items_per_second': (items / seconds) if (items and seconds) else None
+    }
+
+
+def runOnce(f):
+    """Runs f once, in a child process if memory can be measured.
+
+    Returns:
+        A tuple of (seconds, peak memory in KB above the start, or None).
+
+    Raises:
+        RuntimeError if f raises an exception in the child process (with its
+        traceback), or if the child process dies before it's done.
+    """
+
+    if resource is None:
+        start = time.time()
+        f()
+        return (time.time() - start, None)
+
+    (receive, send) = multiprocessing.Pipe(False)
+
+    def child():
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            f()
+            seconds = time.time() - start
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == 'darwin':  # ru_maxrss is in bytes on Macs, KB elsewhere
+                (before, peak) = (before // 1024, peak // 1024)
+            send.send((True, (seconds, peak - before)))
+        except BaseException:
+            send.send((False, traceback.format_exc()))  # Exceptions may not pickle
+
+    p = multiprocessing.Process(target=child)  # Forked, so it shares the data made so far
+    p.start()
+    send.close()  # So recv() sees EOF if the child dies without sending anything
+    try:
+        (ok, result) = receive.recv()
+    except EOFError:
+        (ok, result) = (False, 'The process ended with exit code ' + str(p.exitcode) + '.')
+    finally:
+        receive.close()
+        p.join()
+    if not ok:
+        raise RuntimeError('Stage failed in its child process:\n' + result)
+    return result
+
+
+### SYNTHETIC DATA
+
+
+def makeCandidateFiles(folder, towns=1, years=1, seed=SEED):
+    """Saves synthetic candidate files, one per election.
+
+    Each year has a primary and a general election, named like the Secretary
+    of State's files (i.e. 'cand_11042014_general.csv'), with local races in
+    each of the first towns towns and state/federal races spread across them.
+
+    Args:
+        folder: String name of the folder to save the files in.
+        towns: (Optional) Number of municipalities (up to 39).
+        years: (Optional) Number of years of elections, ending in 2014.
+        seed: (Optional) Seed for the random data.
+
+    Returns:
+        A list of the file names.
+    """
+
+    rand = random.Random(seed)
+    file_names = []
+    for year in range(2014 - 2 * (years - 1), 2015, 2):
+        for (date, elec_type) in [('0909', 'primary'), ('1104', 'general')]:
+            file_name = os.path.join(folder,
+                'cand_' + date + str(year) + '_' + elec_type + '.csv')
+            with open(file_name, 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(['NAME', 'TOWN', 'OFFICE', 'DIST#', 'DECLARATION',
+                    'PARTY', 'CITY', 'ADDRESS', 'ZIP'])
+                writer.writerows(makeCandidateRows(rand, TOWNS[:towns]))
+            file_names.append(file_name)
+    return file_names
+
+
+def makeCandidateRows(rand, towns):
+    """Returns a list of synthetic candidate rows for one election."""
+
+    rows = []
+
+    def addRace(town, office, dist, max_candidates):
+        nonpartisan = 'NON-PARTISAN' in office
+        for i in range(rand.randint(1, max_candidates)):
+            party = 'Non-Partisan Local Office' if (nonpartisan) else rand.choice(PARTIES)
+            declaration = rand.choice(uncontested.DECLARATIONS) if (rand.random() < 0.1) else 'Valid'
+            rows.append(['CANDIDATE ' + str(len(rows)), town, office, dist, declaration,
+                party, town, str(rand.randint(1, 999)) + ' ' + rand.choice(STREETS), '02903'])
+
+    for town in towns:
+        for (office, dist, n, max_candidates) in LOCAL_OFFICES:
+            for k in range(1, n + 1):
+                addRace(town, office.replace('#', str(k)), dist.replace('#', str(k)),
+                    max_candidates)
+    for (office, dist, n, max_candidates) in STATE_OFFICES:
+        for k in range(1, n + 1):
+            addRace(rand.choice(towns), office, dist.replace('#', str(k)), max_candidates)
+    return rows
+
+
+def makeGeoFiles(folder, voters=10000, towns=1, seed=SEED):
+    """Saves a synthetic match table and voter file for matchGeo.
+
+    Every voter address is in the match table, and the match table has
+    about twice as many addresses as there are voters.
+
+    Args:
+        folder: String name of the folder to save the files in.
+        voters: (Optional) Number of rows in the voter file.
+        towns: (Optional) Number of municipalities (up to 39).
+        seed: (Optional) Seed for the random data.
+
+    Returns:
+        A tuple of the match table's and voter file's names.
+    """
+
+    rand = random.Random(seed)
+    numbers = max(1, voters // (len(STREETS) * towns))  # House numbers per street
+    match_table = os.path.join(folder, 'match.csv')
+    with open(match_table, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['addressID', 'geo_lat', 'geo_lon'])
+        for town in TOWNS[:towns]:
+            for street in STREETS:
+                for number in range(1, 2 * numbers + 1):
+                    writer.writerow([', '.join([str(number), street, town, 'RI']),
+                        '%.6f' % rand.uniform(41.1, 42.0), '%.6f' % rand.uniform(-71.9, -71.1)])
+
+    voter_table = os.path.join(folder, 'voters.csv')
+    with open(voter_table, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['VOTER_ID', 'LAST_NAME', 'FIRST_NAME', 'STREET_NUMBER',
+            'STREET_NAME1', 'CITY', 'STATE', 'PARTY'])
+        for v in range(voters):
+            writer.writerow([str(v), 'VOTER', 'NAME ' + str(v), str(rand.randint(1, 2 * numbers)),
+                rand.choice(STREETS), rand.choice(TOWNS[:towns]), 'RI', rand.choice(PARTIES)])
+    return (match_table, voter_table)
+
+
+### RESULTS
+
+
+def saveResults(results, results_dir=RESULTS_DIR):
+    """Saves benchmark results as JSON, along with details about the run.
+
+    The file name has the time of the run and the current git commit
+    (if there is one), i.e. 'benchmarks/20160301-120000_ab12cd3.json'.
+
+    Returns:
+        The string name of the new file.
+    """
+
+    commit = getCommit()
+    results['commit'] = commit
+    results['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    new_file_name = os.path.join(results_dir,
+        time.strftime('%Y%m%d-%H%M%S') + ('_' + commit if (commit) else '') + '.json')
+    print '\nSaving file:', new_file_name, '...'
+    with open(new_file_name, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    print 'Saved file:', new_file_name
+    printResults(results)
+    return new_file_name
+
+
+def printResults(results, old_results=None):
+    """Prints a table of each stage's time and memory (and change from old_results)."""
+
+    old = dict((s['stage'], s) for s in (old_results or {}).get('stages', []))
+    width = max([len('stage')] + [len(s['stage']) for s in results['stages']])
+    print '\n%-*s %10s %12s %10s' % (width, 'stage', 'seconds', 'memory (KB)', 'change')
+    for s in results['stages']:
+        change = ''
+        if (s['stage'] in old) and (old[s['stage']]['seconds']):
+            change = '%+.1f%%' % (100.0 * (s['seconds'] / old[s['stage']]['seconds'] - 1))
+        print '%-*s %10.3f %12s %10s' % (width, s['stage'], s['seconds'],
+            s['peak_memory_kb'] if s['peak_memory_kb'] is not None else '-', change)
+
+
+def compareResults(old_file, new_file):
+    """Prints the results in new_file, with each stage's change in time since old_file."""
+
+    with open(old_file, 'r') as f:
+        old_results = json.load(f)
+    with open(new_file, 'r') as f:
+        new_results = json.load(f)
+    if old_results.get('params') != new_results.get('params'):
+        print 'Warning: the runs used different data sizes.'
+    print 'Old:', old_file, '(' + str(old_results.get('commit')) + ')'
+    print 'New:', new_file, '(' + str(new_results.get('commit')) + ')'
+    printResults(new_results, old_results)
+
+
+def getCommit():
+    """Returns the short hash of the current git commit, or None outside a git repo."""
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks uncontested.py and matchGeo.py.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='town')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--data-dir', help='Keep the synthetic data in this folder.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two results files instead of running the benchmarks.')
+    args = parser.parse_args()
+
+    if (args.compare):
+        compareResults(*args.compare)
+    else:
+        runBenchmarks(args.scale, args.repeat, args.results_dir, args.data_dir)
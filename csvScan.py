@@ -0,0 +1,166 @@
+"""Reads only the columns a script needs from a CSV, without a dict per row.
+
+Shared by matchGeo.py and uncontested/uncontested.py (see CSVScanner), along
+with hashFile, which both use to tell whether a CSV has changed.
+"""
+
+import csv
+import hashlib
+import mmap
+import os
+from itertools import chain, izip
+from operator import itemgetter
+
+BATCH_SIZE = 10000  # Number of rows in each batch (see CSVScanner.batches)
+
+
+class CSVScanner(object):
+    """Scans a CSV for a few of its columns.
+
+    The file is memory-mapped and read a line at a time. Each line is only
+    split as far as the last column needed, so the columns after it are
+    never made into strings, and rows are tuples unless dicts are asked
+    for. Lines with quotes (which may have commas or line breaks inside a
+    field) are parsed by the csv module instead, along with any lines it
+    needs to finish the row, so the values are the same as csv.reader's.
+    For files where most lines have quotes, quoted=True parses every line
+    with the csv module, which is faster than handing it one line at a time.
+    As with csv.DictReader, blank lines are skipped, and rows that are too
+    short get restval for their missing fields.
+
+    Only one of rows, dicts or batches should be used at a time; each
+    starts again from the first row.
+
+    Example:
+        with CSVScanner('voters.csv', restval='') as scanner:
+            for (number, street) in scanner.rows(['STREET_NUMBER', 'STREET_NAME1']):
+                ...
+    """
+
+    def __init__(self, file_name, restval=None, quoted=False):
+        """
+        Args:
+            file_name: String name of the CSV. Its first line is the header.
+            restval: (Optional) Value for fields missing from short rows.
+            quoted: (Optional) If True, every line is parsed by the csv
+                module (i.e. for match tables, whose addressIDs are quoted).
+        """
+
+        self.file_name = file_name
+        self.restval = restval
+        self.quoted = quoted
+        self.f = open(file_name, 'rb')
+        if os.fstat(self.f.fileno()).st_size:
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buf = None  # Empty files can't be memory-mapped
+        line = self.readline()
+        self.fieldnames = self.parseQuoted(line, iter(self.readline, '')) if (line) else []
+        self.start = self.buf.tell() if (self.buf) else 0
+        self.index = dict((name, i) for (i, name) in enumerate(self.fieldnames))
+            # As in DictReader, the last of two fields with the same name wins
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def readline(self):
+
+        return self.buf.readline() if (self.buf) else ''
+
+    def parseQuoted(self, line, lines):
+        """Parses line with the csv module, taking more from lines only if a
+        quoted field has line breaks (a stray quote inside a field doesn't
+        start one, as in csv.reader)."""
+
+        return next(csv.reader(chain([line], lines)), [])
+
+    def getPositions(self, columns):
+        """Returns the positions of columns (names, or positions as they are).
+
+        Raises:
+            KeyError if a column isn't in the header.
+        """
+
+        return [c if isinstance(c, int) else self.index[c] for c in columns]
+
+    def scan(self, positions):
+        """Yields a tuple of the values at positions (a list of ints) in each row."""
+
+        if not (self.buf):
+            return
+        self.buf.seek(self.start)
+        last = max(positions) if (positions) else 0
+        getter = itemgetter(*positions) if len(positions) > 1 else (
+            lambda fields: tuple(fields[p] for p in positions))
+        restval = [self.restval] * (last + 1)
+        if (self.quoted):
+            self.f.seek(self.start)
+            for fields in csv.reader(self.f):
+                try:
+                    yield getter(fields)
+                except IndexError:  # Blank lines and short rows, which are rare
+                    if (fields):
+                        yield getter(fields + restval[len(fields):])
+            return
+        lines = iter(self.buf.readline, '')
+        for line in lines:
+            if '"' in line:
+                fields = self.parseQuoted(line, lines)
+            else:
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                fields = line.split(',', last + 1)  # Anything after the last column stays in one piece
+            if len(fields) <= last:
+                fields += restval[len(fields):]
+            yield getter(fields)
+
+    def rows(self, columns):
+        """Yields a tuple of the values of columns (names or positions) in each row."""
+
+        return self.scan(self.getPositions(columns))
+
+    def dicts(self, columns):
+        """Yields a dict of the values of columns in each row, like a DictReader
+        that only has those columns."""
+
+        for values in self.scan(self.getPositions(columns)):
+            yield dict(izip(columns, values))
+
+    def batches(self, columns, batch_size=BATCH_SIZE):
+        """Yields the rows batch_size at a time, as a list of each column's values.
+
+        Example:
+            for (lats, lons) in scanner.batches(['geo_lat', 'geo_lon']):
+                lats  # A tuple of the next batch_size (or fewer) rows' 'geo_lat' values
+        """
+
+        batch = []
+        for values in self.scan(self.getPositions(columns)):
+            batch.append(values)
+            if len(batch) >= batch_size:
+                yield zip(*batch)
+                batch = []
+        if (batch):
+            yield zip(*batch)
+
+    def close(self):
+
+        if (self.buf):
+            self.buf.close()
+        self.f.close()
+
+
+def hashFile(file_name):
+    """Returns the MD5 hex digest of a file's contents."""
+
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            md5.update(block)
+    return md5.hexdigest()
@@ -0,0 +1,261 @@
+"""Counts geocoded points (i.e. voters from matchGeo.py) in each map region.
+
+Saves the counts in the format interactive_map.js reads, so they can be
+mapped like any other data file.
+
+Usage:
+    python countPoints.py geocoded_file region [new_file_name] [group_field]
+
+    region is 'Rhode Island' or 'Providence' (see prepMap.py). By default,
+    the counts are saved as geocoded_file with '_counts.json' in place of
+    '.csv'. If group_field is given (i.e. PARTY), there's also a count for
+    each value of that field.
+"""
+
+import csv
+import os
+import sys
+from collections import defaultdict
+
+from prepMap import REGIONS, getPolygons, readJSON, saveJSON
+
+GRID_SIZE = 64  # Number of grid cells across (and down) the map
+EDGES_PER_SLAB = 8  # Approx. number of polygon edges per slab (see RegionIndex)
+BATCH_SIZE = 100000  # Number of points located at a time
+
+
+class RegionIndex(object):
+    """Finds which region (polygon) of a GeoJSON file a point is in.
+
+    The map is divided into a grid. Cells that no region's border passes
+    through are entirely inside one region (or none), so points in them
+    are assigned without any test. For the other cells, only the regions
+    whose bounding boxes overlap the cell are tested.
+
+    Each region's edges are also sorted into horizontal slabs, so testing a
+    point (by counting the edges a ray from it crosses) only looks at the
+    few edges at the same latitude rather than all of them.
+    """
+
+    def __init__(self, geo, geo_name, grid_size=GRID_SIZE):
+        """
+        Args:
+            geo: Dict of a GeoJSON FeatureCollection of Polygons/MultiPolygons.
+            geo_name: The property with the name of each region.
+            grid_size: (Optional) Number of grid cells across and down.
+        """
+
+        self.names = []
+        self.regions = []  # (min_x, min_y, max_x, max_y, slab_min_y, slab_height, slabs)
+        for feature in geo['features']:
+            edges = []
+            for polygon in getPolygons(feature['geometry']):
+                for ring in polygon:
+                    points = [tuple(p[:2]) for p in ring]
+                    edges += [(a, b) for (a, b) in zip(points, points[1:] + points[:1])
+                        if a != b]
+            if (edges):
+                self.names.append(feature['properties'][geo_name])
+                self.regions.append(makeSlabs(edges))
+
+        self.min_x = min(r[0] for r in self.regions)
+        self.min_y = min(r[1] for r in self.regions)
+        self.n = grid_size
+        self.cell_w = ((max(r[2] for r in self.regions) - self.min_x) / grid_size) or 1.0
+        self.cell_h = ((max(r[3] for r in self.regions) - self.min_y) / grid_size) or 1.0
+
+        # Which regions might be in each cell, and which cells have a border in them
+        self.candidates = defaultdict(list)
+        border = set()
+        for (i, r) in enumerate(self.regions):
+            for cell in self.getCells(r[0], r[1], r[2], r[3]):
+                self.candidates[cell].append(i)
+            for slab in r[6]:
+                for (x1, y1, x2, y2) in slab:
+                    border.update(self.getCells(min(x1, x2), min(y1, y2),
+                        max(x1, x2), max(y1, y2)))
+
+        # Cells without a border are in at most one region; find it from their centers
+        self.fixed = {}  # Keys = cells, values = region indexes (or -1 for none)
+        for cell in self.candidates:
+            if cell not in border:
+                (cx, cy) = ((cell[0] + 0.5) * self.cell_w + self.min_x,
+                    (cell[1] + 0.5) * self.cell_h + self.min_y)
+                self.fixed[cell] = self.test(cx, cy, self.candidates[cell])
+
+    def __len__(self):
+
+        return len(self.names)
+
+    def getCell(self, x, y):
+        """Returns the (column, row) of the grid cell that (x, y) is in."""
+
+        return (int((x - self.min_x) // self.cell_w), int((y - self.min_y) // self.cell_h))
+
+    def getCells(self, min_x, min_y, max_x, max_y):
+        """Returns a list of the grid cells that overlap a bounding box."""
+
+        (c1, r1) = self.getCell(min_x, min_y)
+        (c2, r2) = self.getCell(max_x, max_y)
+        return [(c, r) for c in range(max(c1, 0), min(c2, self.n) + 1)
+            for r in range(max(r1, 0), min(r2, self.n) + 1)]
+
+    def locate(self, x, y):
+        """Returns the index of the region (x, y) is in, or -1 if it's in none."""
+
+        cell = self.getCell(x, y)
+        region = self.fixed.get(cell)
+        if region is not None:
+            return region
+        return self.test(x, y, self.candidates.get(cell, ()))
+
+    def test(self, x, y, regions):
+        """Returns the first of regions (indexes) that contains (x, y), or -1."""
+
+        for i in regions:
+            (min_x, min_y, max_x, max_y, slab_y, slab_h, slabs) = self.regions[i]
+            if not ((min_x <= x <= max_x) and (min_y <= y <= max_y)):
+                continue
+            inside = False  # Even-odd rule, so holes count as outside
+            for (x1, y1, x2, y2) in slabs[min(int((y - slab_y) // slab_h), len(slabs) - 1)]:
+                if ((y1 > y) != (y2 > y)) and (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1)):
+                    inside = not inside
+            if (inside):
+                return i
+        return -1
+
+    def countPoints(self, points):
+        """Counts the points in each region.
+
+        Points are grouped by grid cell first, so each cell that's entirely
+        inside a region is counted in one step.
+
+        Args:
+            points: List of (x, y) tuples, i.e. (lon, lat).
+
+        Returns:
+            A list of the number of points in each region (in the order of
+            self.names), followed by the number that aren't in any region.
+        """
+
+        counts = [0] * (len(self.names) + 1)  # The last one is for points in no region
+        by_cell = defaultdict(list)
+        for p in points:
+            by_cell[self.getCell(p[0], p[1])].append(p)
+        for (cell, cell_points) in by_cell.items():
+            region = self.fixed.get(cell)
+            if region is not None:
+                counts[region] += len(cell_points)
+                continue
+            candidates = self.candidates.get(cell, ())
+            for (x, y) in cell_points:
+                counts[self.test(x, y, candidates)] += 1
+        return counts
+
+
+def makeSlabs(edges):
+    """Sorts a region's edges into horizontal slabs (see RegionIndex).
+
+    Args:
+        edges: List of ((x1, y1), (x2, y2)) tuples.
+
+    Returns:
+        A tuple of the region's bounding box (min_x, min_y, max_x, max_y),
+        the bottom and height of the slabs, and a list of the slabs, each
+        a list of the (x1, y1, x2, y2) edges that overlap it.
+    """
+
+    xs = [p[0] for e in edges for p in e]
+    ys = [p[1] for e in edges for p in e]
+    (min_y, max_y) = (min(ys), max(ys))
+    n = max(1, len(edges) // EDGES_PER_SLAB)
+    height = ((max_y - min_y) / n) or 1.0
+    slabs = [[] for _ in range(n)]
+    for ((x1, y1), (x2, y2)) in edges:
+        first = int((min(y1, y2) - min_y) // height)
+        last = min(int((max(y1, y2) - min_y) // height), n - 1)
+        for s in range(first, last + 1):
+            slabs[s].append((x1, y1, x2, y2))
+    return (min(xs), min_y, max(xs), max_y, min_y, height, slabs)
+
+
+def countPoints(geocoded_file, region='Providence', new_file_name=None, group=None,
+                geo_file=None, batch_size=BATCH_SIZE):
+    """Counts the geocoded rows of a CSV in each region of a map.
+
+    Args:
+        geocoded_file: String name of a CSV with 'geo_lat' and 'geo_lon'
+            fields, i.e. from matchGeo. Rows without coordinates are skipped.
+        region: (Optional) 'Rhode Island' or 'Providence' (see prepMap.py).
+        new_file_name: (Optional) String name of the new file. By default,
+            geocoded_file with '_counts.json' in place of '.csv'.
+        group: (Optional) A field to also count rows by, i.e. 'PARTY'.
+            Each of its values gets its own count (i.e. 'Count Democrat').
+        geo_file: (Optional) String name of the region's shape file. By
+            default, the one for region in the folder of this file.
+        batch_size: (Optional) Number of rows located at a time.
+
+    Returns:
+        A dict where keys = region names, values = dicts with 'Count' (and
+            a count for each value of group), as saved.
+
+    Side effect:
+        Saves a new file (JSON).
+    """
+
+    if region not in REGIONS:
+        raise ValueError("region must be either 'Providence' or 'Rhode Island'.")
+    if geo_file is None:
+        geo_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            REGIONS[region]['geo_file'])
+    if not new_file_name:
+        new_file_name = geocoded_file.rsplit('.', 1)[0] + '_counts.json'
+    index = RegionIndex(readJSON(geo_file), REGIONS[region]['geo_name'])
+
+    keys = ['Count']
+    totals = defaultdict(lambda: [0] * (len(index) + 1))  # Keys = 'Count' + groups
+    skipped = 0
+
+    def countBatch(batch):
+        for (key, points) in batch.items():
+            for (i, n) in enumerate(index.countPoints(points)):
+                totals[key][i] += n
+                if key != 'Count':  # Groups also count toward the total
+                    totals['Count'][i] += n
+
+    f = open(geocoded_file, 'r')
+    reader = csv.reader(f)
+    fieldnames = reader.next()
+    (lat, lon) = (fieldnames.index('geo_lat'), fieldnames.index('geo_lon'))
+    g = fieldnames.index(group) if (group) else None
+    batch = defaultdict(list)
+    size = 0
+    for row in reader:
+        try:
+            point = (float(row[lon]), float(row[lat]))
+        except ValueError:
+            skipped += 1  # No coordinates
+            continue
+        batch['Count ' + row[g] if (group) else 'Count'].append(point)
+        size += 1
+        if size >= batch_size:
+            countBatch(batch)
+            (batch, size) = (defaultdict(list), 0)
+    countBatch(batch)
+    f.close()
+
+    keys += sorted(k for k in totals if k != 'Count')
+    counts = dict((name, dict((k, totals[k][i]) for k in keys))
+        for (i, name) in enumerate(index.names))
+    print 'Rows without coordinates:', skipped
+    print 'Rows outside every region:', totals['Count'][-1]
+    saveJSON(new_file_name, counts)
+    return counts
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        print __doc__
+        sys.exit(1)
+    countPoints(sys.argv[1], sys.argv[2], *sys.argv[3:5])
@@ -35,7 +35,7 @@ rimap = function () {
     }
 
     // Loads the geodata and draws the map
-    function drawMap(config, dataset) {
+    function drawMap(config, dataset, prep) {
 
         // Set geojson file (and name of field with polygon names)
         if (config.region === "Rhode Island") {
@@ -50,6 +50,19 @@ rimap = function () {
             throw Error("In rimap_config.json, 'region' must be \
                 either 'Providence' or 'Rhode Island'.");
         }
+        // Simplified shapes saved by prepMap.py, if it's been run
+        if (prep) {
+            geo_file = prep.geo_file;
+        }
+
+        // Gets the number shown for a location (precomputed by prepMap.py, if it's been run)
+        function getValue(properties) {
+
+            if (properties._value !== undefined) {
+                return properties._value;
+            }
+            return properties[config.value] / (properties[config.norm] || 1);
+        }
 
         // Define color scale
         var color = d3.scale.threshold()
@@ -61,7 +74,7 @@ rimap = function () {
                     .attr("class", "d3-tip")
                     .offset([-10, 0])
                     .html(function (d) {
-                        var calc = d.properties[config.value] / (d.properties[config.norm] || 1);
+                        var calc = getValue(d.properties);
                         var num = config.percent ? toPct(calc, 1) : calc.toFixed(2);
                         if (config.value_exceed && calc > config.value_exceed) {
                             var num_color = config.color_exceed;
@@ -101,8 +114,7 @@ rimap = function () {
                 .append("path")
                 .attr("d", path)
                 .style("fill", function (d) {
-                    var val = d.properties[config.value] / (d.properties[config.norm] || 1);
-                    return color(val);
+                    return d.properties._color || color(getValue(d.properties));
                 })
                 .style("stroke", "white")
                 .style("stroke-width", 2)
@@ -120,9 +132,36 @@ rimap = function () {
         });
     }
 
-    d3.json("rimap_config.json", function (config) {
-        d3.json(config.file, function (dataset) {
-            drawMap(config, dataset);
+    // Config file: rimap_config.json, unless the page's address says otherwise
+    // (i.e. interactive_map.html?config=reg_18-24_config.json)
+    var config_match = window.location.search.match(/[?&]config=([^&]+)/);
+    var config_file = config_match ? decodeURIComponent(config_match[1]) : "rimap_config.json";
+
+    // Checks that prepMap.py's data file was made with the config's current settings
+    function isCurrent(prep, config) {
+
+        if (!prep) {
+            return false;
+        }
+        for (var k in prep.settings) {
+            var setting = config[k] === undefined ? null : config[k];
+            if (JSON.stringify(setting) !== JSON.stringify(prep.settings[k])) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    d3.json(config_file, function (config) {
+        // Data precomputed by prepMap.py, if it's been run since the config last changed
+        d3.json(config_file.replace(/\.json$/, "") + ".map.json", function (prep) {
+            if (isCurrent(prep, config)) {
+                drawMap(config, prep.data, prep);
+            } else {
+                d3.json(config.file, function (dataset) {
+                    drawMap(config, dataset, null);
+                });
+            }
         });
     });
 }();
@@ -0,0 +1,379 @@
+"""Builds the data files for interactive_map.js from CSVs.
+
+Loads CSVs (i.e. census estimates and registered voter totals) into
+column arrays, joins them by municipality or neighborhood, calculates
+value / norm for each location and sorts the locations into color classes
+(by fixed cutoffs, quantiles or Jenks natural breaks). A batch file lists
+every map to make, so they can all be remade with one command.
+
+Usage:
+    python mapData.py [batch_file ...]
+
+Batch file (JSON; file names are relative to its folder):
+    {
+        "tables": [
+            {"file": "old-files/Registered_voter_totals_Nov2014.csv",
+             "key": "Muni", "prefix": "Reg "},
+            {"file": "old-files/2013_5yr_pop_estimates.csv",
+             "key": "Municipality3", "prefix": "Pop "}
+        ],
+        "columns": {"Pop 25-34": ["Pop 25 to 29 years", "Pop 30 to 34 years"]},
+        "config": {"region": "Rhode Island", "percent": true, ...},
+        "maps": [
+            {"name": "reg_25-34", "value": "Reg 25-34", "norm": "Pop 25-34",
+             "classes": "quantile", "text": "Percent of 25-34 year olds registered"}
+        ],
+        "prep": true
+    }
+
+    "columns" are new columns that are the sum of others. Each map gets
+    its settings from "config" and then from its own entry; "classes" is
+    "threshold" (use the map's "cutoffs" as they are), "quantile" or
+    "jenks", with as many classes as there are "colors". For each map, this
+    saves '<name>.json' (the data) and '<name>_config.json' (the config;
+    open interactive_map.html?config=<name>_config.json to see it), and if
+    "prep" is true, runs prepMap.py on it.
+"""
+
+import bisect
+import csv
+import json
+import os
+import sys
+from array import array
+from collections import OrderedDict
+
+import prepMap
+
+NAN = float('nan')
+CLASS_METHODS = ['threshold', 'quantile', 'jenks']
+
+
+class DataTable(object):
+    """Table of data by location, stored as columns.
+
+    Numeric columns are arrays of floats (NaN where there's no value), and
+    other columns are lists of strings. Locations are matched by their key
+    in upper case, without extra spaces (see normalizeKey).
+    """
+
+    def __init__(self, keys=()):
+        """
+        Args:
+            keys: (Optional) List of the locations' names.
+        """
+
+        self.keys = list(keys)
+        self.index = dict((normalizeKey(k), i) for (i, k) in enumerate(self.keys))
+        self.columns = OrderedDict()  # Keys = column names, values = arrays/lists
+
+    def __len__(self):
+
+        return len(self.keys)
+
+    def column(self, name):
+        """Returns a column (an array of floats, or a list of strings)."""
+
+        if name not in self.columns:
+            raise KeyError('No column named ' + repr(name))
+        return self.columns[name]
+
+    def addColumn(self, name, values):
+        """Adds (or replaces) a column; values must have one item per location."""
+
+        if len(values) != len(self.keys):
+            raise ValueError('Column ' + repr(name) + ' has ' + str(len(values)) +
+                ' values for ' + str(len(self.keys)) + ' locations.')
+        self.columns[name] = values
+
+    def sumColumns(self, name, names):
+        """Adds a column that is the sum of other (numeric) columns."""
+
+        columns = [self.column(n) for n in names]
+        self.addColumn(name, array('d', [sum(values) for values in zip(*columns)]))
+
+    def join(self, other, how='left'):
+        """Joins another table's columns onto this one's, by location.
+
+        Args:
+            other: A DataTable.
+            how: (Optional) 'left' to keep every location in this table
+                (with NaN/'' for ones that aren't in other), or 'inner' to
+                keep only locations in both.
+
+        Returns:
+            A new DataTable.
+        """
+
+        if how not in ['left', 'inner']:
+            raise ValueError("how must be 'left' or 'inner'.")
+        rows = [(i, other.index.get(normalizeKey(k))) for (i, k) in enumerate(self.keys)]
+        if how == 'inner':
+            rows = [(i, j) for (i, j) in rows if j is not None]
+
+        table = DataTable([self.keys[i] for (i, _) in rows])
+        for (name, values) in self.columns.items():
+            table.addColumn(name, takeRows(values, [i for (i, _) in rows]))
+        for (name, values) in other.columns.items():
+            table.addColumn(name, takeRows(values, [j for (_, j) in rows]))
+        return table
+
+    def toDict(self, names=None):
+        """Returns the table in the format interactive_map.js reads.
+
+        Args:
+            names: (Optional) List of the columns to include. By default, all.
+
+        Returns:
+            An OrderedDict where keys = location names, values = dicts where
+                keys = column names, values = numbers (ints where they're whole,
+                None where there's no value) or strings.
+        """
+
+        names = list(self.columns) if names is None else names
+        columns = [[toNumber(v) if isinstance(v, float) else v for v in self.column(n)]
+            for n in names]
+        return OrderedDict((k, OrderedDict(zip(names, values)))
+            for (k, values) in zip(self.keys, zip(*columns) if (columns) else [()] * len(self)))
+
+
+def readTable(file_name, key, prefix='', duplicates='sum'):
+    """Reads a CSV into a DataTable.
+
+    Column names are stripped of extra spaces. Columns whose values are all
+    numbers (or blank) become arrays of floats; commas in numbers are ignored.
+
+    Args:
+        file_name: String name of the CSV.
+        key: The column with the location names.
+        prefix: (Optional) String added to the start of every other column's
+            name, i.e. 'Pop ' for census columns.
+        duplicates: (Optional) What to do with columns that have the same
+            name (i.e. the census's male and female age groups): 'sum' adds
+            them together, 'first' or 'last' keeps one of them.
+
+    Returns:
+        A DataTable.
+    """
+
+    if duplicates not in ['sum', 'first', 'last']:
+        raise ValueError("duplicates must be 'sum', 'first' or 'last'.")
+    with open(file_name, 'rU') as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in reader.next()]
+        rows = [row for row in reader if any(row)]
+    k = header.index(key)
+    table = DataTable([row[k].strip() for row in rows])
+
+    for (i, name) in enumerate(header):
+        if i == k:
+            continue
+        values = [(row[i].strip() if i < len(row) else '') for row in rows]
+        numbers = toFloats(values)
+        column = numbers if numbers is not None else values
+        name = prefix + name
+        if name in table.columns:
+            if duplicates == 'first':
+                continue
+            if (duplicates == 'sum') and (numbers is not None):
+                column = array('d', [a + b for (a, b) in zip(table.columns[name], numbers)])
+        table.addColumn(name, column)
+    return table
+
+
+### CALCULATIONS
+
+
+def getRatios(table, value, norm=None):
+    """Calculates value / norm for each location, as interactive_map.js does.
+
+    If norm is None, or a location's norm is 0 or missing, its value isn't divided.
+
+    Returns:
+        An array of floats (NaN where value is missing).
+    """
+
+    values = table.column(value)
+    if norm is None:
+        return array('d', values)
+    return array('d', [v / (n if (n == n) and (n) else 1.0)
+        for (v, n) in zip(values, table.column(norm))])
+
+
+def getClasses(values, cutoffs):
+    """Sorts values into classes by cutoffs, as d3.scale.threshold does.
+
+    Values below cutoffs[0] are class 0, values from cutoffs[0] up to (but
+    not including) cutoffs[1] are class 1, and so on.
+
+    Returns:
+        An array of ints (-1 where a value is NaN).
+    """
+
+    return array('i', [bisect.bisect_right(cutoffs, v) if (v == v) else -1 for v in values])
+
+
+def getCutoffs(values, method, k=None, cutoffs=None):
+    """Returns the cutoffs between k classes of values.
+
+    Args:
+        values: Iterable of floats; NaNs are ignored.
+        method: 'threshold' (returns cutoffs as is), 'quantile' (classes
+            with the same number of values) or 'jenks' (natural breaks).
+        k: (Optional) Number of classes, for 'quantile' and 'jenks'.
+        cutoffs: (Optional) List of cutoffs, for 'threshold'.
+
+    Returns:
+        A sorted list of k - 1 cutoffs. Each is the lowest value in its class.
+    """
+
+    if method not in CLASS_METHODS:
+        raise ValueError('method must be one of: ' + ', '.join(CLASS_METHODS))
+    if method == 'threshold':
+        return list(cutoffs)
+    values = sorted(v for v in values if (v == v))
+    if not values:
+        return []
+    if method == 'quantile':
+        return [values[(i * len(values)) // k] for i in range(1, k)]
+    return getJenksCutoffs(values, k)
+
+
+def getJenksCutoffs(values, k):
+    """Finds the Jenks natural breaks between k classes of sorted values.
+
+    Uses the Fisher-Jenks dynamic programming method, which picks the classes
+    that minimize the sum of squared deviations from each class's mean.
+    It takes time proportional to k * len(values) ** 2, which is fine for
+    the few dozen locations on a map.
+
+    Returns:
+        A list of k - 1 cutoffs (see getCutoffs).
+    """
+
+    n = len(values)
+    k = min(k, n)
+    # Prefix sums, so the squared deviation of any run of values is quick to get
+    (s1, s2) = ([0.0], [0.0])
+    for v in values:
+        s1.append(s1[-1] + v)
+        s2.append(s2[-1] + v * v)
+
+    def cost(i, j):  # Squared deviation of values[i:j]
+        return (s2[j] - s2[i]) - (s1[j] - s1[i]) ** 2 / (j - i)
+
+    # best[c][j] = lowest cost of splitting values[:j] into c + 1 classes
+    best = [[cost(0, j) if (j) else 0.0 for j in range(n + 1)]]
+    start = [[0] * (n + 1)]  # Where the last class of each best split starts
+    for c in range(1, k):
+        (row, starts) = ([float('inf')] * (n + 1), [0] * (n + 1))
+        for j in range(c + 1, n + 1):
+            for i in range(c, j):
+                total = best[c - 1][i] + cost(i, j)
+                if total < row[j]:
+                    (row[j], starts[j]) = (total, i)
+        best.append(row)
+        start.append(starts)
+
+    cutoffs = []
+    j = n
+    for c in range(k - 1, 0, -1):
+        j = start[c][j]
+        cutoffs.append(values[j])
+    return cutoffs[::-1]
+
+
+### BATCH
+
+
+def runBatch(batch_file):
+    """Makes every map in a batch file (see the top of this file).
+
+    Returns:
+        A list of the new config files' names.
+
+    Side effect:
+        Saves a data file (JSON) and a config file (JSON) for each map,
+        plus prepMap.py's files if the batch file says to.
+    """
+
+    folder = os.path.dirname(batch_file)
+    with open(batch_file, 'r') as f:
+        batch = json.load(f, object_pairs_hook=OrderedDict)
+
+    table = None
+    for t in batch['tables']:
+        new = readTable(os.path.join(folder, t['file']), t['key'], t.get('prefix', ''),
+            t.get('duplicates', 'sum'))
+        table = new if table is None else table.join(new, t.get('how', 'left'))
+    for (name, names) in batch.get('columns', {}).items():
+        table.sumColumns(name, names)
+
+    config_files = []
+    for m in batch['maps']:
+        config = OrderedDict(batch.get('config', {}))
+        config.update((k, v) for (k, v) in m.items() if k not in ['name', 'classes'])
+        config_file = os.path.join(folder, m['name'] + '_config.json')
+        config['file'] = m['name'] + '.json'
+        config['cutoffs'] = getCutoffs(getRatios(table, config['value'], config.get('norm')),
+            m.get('classes', 'threshold'), len(config['colors']), config.get('cutoffs'))
+
+        names = [config['value']] + ([config['norm']] if config.get('norm') else [])
+        prepMap.saveJSON(os.path.join(folder, config['file']), table.toDict(names))
+        prepMap.saveConfig(config_file, config)
+        if batch.get('prep'):
+            prepMap.prepMap(config_file)
+        config_files.append(config_file)
+    return config_files
+
+
+### GENERAL UTILITIES
+
+
+def normalizeKey(key):
+    """Returns a location name in upper case, without extra spaces."""
+
+    return ' '.join(key.upper().split())
+
+
+def toFloats(values):
+    """Converts a list of strings to an array of floats (NaN for blanks).
+
+    Returns:
+        The array, or None if any value isn't a number.
+    """
+
+    numbers = array('d')
+    for v in values:
+        if not v:
+            numbers.append(NAN)
+            continue
+        try:
+            numbers.append(float(v.replace(',', '')))
+        except ValueError:
+            return None
+    return numbers
+
+
+def toNumber(x):
+    """Returns a float as an int if it's whole, or None if it's NaN (for JSON)."""
+
+    if x != x:
+        return None
+    if x == int(x):
+        return int(x)
+    return x
+
+
+def takeRows(values, rows):
+    """Returns the values at rows (a list of indexes, or None for a missing row)."""
+
+    if isinstance(values, array):
+        return array('d', [values[i] if i is not None else NAN for i in rows])
+    return [values[i] if i is not None else '' for i in rows]
+
+
+if __name__ == '__main__':
+
+    for batch_file in (sys.argv[1:] or ['map_batch.json']):
+        runBatch(batch_file)
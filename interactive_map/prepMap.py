@@ -0,0 +1,295 @@
+"""Precomputes the data and shapes for interactive_map.js.
+
+Reads rimap_config.json and:
+    * Calculates value/norm and the color for every municipality/neighborhood,
+      and saves them in a small data file next to the config (its name with
+      '.map.json' in place of '.json'), with the settings they came from.
+      The map only uses the file while the config still has those settings.
+    * Simplifies and rounds the region's shapes, keeping borders between
+      neighboring shapes identical, and saves them next to the original
+      (i.e. 'prov_nhood.min.geojson'). The data file points the map to them.
+
+The config file itself isn't changed.
+
+Usage:
+    python prepMap.py [config_file ...]
+"""
+
+import bisect
+import json
+import os
+import sys
+from collections import OrderedDict
+
+# Same regions as interactive_map.js, plus how much their shapes get simplified
+REGIONS = {
+    'Rhode Island': {
+        'geo_file': 'ri_muni.geojson',
+        'geo_name': 'MUNI',
+        'tolerance': 0.0005  # Degrees; about 50 meters
+    },
+    'Providence': {
+        'geo_file': 'prov_nhood.geojson',
+        'geo_name': 'LNAME',
+        'tolerance': 0.00005  # About 5 meters
+    }
+}
+PRECISION = 5  # Decimal places kept in coordinates (about 1 meter)
+# Settings the data file is made from (the map only uses it while they're the same)
+MAP_SETTINGS = ['file', 'value', 'norm', 'cutoffs', 'colors', 'region']
+
+
+def prepMap(config_file='rimap_config.json'):
+    """Saves precomputed data and shapes for the map described by a config file.
+
+    Args:
+        config_file: (Optional) String name of the config file. The data
+            and shape files it refers to are relative to its folder.
+
+    Returns:
+        Nothing.
+
+    Side effect:
+        Saves two new files (JSON, GeoJSON). The GeoJSON is only saved again
+        if the region's shape file is newer.
+    """
+
+    folder = os.path.dirname(config_file)
+    config = readJSON(config_file)
+    if config['region'] not in REGIONS:
+        raise ValueError("In " + config_file + ", 'region' must be " +
+            "either 'Providence' or 'Rhode Island'.")
+    region = REGIONS[config['region']]
+
+    geo = readJSON(os.path.join(folder, region['geo_file']))
+    dataset = readJSON(os.path.join(folder, config['file']))
+
+    geo_file = region['geo_file'].rsplit('.', 1)[0] + '.min.geojson'
+    source = os.path.join(folder, region['geo_file'])
+    target = os.path.join(folder, geo_file)
+    if not (os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source)):
+        saveJSON(target, simplifyGeo(geo, region['geo_name'], region['tolerance']))
+
+    names = [f['properties'][region['geo_name']] for f in geo['features']]
+    saveJSON(getMapDataName(config_file), {
+        'settings': dict((k, config.get(k)) for k in MAP_SETTINGS),
+        'geo_file': geo_file,
+        'data': calculateMapData(config, dataset, names)
+    })
+
+
+def calculateMapData(config, dataset, names):
+    """Calculates what the map shows for each location.
+
+    Follows interactive_map.js: the number is value / norm (or just value
+    if there's no norm, or the norm is 0), and the color is the one for the
+    range between the cutoffs that the number falls in.
+
+    Args:
+        config: Dict of the map config (see readme.md).
+        dataset: Dict where keys = location names, values = dicts of data.
+        names: List of location names in the shape file.
+
+    Returns:
+        A dict where keys = location names (as in the shape file), values =
+            dicts with the number ('_value') and its color ('_color'; left
+            out if there are more cutoffs than colors). Locations without a
+            value are left out.
+    """
+
+    map_data = {}
+    for name in names:
+        data = dataset.get(name) or dataset.get(name.upper())
+        if (not data) or (data.get(config['value']) is None):
+            continue
+        value = float(data[config['value']]) / (data.get(config['norm']) or 1)
+        map_data[name] = {'_value': value}
+        c = bisect.bisect_right(config['cutoffs'], value)  # As d3.scale.threshold does
+        if c < len(config['colors']):
+            map_data[name]['_color'] = config['colors'][c]
+    return map_data
+
+
+### SHAPES
+
+
+def simplifyGeo(geo, geo_name, tolerance, precision=PRECISION):
+    """Simplifies the polygons in a GeoJSON FeatureCollection.
+
+    Coordinates are rounded to precision decimal places, and then each ring
+    is simplified with the Douglas-Peucker algorithm. To keep neighboring
+    shapes from getting gaps or overlaps, rings are first split wherever the
+    set of shapes a point belongs to changes, and each piece is simplified
+    the same way no matter which shape it came from.
+
+    Args:
+        geo: Dict of a GeoJSON FeatureCollection of Polygons/MultiPolygons.
+        geo_name: The property with the name of each shape (the only
+            property that's kept).
+        tolerance: Max. distance (in degrees) a simplified line may stray
+            from the original.
+        precision: (Optional) Number of decimal places to keep.
+
+    Returns:
+        A dict of the simplified GeoJSON FeatureCollection.
+    """
+
+    # Every ring, as a list of (x, y) tuples without the repeated last point
+    rings = []
+    for feature in geo['features']:
+        for polygon in getPolygons(feature['geometry']):
+            for ring in polygon:
+                points = []
+                for (x, y) in (tuple(p[:2]) for p in ring):
+                    p = (round(x, precision), round(y, precision))
+                    if (not points) or (p != points[-1]):
+                        points.append(p)
+                if (len(points) > 1) and (points[0] == points[-1]):
+                    points.pop()
+                rings.append(points)
+
+    owners = {}  # Keys = points, values = sets of the rings they're in
+    for (r, ring) in enumerate(rings):
+        for p in ring:
+            owners.setdefault(p, set()).add(r)
+
+    simplified = iter([simplifyRing(ring, owners, tolerance) for ring in rings])
+    features = []
+    for feature in geo['features']:
+        polygons = [[next(simplified) for ring in polygon]
+            for polygon in getPolygons(feature['geometry'])]
+        if feature['geometry']['type'] == 'Polygon':
+            geometry = {'type': 'Polygon', 'coordinates': polygons[0]}
+        else:
+            geometry = {'type': 'MultiPolygon', 'coordinates': polygons}
+        features.append({
+            'type': 'Feature',
+            'properties': {geo_name: feature['properties'][geo_name]},
+            'geometry': geometry
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def simplifyRing(ring, owners, tolerance):
+    """Simplifies a ring (see simplifyGeo).
+
+    Returns:
+        A closed list of [x, y] coordinates for GeoJSON.
+    """
+
+    n = len(ring)
+    if n < 4:
+        return [list(p) for p in ring + ring[:1]]
+
+    # Points where the ring's neighbor changes can't be removed
+    fixed = [i for i in range(n)
+        if (owners[ring[i]] != owners[ring[i - 1]]) or
+            (owners[ring[i]] != owners[ring[(i + 1) % n]])]
+    if not fixed:
+        fixed = [ring.index(min(ring))]  # Same start whichever shape it's from
+
+    points = []
+    for (k, start) in enumerate(fixed):
+        end = fixed[(k + 1) % len(fixed)]
+        if end <= start:
+            end += n
+        piece = [ring[i % n] for i in range(start, end + 1)]
+        points += simplifyLine(piece, tolerance)[:-1]
+
+    if len(points) < 3:  # Too small to simplify
+        points = ring
+    return [list(p) for p in points + points[:1]]
+
+
+def simplifyLine(points, tolerance):
+    """Simplifies a line with the Douglas-Peucker algorithm.
+
+    The line is simplified in a fixed direction (whichever of its ends
+    is smaller), so a line shared by two shapes gives the same result for both.
+
+    Args:
+        points: List of (x, y) tuples.
+        tolerance: Max. distance a simplified line may stray from points.
+
+    Returns:
+        A list of the (x, y) tuples that are kept, including both ends.
+    """
+
+    if (points[::-1] < points):
+        return simplifyLine(points[::-1], tolerance)[::-1]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        (farthest, max_dist) = (None, tolerance)
+        for i in range(first + 1, last):
+            dist = distanceToSegment(points[i], points[first], points[last])
+            if dist > max_dist:
+                (farthest, max_dist) = (i, dist)
+        if farthest is not None:
+            keep[farthest] = True
+            stack += [(first, farthest), (farthest, last)]
+    return [p for (p, k) in zip(points, keep) if (k)]
+
+
+def distanceToSegment(p, a, b):
+    """Returns the distance from point p to the line segment from a to b."""
+
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    if (dx == 0) and (dy == 0):
+        (x, y) = a
+    else:
+        t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / float(dx * dx + dy * dy)
+        t = max(0.0, min(1.0, t))
+        (x, y) = (a[0] + t * dx, a[1] + t * dy)
+    return ((p[0] - x) ** 2 + (p[1] - y) ** 2) ** 0.5
+
+
+def getPolygons(geometry):
+    """Returns a list of the polygons (lists of rings) in a Polygon/MultiPolygon."""
+
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+### GENERAL UTILITIES
+
+
+def getMapDataName(config_file):
+    """Returns the name of the data file prepMap saves for a config file."""
+
+    return config_file.rsplit('.', 1)[0] + '.map.json'
+
+
+def readJSON(file_name):
+    """Reads a JSON file, keeping the order of the keys in objects."""
+
+    with open(file_name, 'r') as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def saveConfig(config_file, config):
+    """Saves a map config with one setting per line, as in the example."""
+
+    with open(config_file, 'w') as f:
+        f.write('{\n' + ',\n'.join(['    ' + json.dumps(k) + ': ' + json.dumps(v)
+            for (k, v) in config.items()]) + '\n}\n')
+    print 'Saved file:', config_file
+
+
+def saveJSON(new_file_name, data):
+    """Saves data as compact JSON at new_file_name."""
+
+    print '\nSaving file:', new_file_name, '...'
+    with open(new_file_name, 'w') as f:
+        json.dump(data, f, separators=(',', ':'), sort_keys=True)
+    print 'Saved file:', new_file_name, '(' + str(os.path.getsize(new_file_name)), 'bytes)'
+
+
+if __name__ == '__main__':
+
+    for config_file in (sys.argv[1:] or ['rimap_config.json']):
+        prepMap(config_file)
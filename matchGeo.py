@@ -1,47 +1,1104 @@
+import collections
+import cPickle
 import csv
+import difflib
+import heapq
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+from array import array
+from itertools import count, ifilter, izip
+from operator import itemgetter
 
-def matchGeo(match_table, voter_table):
+from csvScan import CSVScanner, hashFile
+
+ADDRESS_FIELDS = ['STREET_NUMBER', 'STREET_NAME1', 'CITY', 'STATE']
+BATCH_SIZE = 10000  # Number of rows buffered before each writerows() call
+MEMORY_BUDGET = 1024 ** 3  # Bytes; the match table is sorted on disk above this
+HASH_JOIN_OVERHEAD = 4  # Approx. bytes in memory per byte of match table CSV
+SORT_RECORD_SIZE = 200  # Approx. bytes in memory per record being sorted
+INDEX_VERSION = '3'  # Index files built with another version are rebuilt
+FUZZY_CUTOFF = 0.85  # Minimum similarity for a fuzzy street name match
+CACHE_SIZE = 50000  # Number of normalized names kept in each memo cache
+DIRECTIONS = frozenset(['N', 'S', 'E', 'W', 'NE', 'NW', 'SE', 'SW'])  # Never fuzzy-matched
+
+STREET_ABBREVIATIONS = {
+    'STREET': 'ST', 'AVENUE': 'AVE', 'AV': 'AVE', 'ROAD': 'RD', 'DRIVE': 'DR',
+    'LANE': 'LN', 'BOULEVARD': 'BLVD', 'COURT': 'CT', 'PLACE': 'PL',
+    'TERRACE': 'TER', 'CIRCLE': 'CIR', 'HIGHWAY': 'HWY', 'PARKWAY': 'PKWY',
+    'SQUARE': 'SQ', 'TRAIL': 'TRL', 'TURNPIKE': 'TPKE', 'EXTENSION': 'EXT',
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W'
+}
+
+
+class GeoLookup(object):
+    """Compact lookup from addressID to lat/lon coordinates.
+
+    Instead of one {'lat', 'lon'} dict per address, each address string
+    maps to a row number, and the coordinates for all addresses are stored
+    in two packed arrays of floats, with the number of decimals each was
+    written with (i.e. 4 for '41.0140') in two arrays of bytes. Coordinates
+    that wouldn't come back the same from a float and a number of decimals
+    (i.e. '4.1e1', or text that isn't a number) are kept as text instead,
+    so the output has them exactly as in the match table.
+    """
+
+    __slots__ = ('index', 'lat', 'lon', 'lat_decimals', 'lon_decimals', 'texts', 'fallback')
+
+    def __init__(self):
+
+        self.index = {}  # Keys = addressIDs, values = positions in the arrays
+        self.lat = array('d')
+        self.lon = array('d')
+        self.lat_decimals = array('b')  # -1 where the (lat, lon) are in texts
+        self.lon_decimals = array('b')
+        self.texts = {}  # Keys = positions, values = (lat, lon) text (see above)
+        self.fallback = None  # FallbackIndex, built on the first miss
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def __contains__(self, address):
+
+        return address in self.index
+
+    def add(self, address, lat, lon):
+        """Adds an address with its (str) coordinates."""
+
+        self.extend([address], [lat], [lon])
+
+    def extend(self, addresses, lats, lons):
+        """Adds addresses with their (str) coordinates, given as sequences of the same length."""
+
+        start = len(self.lat)
+        self.index.update(izip(addresses, count(start)))
+        (xs, ys) = (toFloats(lats), toFloats(lons))
+        (lat_decimals, lon_decimals) = (countDecimals(lats, xs), countDecimals(lons, ys))
+        if (-1 in lat_decimals) or (-1 in lon_decimals):
+            for (i, d) in enumerate(izip(lat_decimals, lon_decimals)):
+                if -1 in d:
+                    lat_decimals[i] = -1
+                    self.texts[start + i] = (lats[i], lons[i])
+        self.lat.fromlist(xs)
+        self.lon.fromlist(ys)
+        self.lat_decimals.fromlist(lat_decimals)
+        self.lon_decimals.fromlist(lon_decimals)
+
+    def getText(self, i):
+        """Returns the coordinates at position i as strs, as they were added."""
+
+        d = self.lat_decimals[i]
+        if d < 0:
+            return self.texts[i]
+        return ('%.*f' % (d, self.lat[i]), '%.*f' % (self.lon_decimals[i], self.lon[i]))
+
+    def get(self, address):
+        """Returns the (lat, lon) of an address as strs ready for the CSV.
+
+        Raises:
+            KeyError if the address isn't in the lookup.
+        """
+
+        return self.getText(self.index[address])
+
+    def match(self, address, fuzzy=False):
+        """Like get(), but falls back to matching the normalized address and
+        then (if fuzzy) the closest street name at the same number and city.
+
+        Raises:
+            KeyError if no address matches.
+        """
+
+        i = self.index.get(address)
+        if i is None:
+            if self.fallback is None:  # In file order, so the last duplicate wins
+                self.fallback = FallbackIndex(sorted(self.index.iteritems(), key=itemgetter(1)))
+            i = self.fallback.find(address, fuzzy)
+        return self.getText(i)
+
+
+class FallbackIndex(object):
+    """Indexes addresses by their normalized form, and by number/city/state
+    so that fuzzy matches only compare streets within one block of candidates.
+    As with exact matches, the last of the addresses that normalize the same
+    wins, so items should be in file order.
+    """
+
+    def __init__(self, items):
+        """
+        Args:
+            items: Iterable of (addressID, value) pairs.
+        """
+
+        self.norm = {}  # Keys = normalized addressIDs, values = values
+        self.blocks = {}  # Keys = blocks (see getBlock), values = [(street, value)]
+        for (address, value) in items:
+            norm = normalizeAddress(address)
+            self.norm[norm] = value
+            (number, street, city, state) = splitAddress(norm)
+            self.blocks.setdefault(getBlock(number, city, state), []).append((street, value))
+
+    def find(self, address, fuzzy=False):
+        """Returns the value for the address that best matches address.
+
+        Raises:
+            KeyError if no address matches.
+        """
+
+        norm = normalizeAddress(address)
+        if norm in self.norm:
+            return self.norm[norm]
+        if (fuzzy):
+            (number, street, city, state) = splitAddress(norm)
+            value = closestStreet(street, self.blocks.get(getBlock(number, city, state), []))
+            if value is not None:
+                return value
+        raise KeyError(address)
+
+
+def matchGeo(match_table, voter_table, batch_size=BATCH_SIZE, method=None,
+             memory_budget=MEMORY_BUDGET, tmp_dir=None, workers=1, normalize=True,
+             fuzzy=False, save_rejects=True, previous=None, id_field=None):
     """
     Args:
         match_table: String name of the file with addressIDs and lat/lon coordinates
         voter_table: String name of the file with voter addresses
+        batch_size: (Optional) Number of rows to buffer between writes.
+        method: (Optional) 'hash' to hold the match table in memory, 'merge'
+            to sort both tables on disk and join them in a single pass, or
+            'index' to look addresses up in a persistent index of the match
+            table (see openGeoIndex). By default, picks 'merge' only if the
+            match table won't fit in memory_budget, otherwise 'hash'. The
+            'index' method is only used when asked for, since each lookup
+            costs more than a 'hash' lookup.
+        memory_budget: (Optional) Approximate number of bytes the join may use.
+        tmp_dir: (Optional) Directory for the sort-merge and parallel chunk
+            files. By default, the system's temp directory.
+        workers: (Optional) Number of processes to join the voter file with.
+            Can't be combined with the 'merge' method.
+        normalize: (Optional) If True, addresses that don't match exactly are
+            matched after normalizing case, spacing, punctuation and street
+            suffixes (see normalizeAddress).
+        fuzzy: (Optional) If True (and normalize is True), addresses that still
+            don't match are matched to the most similar street name with the
+            same number, city and state, as long as its directions and
+            numbered words are the same (see closestStreet). Off by default,
+            since a close match can still be the wrong street. Not used by
+            the 'merge' method.
+        save_rejects: (Optional) If True, rows whose address can't be matched
+            are saved to a separate file instead of raising a KeyError.
+        previous: (Optional) String name of the output of an earlier run (i.e.
+            the last voter file's '_geocoded' CSV; it can be the file this
+            run will replace). Rows that haven't changed since then reuse
+            their coordinates, so only new and changed rows are looked up.
+            See joinDelta. Can't be combined with the 'merge' method or
+            multiple workers, so by default, method is then 'index' where it
+            would have been 'merge'.
+        id_field: (Optional) With previous, the field that identifies each
+            row (i.e. 'VOTER_ID'). Rows are then matched to the earlier run
+            by it, and a row changes when its address does. By default,
+            rows are matched by address.
 
     Returns:
         Nothing.
 
     Side effect:
-        Saves a CSV with all the data from voter_table plus the lat/lon coordinates 
-        that correspond with each address. The file name is the same as that of 
+        Saves a CSV with all the data from voter_table plus the lat/lon coordinates
+        that correspond with each address. The file name is the same as that of
         voter_table but with '_geocoded' appended before the '.csv' (or '.txt') extension.
+        Unmatched rows (if any) are saved the same way, but with '_rejects' appended.
+        With previous, the changes since the earlier run are saved the same
+        way, but with '_changes' appended (see joinDelta).
     """
 
-    vts = voter_table.rsplit('.', 1)
-    vts.insert(1, '_geocoded.')
-    new_file_name = ''.join(vts)
-
-    f1 = open(match_table, 'r')
-    reader1 = csv.DictReader(f1)
-    geo_match = {}
-    for row in reader1:
-        geo_match[row['addressID']] = {
-            'lat': row['geo_lat'],
-            'lon': row['geo_lon']
-        }
-    f1.close()
+    new_file_name = getGeocodedName(voter_table)
+    if method is None:
+        method = chooseJoin(match_table, memory_budget)
+        if (previous) and (method == 'merge'):
+            method = 'index'
+    if method not in ['hash', 'merge', 'index']:
+        raise ValueError("method must be 'hash', 'merge', 'index', or None.")
+    if (workers > 1) and (method == 'merge'):
+        raise ValueError("The 'merge' method can't be run with multiple workers.")
+    if (previous) and ((workers > 1) or (method == 'merge')):
+        raise ValueError("previous can't be used with the 'merge' method or multiple workers.")
+    if (previous):
+        last_run = readPrevious(previous, id_field)  # Before new_file_name is replaced
+
+    if method == 'merge':
+        locate = mergeJoin(match_table, voter_table, memory_budget, tmp_dir, normalize)
+    else:
+        geo_match = loadLookup(match_table, method)
+        locate = getLocate(geo_match, normalize, fuzzy)
 
+    reject_file_name = getRejectsName(voter_table)
+    rejectfile = open(reject_file_name, 'wb') if (save_rejects) else None
     print '\nSaving file:', new_file_name, '...'
     with open(new_file_name, 'wb') as newfile:
         f2 = open(voter_table, 'r')
-        reader2 = csv.DictReader(f2)
-        header = reader2.fieldnames + ['addressID', 'geo_lat', 'geo_lon']
-        writer = csv.DictWriter(newfile, header)
-        writer.writeheader()
-        for row in reader2:
-            address = ', '.join([row['STREET_NUMBER'], row['STREET_NAME1'], row['CITY'], row['STATE']])
-            row['addressID'] = address
-            row['geo_lat'] = geo_match[address]['lat']
-            row['geo_lon'] = geo_match[address]['lon']
-            writer.writerow(row)
+        reader2 = csv.reader(f2)
+        fieldnames = reader2.next()
         f2.close()
-    newfile.close()
+        cols = [fieldnames.index(a) for a in ADDRESS_FIELDS]
+        writer = csv.writer(newfile)
+        writer.writerow(fieldnames + ['addressID', 'geo_lat', 'geo_lon'])
+        rejects = None
+        if (save_rejects):
+            rejects = csv.writer(rejectfile)
+            rejects.writerow(fieldnames + ['addressID'])
+        if (previous):
+            f2 = open(voter_table, 'r')
+            reader2 = csv.reader(f2)
+            reader2.next()
+            id_col = fieldnames.index(id_field) if (id_field) else None
+            changes_file_name = getChangesName(voter_table)
+            with open(changes_file_name, 'wb') as changesfile:
+                changes = csv.writer(changesfile)
+                changes.writerow([id_field or 'addressID', 'change', 'old_addressID',
+                    'new_addressID'])
+                rejected = joinDelta(reader2, writer, len(fieldnames), cols, id_col,
+                    last_run, locate, batch_size, rejects, changes)
+            f2.close()
+            print 'Changes saved in:', changes_file_name
+        elif workers > 1:
+            rejected = parallelJoin(match_table, voter_table, newfile, rejectfile,
+                method, geo_match, len(fieldnames), cols, workers, batch_size,
+                tmp_dir, normalize, fuzzy)
+        else:
+            f2 = open(voter_table, 'r')
+            reader2 = csv.reader(f2)
+            reader2.next()
+            rejected = joinRows(reader2, writer, len(fieldnames), cols, locate,
+                batch_size, rejects)
+            f2.close()
+    if method == 'index':
+        geo_match.close()
     print 'Saved file:', new_file_name
+    if (save_rejects):
+        rejectfile.close()
+        if (rejected):
+            print 'Unmatched rows:', rejected, '(saved in', reject_file_name + ')'
+        else:
+            os.remove(reject_file_name)
+
+
+def joinRows(rows, writer, n, cols, locate, batch_size=BATCH_SIZE, rejects=None):
+    """Appends the addressID and coordinates to each voter row and writes it.
+
+    Args:
+        rows: Iterable of voter rows (lists), not including the header.
+        writer: A csv.writer for the output.
+        n: Number of fields in the header of the voter file.
+        cols: Positions of the ADDRESS_FIELDS in each row.
+        locate: Function that takes a row number and address and returns
+            (lat, lon), or raises a KeyError if the address can't be matched.
+        batch_size: (Optional) Number of rows to buffer between writes.
+        rejects: (Optional) A csv.writer for rows that can't be matched.
+            If None, the KeyError is raised instead.
+
+    Returns:
+        The number of rows that couldn't be matched.
+    """
+
+    getAddress = itemgetter(*cols)
+    batch = []
+    rejected = 0
+    for (seq, row) in enumerate(ifilter(None, rows)):  # Skips blank lines, as DictReader would
+        if len(row) < n:  # Pads short rows, as DictReader/DictWriter would
+            row += [''] * (n - len(row))
+        address = ', '.join(getAddress(row))
+        try:
+            coordinates = locate(seq, address)
+        except KeyError:
+            if rejects is None:
+                raise
+            rejects.writerow(row + [address])
+            rejected += 1
+            continue
+        row.append(address)
+        row.extend(coordinates)
+        batch.append(row)
+        if len(batch) >= batch_size:
+            writer.writerows(batch)
+            batch = []
+    writer.writerows(batch)
+
+    return rejected
+
+
+def getLocate(geo_match, normalize=True, fuzzy=False):
+    """Returns a locate function (see joinRows) for a GeoLookup or GeoIndex."""
+
+    if (normalize):
+        match = geo_match.match
+        return lambda seq, address: match(address, fuzzy)
+    get = geo_match.get
+    return lambda seq, address: get(address)
+
+
+def chooseJoin(match_table, memory_budget=MEMORY_BUDGET):
+    """Picks a join method based on the size of the match table.
+
+    An index file for match_table doesn't change the choice: it saves
+    loading the table, but each lookup in it is slower, so 'index' is only
+    used when it's asked for.
+
+    Returns:
+        'hash' if the match table should fit in memory_budget, otherwise 'merge'.
+    """
+
+    if os.path.getsize(match_table) * HASH_JOIN_OVERHEAD > memory_budget:
+        return 'merge'
+    return 'hash'
+
+
+def loadLookup(match_table, method):
+    """Returns a GeoLookup ('hash') or GeoIndex ('index') for match_table."""
+
+    if method == 'index':
+        return openGeoIndex(match_table)
+    return readMatchTable(match_table)
+
+
+def readMatchTable(match_table):
+    """Reads the file of addressIDs and coordinates into a GeoLookup.
+
+    Args:
+        match_table: String name of the file with addressIDs and lat/lon coordinates
+
+    Returns:
+        A GeoLookup with every address in match_table.
+    """
+
+    geo_match = GeoLookup()
+    with CSVScanner(match_table, restval='', quoted=True) as f1:  # addressIDs are quoted
+        for (addresses, lats, lons) in f1.batches(['addressID', 'geo_lat', 'geo_lon']):
+            geo_match.extend(addresses, lats, lons)
+
+    return geo_match
+
+
+### INCREMENTAL JOIN
+
+
+def readPrevious(previous, id_field=None):
+    """Reads the output of an earlier run of matchGeo (see joinDelta).
+
+    Args:
+        previous: String name of a '_geocoded' CSV.
+        id_field: (Optional) The field that identifies each row. By default,
+            rows are identified by their addressID.
+
+    Returns:
+        A dict where keys = IDs (or addressIDs), values = (addressID, lat, lon)
+            tuples of strs.
+    """
+
+    last_run = {}
+    with CSVScanner(previous, restval='', quoted=True) as f:  # As are its addressIDs
+        n = len(f.fieldnames)
+        (a, lat, lon) = [n - 3, n - 2, n - 1]  # matchGeo adds these at the end
+        if f.fieldnames[a:] != ['addressID', 'geo_lat', 'geo_lon']:
+            raise ValueError(previous + ' is not a file saved by matchGeo.')
+        k = f.fieldnames.index(id_field) if (id_field) else a
+        for (key, address, row_lat, row_lon) in f.rows([k, a, lat, lon]):
+            last_run[key] = (address, row_lat, row_lon)
+
+    return last_run
+
+
+def joinDelta(rows, writer, n, cols, id_col, last_run, locate, batch_size=BATCH_SIZE,
+              rejects=None, changes=None):
+    """Like joinRows, but reuses the coordinates of rows that haven't changed.
+
+    A row is unchanged if it has the same ID and address as in the earlier
+    run (or, without IDs, if its address was in the earlier run). Only the
+    other rows are looked up with locate. The number of IDs (or distinct
+    addresses) unchanged, added, moved and removed is printed.
+
+    Args:
+        rows: Iterable of voter rows (lists), not including the header.
+        writer: A csv.writer for the output.
+        n: Number of fields in the header of the voter file.
+        cols: Positions of the ADDRESS_FIELDS in each row.
+        id_col: Position of the ID field in each row, or None to use addresses.
+        last_run: Dict of the earlier run, as returned by readPrevious.
+            Rows are removed from it as they're found.
+        locate: See joinRows.
+        batch_size: (Optional) Number of rows to buffer between writes.
+        rejects: (Optional) See joinRows.
+        changes: (Optional) A csv.writer for the change log. Each row is an
+            ID (or addressID), a change ('added', 'moved' or 'removed'), and
+            the old and new addressIDs.
+
+    Returns:
+        The number of rows that couldn't be matched.
+    """
+
+    getAddress = itemgetter(*cols)
+    counts = collections.Counter()
+    found = {}  # Coordinates of addresses already joined, when there are no IDs
+    batch = []
+    rejected = 0
+    for (seq, row) in enumerate(ifilter(None, rows)):  # Skips blank lines, as DictReader would
+        if len(row) < n:  # Pads short rows, as DictReader/DictWriter would
+            row += [''] * (n - len(row))
+        address = ', '.join(getAddress(row))
+        key = row[id_col] if id_col is not None else address
+        old = last_run.pop(key, None)
+        try:
+            if (old is None) and (key in found):  # Another row at the same address
+                (lat, lon) = found[key]
+            elif (old) and (old[0] == address):
+                counts['unchanged'] += 1
+                (lat, lon) = old[1:]
+            else:
+                change = 'added' if old is None else 'moved'
+                counts[change] += 1
+                if changes is not None:
+                    changes.writerow([key, change, old[0] if (old) else '', address])
+                (lat, lon) = locate(seq, address)
+        except KeyError:
+            if rejects is None:
+                raise
+            rejects.writerow(row + [address])
+            rejected += 1
+            continue
+        if id_col is None:
+            found[key] = (lat, lon)
+        row += [address, lat, lon]
+        batch.append(row)
+        if len(batch) >= batch_size:
+            writer.writerows(batch)
+            batch = []
+    writer.writerows(batch)
+
+    for (key, old) in last_run.items():  # Rows that aren't in the new file
+        counts['removed'] += 1
+        if changes is not None:
+            changes.writerow([key, 'removed', old[0], ''])
+    print ('Unchanged: %d, added: %d, moved: %d, removed: %d' %
+        tuple(counts[k] for k in ['unchanged', 'added', 'moved', 'removed']))
+
+    return rejected
+
+
+### PERSISTENT INDEX
+
+
+class GeoIndex(object):
+    """Lookup from addressID to lat/lon coordinates backed by a SQLite file.
+
+    Has the same get() as GeoLookup, but nothing is loaded up front.
+    """
+
+    def __init__(self, index_file):
+
+        self.conn = sqlite3.connect(index_file)
+        self.conn.text_factory = str
+        self.cursor = self.conn.cursor()
+
+    def __len__(self):
+
+        return self.cursor.execute('SELECT COUNT(*) FROM geo').fetchone()[0]
+
+    def __contains__(self, address):
+
+        return (self.cursor.execute('SELECT 1 FROM geo WHERE addressID = ?',
+            (address,)).fetchone() is not None)
+
+    def get(self, address):
+        """Returns the (lat, lon) of an address as strs ready for the CSV.
+
+        Raises:
+            KeyError if the address isn't in the index.
+        """
+
+        row = self.cursor.execute('SELECT geo_lat, geo_lon FROM geo WHERE addressID = ?',
+            (address,)).fetchone()
+        if row is None:
+            raise KeyError(address)
+        return row
+
+    def match(self, address, fuzzy=False):
+        """Like get(), but falls back to matching the normalized address and
+        then (if fuzzy) the closest street name at the same number and city.
+
+        Raises:
+            KeyError if no address matches.
+        """
+
+        row = self.cursor.execute('SELECT geo_lat, geo_lon FROM geo WHERE addressID = ?',
+            (address,)).fetchone()
+        if row is not None:
+            return row
+
+        # Rows are in file order by rowid (a replaced row gets a new one), so
+        # the last of the addresses that normalize the same wins, as in GeoLookup
+        norm = normalizeAddress(address)
+        row = self.cursor.execute('SELECT geo_lat, geo_lon FROM geo WHERE norm = ? ' +
+            'ORDER BY rowid DESC LIMIT 1', (norm,)).fetchone()
+        if (row is None) and (fuzzy):
+            (number, street, city, state) = splitAddress(norm)
+            candidates = self.cursor.execute(
+                'SELECT street, geo_lat, geo_lon FROM geo WHERE block = ? ORDER BY rowid',
+                (getBlock(number, city, state),)).fetchall()
+            row = closestStreet(street, [(c[0], c[1:]) for c in candidates])
+        if row is None:
+            raise KeyError(address)
+        return row
+
+    def close(self):
+
+        self.conn.close()
+
+
+def openGeoIndex(match_table, index_file=None):
+    """Opens the persistent index of a match table, (re)building it if needed.
+
+    The index is rebuilt only if match_table's contents have changed since
+    the index was built. If only its modification time has changed, the
+    file is hashed and the index is kept when the hash still matches.
+
+    Args:
+        match_table: String name of the file with addressIDs and lat/lon coordinates
+        index_file: (Optional) String name of the index file. By default,
+            the name of match_table with '.geoindex' appended.
+
+    Returns:
+        A GeoIndex.
+    """
+
+    if index_file is None:
+        index_file = getIndexName(match_table)
+    stat = os.stat(match_table)
+    source = {'size': str(stat.st_size), 'mtime': repr(stat.st_mtime)}
+
+    built = None
+    if os.path.exists(index_file):
+        conn = sqlite3.connect(index_file)
+        try:
+            built = dict(conn.execute('SELECT key, value FROM meta'))
+        except sqlite3.DatabaseError:
+            pass  # Not a finished index; rebuild it
+        conn.close()
+    if (built) and (built.get('version') != INDEX_VERSION):
+        built = None
+
+    if (built) and (built.get('size') == source['size']):
+        if built.get('mtime') == source['mtime']:
+            return GeoIndex(index_file)
+        source['md5'] = hashFile(match_table)
+        if built.get('md5') == source['md5']:  # Touched but unchanged
+            conn = sqlite3.connect(index_file)
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'mtime'", (source['mtime'],))
+            conn.commit()
+            conn.close()
+            return GeoIndex(index_file)
+
+    if 'md5' not in source:
+        source['md5'] = hashFile(match_table)
+    buildGeoIndex(match_table, index_file, source)
+    return GeoIndex(index_file)
+
+
+def buildGeoIndex(match_table, index_file, source):
+    """Saves a match table as a SQLite index file.
+
+    The index is built in a temporary file that replaces index_file once
+    it's complete, so an interrupted build never leaves a partial index.
+
+    Args:
+        match_table: String name of the file with addressIDs and lat/lon coordinates
+        index_file: String name of the index file.
+        source: Dict of str metadata about match_table ('size', 'mtime', 'md5')
+            used to tell whether the index is out of date.
+
+    Besides the coordinates, each address is stored in its normalized form
+    and with its block (see getBlock) and normalized street, for GeoIndex.match.
+
+    Returns:
+        Nothing.
+
+    Side effect:
+        Saves a new file (SQLite) at index_file.
+    """
+
+    print '\nIndexing:', match_table, '...'
+    tmp_file = index_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    conn = sqlite3.connect(tmp_file)
+    conn.text_factory = str  # Addresses are stored as-is, like the CSV's bytes
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('CREATE TABLE geo (addressID TEXT PRIMARY KEY, geo_lat TEXT, ' +
+        'geo_lon TEXT, norm TEXT, block TEXT, street TEXT)')  # Coordinates are kept as text
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def readRows():
+
+        with CSVScanner(match_table, restval='', quoted=True) as f:
+            for (address, lat, lon) in f.rows(['addressID', 'geo_lat', 'geo_lon']):
+                norm = normalizeAddress(address)
+                (number, street, city, state) = splitAddress(norm)
+                yield (address, lat, lon, norm,
+                    getBlock(number, city, state), street)
+
+    conn.executemany('INSERT OR REPLACE INTO geo VALUES (?, ?, ?, ?, ?, ?)',
+        readRows())  # As in a dict, the last duplicate address wins
+    conn.execute('CREATE INDEX geo_norm ON geo (norm)')
+    conn.execute('CREATE INDEX geo_block ON geo (block)')
+
+    source = dict(source, version=INDEX_VERSION)
+    conn.executemany('INSERT INTO meta VALUES (?, ?)', source.items())
+    conn.commit()
+    conn.close()
+    if os.path.exists(index_file):
+        os.remove(index_file)  # os.rename can't overwrite on Windows
+    os.rename(tmp_file, index_file)
+    print 'Saved file:', index_file
+
+
+### PARALLEL JOIN
+
+
+_worker_lookup = {}  # Lookup used by the current worker process; see initWorker
+
+
+def parallelJoin(match_table, voter_table, newfile, rejectfile, method, geo_match,
+                 n, cols, workers, batch_size=BATCH_SIZE, tmp_dir=None,
+                 normalize=True, fuzzy=False):
+    """Joins chunks of the voter file in a pool of processes.
+
+    The voter file is split into byte ranges that start and end on row
+    boundaries (so fields must not contain line breaks). Each worker joins
+    its chunks into temporary files, which are copied into newfile (and
+    rejectfile) in the original row order.
+
+    With 'hash', the lookup loaded by the parent process is inherited by
+    the workers where processes are forked; elsewhere (Windows), each
+    worker loads its own. With 'index', each worker opens its own
+    connection to the index file.
+
+    Args:
+        match_table: String name of the file with addressIDs and lat/lon coordinates
+        voter_table: String name of the file with voter addresses
+        newfile: Open file the joined rows are appended to.
+        rejectfile: Open file unmatched rows are appended to, or None to
+            raise a KeyError for them instead.
+        method: 'hash' or 'index'.
+        geo_match: The GeoLookup or GeoIndex loaded by the parent process.
+        n: Number of fields in the header of the voter file.
+        cols: Positions of the ADDRESS_FIELDS in each row.
+        workers: Number of processes.
+        batch_size: (Optional) Number of rows to buffer between writes.
+        tmp_dir: (Optional) Directory for the chunk files.
+        normalize: (Optional) See matchGeo.
+        fuzzy: (Optional) See matchGeo.
+
+    Returns:
+        The number of rows that couldn't be matched.
+    """
+
+    if method == 'hash':
+        _worker_lookup['hash'] = geo_match  # Set before forking, to be shared
+    chunks = splitRows(voter_table, workers * 4)  # Extra chunks balance the load
+    tasks = [(voter_table, start, end, n, cols, batch_size, tmp_dir,
+        (rejectfile is not None)) for (start, end) in chunks]
+    pool = multiprocessing.Pool(workers, initWorker,
+        (match_table, method, normalize, fuzzy))
+    rejected = 0
+    try:
+        for (chunk_file, reject_file, r) in pool.imap(joinChunk, tasks):  # In order
+            for (name, out) in [(chunk_file, newfile), (reject_file, rejectfile)]:
+                if name is not None:
+                    with open(name, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                    os.remove(name)
+            rejected += r
+        pool.close()
+    finally:
+        pool.terminate()
+        _worker_lookup.clear()
+
+    return rejected
+
+
+def initWorker(match_table, method, normalize=True, fuzzy=False):
+    """Loads the lookup in a worker process unless it was inherited."""
+
+    if method == 'index':
+        _worker_lookup.clear()  # SQLite connections can't be shared across a fork
+    if method not in _worker_lookup:
+        _worker_lookup[method] = loadLookup(match_table, method)
+    _worker_lookup['locate'] = getLocate(_worker_lookup[method], normalize, fuzzy)
+
+
+def joinChunk(task):
+    """Joins the rows in one byte range of the voter file (in a worker process).
+
+    Returns:
+        A tuple containing:
+            String name of the temporary file with the joined rows.
+            String name of the temporary file with the unmatched rows
+                (None if rejects aren't being saved).
+            The number of unmatched rows.
+    """
+
+    (voter_table, start, end, n, cols, batch_size, tmp_dir, save_rejects) = task
+    (fd, chunk_file) = tempfile.mkstemp(suffix='.csv', dir=tmp_dir)
+    reject_file = None
+    rejects = None
+    if (save_rejects):
+        (rfd, reject_file) = tempfile.mkstemp(suffix='.csv', dir=tmp_dir)
+        rejectfile = os.fdopen(rfd, 'wb')
+        rejects = csv.writer(rejectfile)
+    with os.fdopen(fd, 'wb') as out:
+        with open(voter_table, 'rb') as f:
+            f.seek(start)
+            rejected = joinRows(csv.reader(readLines(f, end - start)), csv.writer(out),
+                n, cols, _worker_lookup['locate'], batch_size, rejects)
+    if (save_rejects):
+        rejectfile.close()
+    return (chunk_file, reject_file, rejected)
+
+
+def splitRows(file_name, n):
+    """Splits a CSV (after its header) into about n byte ranges of whole rows.
+
+    Returns:
+        A list of (start, end) byte offsets.
+    """
+
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        f.readline()  # Header
+        bounds = [f.tell()]
+        for i in range(1, n):
+            pos = bounds[0] + (size - bounds[0]) * i // n
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()  # Moves to the start of the next row
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(a, b) for (a, b) in zip(bounds, bounds[1:]) if (a < b)]
+
+
+def readLines(f, length):
+    """Yields lines from an open file until length bytes have been read."""
+
+    while length > 0:
+        line = f.readline()
+        if not line:
+            break
+        length -= len(line)
+        yield line
+
+
+### SORT-MERGE JOIN
+
+
+def mergeJoin(match_table, voter_table, memory_budget=MEMORY_BUDGET, tmp_dir=None,
+              normalize=True):
+    """Joins voter addresses to coordinates without holding either table in memory.
+
+    Both tables are sorted by addressID on disk (see externalSort) and then
+    merged in a single pass. The matched coordinates are sorted back into
+    the original order of voter_table.
+
+    Args:
+        match_table: String name of the file with addressIDs and lat/lon coordinates
+        voter_table: String name of the file with voter addresses
+        memory_budget: (Optional) Approximate number of bytes the sorts may use.
+        tmp_dir: (Optional) Directory for the chunk files.
+        normalize: (Optional) If True, both tables are sorted and joined on
+            their normalized addresses (see normalizeAddress). As in the
+            other methods, an exact match wins, and otherwise the last of
+            the addresses that normalize the same.
+
+    Returns:
+        A function that takes a voter row number and address and returns
+        (lat, lon) as strs. It must be called once per row, in file order
+        and skipping blank lines, and raises a KeyError for addresses that
+        aren't in match_table.
+    """
+
+    key = normalizeAddress if (normalize) else (lambda address: address)
+
+    chunk_size = max(1, memory_budget // SORT_RECORD_SIZE)
+
+    def readVoterAddresses():
+
+        with CSVScanner(voter_table, restval='') as f:
+            for (seq, row) in enumerate(f.rows(ADDRESS_FIELDS)):
+                address = ', '.join(row)
+                yield (key(address), seq, address)
+
+    def readMatches():
+
+        with CSVScanner(match_table, restval='', quoted=True) as f:
+            for (i, (address, lat, lon)) in enumerate(f.rows(['addressID', 'geo_lat', 'geo_lon'])):
+                yield (key(address), i, address, lat, lon)  # Row numbers keep duplicates in file order
+
+    def mergeSorted(voters, matches):
+        """Yields (seq, lat, lon) for each voter, with None for lat and lon
+        if there's no match. Matches are sorted by key and then row number,
+        so for each key, the last row for each exact address and the last
+        row overall are kept, as in a dict."""
+
+        match = next(matches, None)
+        (current, exact, last) = (None, {}, None)
+        for (address_key, seq, address) in voters:
+            if address_key != current:
+                (current, exact, last) = (address_key, {}, None)
+                while (match is not None) and (match[0] < address_key):
+                    match = next(matches, None)
+                while (match is not None) and (match[0] == address_key):
+                    exact[match[2]] = last = (match[3], match[4])
+                    match = next(matches, None)
+            coords = exact.get(address, last)
+            if coords is None:
+                yield (seq, None, None)
+            else:
+                yield (seq, coords[0], coords[1])
+
+    voters = externalSort(readVoterAddresses(), chunk_size, tmp_dir)
+    matches = externalSort(readMatches(), chunk_size, tmp_dir)
+    joined = externalSort(mergeSorted(voters, matches), chunk_size, tmp_dir)
+
+    def locate(seq, address):
+
+        (joined_seq, lat, lon) = joined.next()
+        if joined_seq != seq:
+            raise ValueError('Voter row ' + str(seq) + ' was joined out of order (got row ' +
+                str(joined_seq) + '); both passes must skip the same rows.')
+        if lat is None:
+            raise KeyError(address)
+        return (lat, lon)
+
+    return locate
+
+
+def externalSort(records, chunk_size, tmp_dir=None):
+    """Sorts tuples that may not all fit in memory.
+
+    Records are sorted chunk_size at a time, each sorted chunk is pickled to
+    a temporary file, and the chunks are then lazily merged.
+
+    Args:
+        records: Iterable of tuples (sorted by their natural order).
+        chunk_size: Number of records to sort in memory at a time.
+        tmp_dir: (Optional) Directory for the chunk files.
+
+    Returns:
+        An iterator over the records in sorted order.
+    """
+
+    def writeChunk(chunk):
+
+        f = tempfile.TemporaryFile(dir=tmp_dir)  # Deleted once closed
+        chunk.sort()
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        pickler.fast = 1  # No memo, so neither side holds on to every record
+        for r in chunk:
+            pickler.dump(r)
+        f.seek(0)
+        return f
+
+    def readChunk(f):
+
+        unpickler = cPickle.Unpickler(f)
+        try:
+            while True:
+                yield unpickler.load()
+        except EOFError:
+            f.close()
+
+    chunks = []
+    chunk = []
+    for r in records:
+        chunk.append(r)
+        if len(chunk) >= chunk_size:
+            chunks.append(writeChunk(chunk))
+            chunk = []
+    if (chunk):
+        chunks.append(writeChunk(chunk))
+
+    return heapq.merge(*[readChunk(f) for f in chunks])
+
+
+### ADDRESS NORMALIZATION
+
+
+def lruCache(maxsize):
+    """Decorator that memoizes a function of one argument, keeping only the
+    results for the maxsize most recently used arguments."""
+
+    def decorator(f):
+
+        cache = collections.OrderedDict()
+
+        def cached(x):
+
+            try:
+                value = cache.pop(x)
+            except KeyError:
+                value = f(x)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)  # Least recently used
+            cache[x] = value
+            return value
+
+        cached.cache = cache
+        return cached
+
+    return decorator
+
+
+def normalizeAddress(address):
+    """Normalizes an addressID ('NUMBER, STREET, CITY, STATE') for matching."""
+
+    (number, street, city, state) = splitAddress(address)
+    return ', '.join([normalizeText(number), normalizeStreet(street),
+        normalizeText(city), normalizeText(state)])
+
+
+@lruCache(CACHE_SIZE)
+def normalizeText(text):
+    """Uppercases text, drops periods and '#', and collapses whitespace."""
+
+    return ' '.join(text.upper().replace('.', ' ').replace('#', ' ').split())
+
+
+@lruCache(CACHE_SIZE)
+def normalizeStreet(street):
+    """Normalizes a street name, abbreviating suffixes and directions
+    (i.e. 'Broad Street' becomes 'BROAD ST')."""
+
+    words = normalizeText(street).split()
+    return ' '.join([STREET_ABBREVIATIONS.get(w, w) for w in words])
+
+
+def splitAddress(address):
+    """Splits an addressID into its (number, street, city, state) parts."""
+
+    parts = [p.strip() for p in address.split(',')]
+    if len(parts) < 4:
+        parts = parts[:1] + [''] * (4 - len(parts)) + parts[1:]
+    return (parts[0], ' '.join(parts[1:-2]), parts[-2], parts[-1])
+
+
+def getBlock(number, city, state):
+    """Returns the key of the group of addresses searched for fuzzy matches."""
+
+    return ', '.join([number, city, state])
+
+
+def closestStreet(street, candidates, cutoff=FUZZY_CUTOFF):
+    """Finds the most similar street name.
+
+    Only streets with the same directions (i.e. 'N') and numbered words
+    (i.e. '2ND') are compared, so '3 S MAIN ST' never matches '3 N MAIN ST'
+    and '1ST ST' never matches '21ST ST'. (House numbers are already exact,
+    since candidates are one block; see getBlock.)
+
+    Args:
+        street: A normalized street name.
+        candidates: List of (normalized street name, value) pairs.
+        cutoff: (Optional) Minimum similarity (0 to 1) for a match.
+
+    Returns:
+        The value of the most similar street, or None if none reach cutoff.
+    """
+
+    best = None
+    best_ratio = cutoff
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seq2(street)
+    fixed = getFixedWords(street)
+    for (name, value) in candidates:
+        if getFixedWords(name) != fixed:
+            continue
+        matcher.set_seq1(name)
+        ratio = matcher.ratio()
+        if ratio >= best_ratio:
+            (best, best_ratio) = (value, ratio)
+    return best
+
+
+def getFixedWords(street):
+    """Returns the words of a normalized street name that must match exactly
+    (directions, and words with digits), in order."""
+
+    return [w for w in street.split() if (w in DIRECTIONS) or any(c.isdigit() for c in w)]
+
+
+### GENERAL UTILITIES
+
+
+def getGeocodedName(voter_table):
+    """Appends '_geocoded' to a file name, before its extension."""
+
+    vts = voter_table.rsplit('.', 1)
+    vts.insert(1, '_geocoded.')
+    return ''.join(vts)
+
+
+def getRejectsName(voter_table):
+    """Appends '_rejects' to a file name, before its extension."""
+
+    vts = voter_table.rsplit('.', 1)
+    vts.insert(1, '_rejects.')
+    return ''.join(vts)
+
+
+def getChangesName(voter_table):
+    """Appends '_changes' to a file name, before its extension."""
+
+    vts = voter_table.rsplit('.', 1)
+    vts.insert(1, '_changes.')
+    return ''.join(vts)
+
+
+def getIndexName(match_table):
+    """Returns the default name of the persistent index of a match table."""
+
+    return match_table + '.geoindex'
+
+
+def toFloat(text):
+    """Converts a coordinate to a float; blanks (and text that isn't a number) become NaN."""
+
+    try:
+        return float(text)
+    except ValueError:
+        return float('nan')
+
+
+def toFloats(texts):
+    """Returns a list of the coordinates in texts as floats (see toFloat)."""
+
+    try:
+        return map(float, texts)
+    except ValueError:  # Rare, so the whole list is converted again
+        return map(toFloat, texts)
+
+
+def countDecimals(texts, floats):
+    """Returns a list of the number of decimals that each float in floats has
+    to be formatted with ('%.*f') to give back the text it was read from,
+    or -1 where no number of decimals would (i.e. '4.1e1', '' or 'n/a').
+    """
+
+    decimals = [len(t) - t.find('.') - 1 for t in texts]  # Checked below
+    if map('%.*f'.__mod__, izip(decimals, floats)) != list(texts):
+        for (i, (text, x)) in enumerate(izip(texts, floats)):
+            d = len(text) - text.find('.') - 1 if '.' in text else 0
+            decimals[i] = d if (d < 128) and ('%.*f' % (d, x) == text) else -1
+
+    return decimals
@@ -0,0 +1,17 @@
+"""Shared helpers for the tests."""
+
+import sys
+from contextlib import contextmanager
+from StringIO import StringIO
+
+
+@contextmanager
+def quiet():
+    """Hides what the code being tested prints (i.e. 'Saving file: ...')."""
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
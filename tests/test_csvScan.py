@@ -0,0 +1,106 @@
+"""Tests for csvScan.py, comparing CSVScanner with csv.DictReader.
+
+Run from the top folder with:
+    python -m unittest discover tests
+"""
+
+import csv
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csvScan import CSVScanner, hashFile
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+TRICKY = ('NAME,CITY,NOTE,CITY\r\n'  # CITY twice: the last one wins, as in DictReader
+    '"Smith, Jane",WARWICK,"Said ""hi""",NEWPORT\r\n'
+    '\r\n'
+    'Doe,CRANSTON,"Two\r\nlines",BRISTOL\r\n'
+    'Short,PROVIDENCE\r\n'
+    'Stray,12 1/2" Elm St,x,NEWPORT\r\n'  # A quote inside a field doesn't start a quoted field
+    '"Quoted, then stray",12" Elm,"y",TIVERTON\r\n'
+    'Long,WARWICK,a,b,c,d\n'
+    'Quote at end,"X",,"Y"\n'
+    '\n')
+
+
+def readDicts(file_name, columns, restval=''):
+    """Returns what csv.DictReader gives for columns in each row."""
+
+    with open(file_name, 'rb') as f:
+        return [dict((c, row[c]) for c in columns)
+            for row in csv.DictReader(f, restval=restval)]
+
+
+class CSVScannerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'tricky.csv')
+        with open(self.file_name, 'wb') as f:
+            f.write(TRICKY)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dir)
+
+    def assertSameAsDictReader(self, file_name, columns):
+
+        expected = readDicts(file_name, columns)
+        for quoted in [False, True]:
+            with CSVScanner(file_name, restval='', quoted=quoted) as scanner:
+                self.assertEqual(list(scanner.dicts(columns)), expected)
+                self.assertEqual(list(scanner.rows(columns)),
+                    [tuple(d[c] for c in columns) for d in expected])
+                batches = list(scanner.batches(columns, batch_size=2))
+                self.assertEqual([v for batch in batches for v in zip(*batch)],
+                    list(scanner.rows(columns)))
+
+    def testTrickyFile(self):
+
+        for columns in [['NAME'], ['CITY'], ['NOTE', 'NAME'], ['NAME', 'CITY', 'NOTE']]:
+            self.assertSameAsDictReader(self.file_name, columns)
+
+    def testCandidateFiles(self):
+
+        for file_name in glob.glob(os.path.join(DATA_DIR, 'cand_*.csv')):
+            with open(file_name, 'rb') as f:
+                header = next(csv.reader(f))
+            self.assertSameAsDictReader(file_name, header)
+            self.assertSameAsDictReader(file_name, ['OFFICE', 'DIST#', 'CITY'])
+
+    def testStrayQuoteInHeader(self):
+
+        file_name = os.path.join(self.dir, 'header.csv')
+        with open(file_name, 'wb') as f:
+            f.write('NAME,HEIGHT 12",CITY\nDoe,5,WARWICK\n')
+        self.assertSameAsDictReader(file_name, ['NAME', 'HEIGHT 12"', 'CITY'])
+
+    def testEmptyFile(self):
+
+        file_name = os.path.join(self.dir, 'empty.csv')
+        open(file_name, 'wb').close()
+        with CSVScanner(file_name) as scanner:
+            self.assertEqual(scanner.fieldnames, [])
+            self.assertEqual(list(scanner.rows([])), [])
+
+    def testUnknownColumn(self):
+
+        with CSVScanner(self.file_name) as scanner:
+            self.assertRaises(KeyError, scanner.rows, ['TOWN'])
+
+    def testHashFile(self):
+
+        self.assertEqual(hashFile(self.file_name), hashlib.md5(TRICKY).hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
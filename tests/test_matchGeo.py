@@ -0,0 +1,242 @@
+"""Tests for matchGeo.py, comparing each join method with the original script.
+
+Run from the top folder with:
+    python -m unittest discover tests
+"""
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matchGeo
+from helpers import quiet
+
+MATCH_HEADER = ['addressID', 'geo_lat', 'geo_lon']
+VOTER_HEADER = ['VOTER_ID', 'FIRST', 'STREET_NUMBER', 'STREET_NAME1', 'CITY', 'STATE']
+
+MATCHES = [
+    ['1, MAIN ST, PROVIDENCE, RI', '41.8240', '-71.4128'],  # Not how repr() would write them
+    ['2, MAIN ST, PROVIDENCE, RI', '41.82', '-71.41'],
+    ['3, ELM ST, CRANSTON, RI', 'n/a', ''],  # Not numbers
+    ['4, OAK AVE, WARWICK, RI', '41.7001', '-71.4162'],
+    ['5, PINE ST, NEWPORT, RI', '4.1e1', '-71.3'],
+]
+VOTERS = [
+    ['1', 'A', '1', 'MAIN ST', 'PROVIDENCE', 'RI'],
+    ['2', 'B', '3', 'ELM ST', 'CRANSTON', 'RI'],
+    ['3', 'C', '2', 'MAIN ST', 'PROVIDENCE', 'RI'],
+    ['4', 'D', '5', 'PINE ST', 'NEWPORT', 'RI'],
+    ['5', 'E', '4', 'OAK AVE', 'WARWICK', 'RI'],
+    ['6', 'F', '1', 'MAIN ST', 'PROVIDENCE', 'RI'],
+]
+
+
+def baselineMatchGeo(match_table, voter_table):
+    """matchGeo as it was before any of the join methods (the expected output)."""
+
+    vts = voter_table.rsplit('.', 1)
+    vts.insert(1, '_geocoded.')
+    new_file_name = ''.join(vts)
+
+    f1 = open(match_table, 'r')
+    reader1 = csv.DictReader(f1)
+    geo_match = {}
+    for row in reader1:
+        geo_match[row['addressID']] = {
+            'lat': row['geo_lat'],
+            'lon': row['geo_lon']
+        }
+    f1.close()
+
+    with open(new_file_name, 'wb') as newfile:
+        f2 = open(voter_table, 'r')
+        reader2 = csv.DictReader(f2)
+        header = reader2.fieldnames + ['addressID', 'geo_lat', 'geo_lon']
+        writer = csv.DictWriter(newfile, header)
+        writer.writeheader()
+        for row in reader2:
+            address = ', '.join([row['STREET_NUMBER'], row['STREET_NAME1'], row['CITY'], row['STATE']])
+            row['addressID'] = address
+            row['geo_lat'] = geo_match[address]['lat']
+            row['geo_lon'] = geo_match[address]['lon']
+            writer.writerow(row)
+        f2.close()
+    return new_file_name
+
+
+class MatchGeoTest(unittest.TestCase):
+
+    METHODS = [
+        {'method': 'hash'},
+        {'method': 'merge'},
+        {'method': 'index'},
+        {'method': 'hash', 'workers': 2},
+        {'method': 'index', 'workers': 2},
+    ]
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dir)
+
+    def writeCSV(self, name, header, rows, blank_after=()):
+        """Saves a CSV in the test folder, with a blank line after each row in blank_after.
+        Rows that are strs are written as they are (i.e. with stray quotes)."""
+
+        file_name = os.path.join(self.dir, name)
+        with open(file_name, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for (i, row) in enumerate(rows):
+                if isinstance(row, str):
+                    f.write(row + '\r\n')
+                else:
+                    writer.writerow(row)
+                if i in blank_after:
+                    f.write('\r\n')
+        return file_name
+
+    def readFile(self, file_name):
+
+        with open(file_name, 'rb') as f:
+            return f.read()
+
+    def getExpected(self, match_table, voter_table):
+        """Returns the contents of the original script's output."""
+
+        expected = self.readFile(baselineMatchGeo(match_table, voter_table))
+        os.remove(matchGeo.getGeocodedName(voter_table))
+        return expected
+
+    def assertSameAsBaseline(self, matches, voters, blank_after=(), **kwargs):
+
+        match_table = self.writeCSV('match.csv', MATCH_HEADER, matches)
+        voter_table = self.writeCSV('voters.csv', VOTER_HEADER, voters, blank_after)
+        expected = self.getExpected(match_table, voter_table)
+        with quiet():
+            matchGeo.matchGeo(match_table, voter_table, tmp_dir=self.dir, **kwargs)
+        self.assertEqual(self.readFile(matchGeo.getGeocodedName(voter_table)), expected)
+        self.assertFalse(os.path.exists(matchGeo.getRejectsName(voter_table)))
+
+    def testMethodsMatchBaseline(self):
+
+        for kwargs in self.METHODS:
+            self.assertSameAsBaseline(MATCHES, VOTERS, **kwargs)
+
+    def testCoordinateTextIsKept(self):
+
+        lookup = matchGeo.readMatchTable(self.writeCSV('match.csv', MATCH_HEADER, MATCHES))
+        self.assertEqual(lookup.get('1, MAIN ST, PROVIDENCE, RI'), ('41.8240', '-71.4128'))
+        self.assertEqual(lookup.get('3, ELM ST, CRANSTON, RI'), ('n/a', ''))
+        self.assertEqual(lookup.get('2, MAIN ST, PROVIDENCE, RI'), ('41.82', '-71.41'))
+        self.assertEqual(lookup.get('5, PINE ST, NEWPORT, RI'), ('4.1e1', '-71.3'))
+        self.assertEqual(sorted(lookup.texts), [2, 4])  # Only the ones that aren't plain decimals
+
+    def testTrailingZerosAreKept(self):
+
+        lookup = matchGeo.GeoLookup()
+        for (i, lat) in enumerate(['41.800000', '-0.000100', '41', '0.5', '041.5', '+41.5']):
+            lookup.add(str(i), lat, '-71.400000')
+            self.assertEqual(lookup.get(str(i)), (lat, '-71.400000'))
+        self.assertEqual(sorted(lookup.texts), [4, 5])
+
+    def testLastDuplicateAddressWins(self):
+
+        matches = MATCHES + [
+            ['2, MAIN ST, PROVIDENCE, RI', '41.0', '-71.5'],  # Sorts before the first one
+            ['4, OAK AVE, WARWICK, RI', '42.0', '-71.4'],  # Sorts after the first one
+        ]
+        for kwargs in self.METHODS + [{'method': 'merge', 'normalize': False}]:
+            self.assertSameAsBaseline(matches, VOTERS, **kwargs)
+
+    def testNormalizedDuplicates(self):
+
+        match_table = self.writeCSV('match.csv', MATCH_HEADER, [
+            ['1, Main St, PROVIDENCE, RI', '41.1', '-71.1'],
+            ['1, MAIN ST, PROVIDENCE, RI', '41.2', '-71.2'],
+            ['1, Main Street, PROVIDENCE, RI', '41.3', '-71.3'],
+            ['2, ELM ST, PROVIDENCE, RI', '41.4', '-71.4'],
+            ['1, MAIN ST, PROVIDENCE, RI', '41.5', '-71.5'],
+            ['2, Elm St., PROVIDENCE, RI', '41.6', '-71.6'],
+        ])
+        voter_table = self.writeCSV('voters.csv', VOTER_HEADER, [
+            ['1', 'A', '1', 'Main St', 'PROVIDENCE', 'RI'],  # Exact
+            ['2', 'B', '1', 'MAIN ST', 'PROVIDENCE', 'RI'],  # Exact, and duplicated
+            ['3', 'C', '1', 'MAIN STREET', 'PROVIDENCE', 'RI'],  # Only normalized
+            ['4', 'D', '2', 'Elm Street', 'PROVIDENCE', 'RI'],  # Only normalized
+        ])
+        expected = ['41.1', '41.5', '41.5', '41.6']  # An exact match, or else the last row
+        for kwargs in self.METHODS:
+            with quiet():
+                matchGeo.matchGeo(match_table, voter_table, tmp_dir=self.dir, **kwargs)
+            with open(matchGeo.getGeocodedName(voter_table), 'rb') as f:
+                lats = [row['geo_lat'] for row in csv.DictReader(f)]
+            self.assertEqual(lats, expected, kwargs)
+
+    def testFuzzyMatching(self):
+
+        match_table = self.writeCSV('match.csv', MATCH_HEADER, [
+            ['3, N MAIN ST, PROVIDENCE, RI', '41.1', '-71.1'],
+            ['1, 21ST ST, PROVIDENCE, RI', '41.2', '-71.2'],
+            ['7, BROADWAY AVE, PROVIDENCE, RI', '41.3', '-71.3'],
+        ])
+        with quiet():
+            index = matchGeo.openGeoIndex(match_table, os.path.join(self.dir, 'match.geoindex'))
+        for lookup in [matchGeo.readMatchTable(match_table), index]:
+            self.assertRaises(KeyError, lookup.match, '7, BRODWAY AVE, PROVIDENCE, RI')
+                # Off by default
+            self.assertEqual(lookup.match('7, BRODWAY AVE, PROVIDENCE, RI', fuzzy=True),
+                ('41.3', '-71.3'))
+            self.assertRaises(KeyError, lookup.match, '3, S MAIN ST, PROVIDENCE, RI', fuzzy=True)
+            self.assertRaises(KeyError, lookup.match, '3, MAIN ST, PROVIDENCE, RI', fuzzy=True)
+            self.assertRaises(KeyError, lookup.match, '1, 1ST ST, PROVIDENCE, RI', fuzzy=True)
+        index.close()
+
+    def testIndexIsOnlyUsedWhenAskedFor(self):
+
+        match_table = self.writeCSV('match.csv', MATCH_HEADER, MATCHES)
+        with quiet():
+            matchGeo.openGeoIndex(match_table).close()
+        self.assertEqual(matchGeo.chooseJoin(match_table), 'hash')
+        self.assertEqual(matchGeo.chooseJoin(match_table, memory_budget=10), 'merge')
+
+    def testBlankVoterLinesAreSkipped(self):
+
+        for kwargs in self.METHODS:
+            self.assertSameAsBaseline(MATCHES, VOTERS, blank_after=[1, 3, 5], **kwargs)
+
+    def testStrayQuotes(self):
+
+        matches = MATCHES + [['7, 12 1/2" ELM ST, CRANSTON, RI', '41.77', '-71.43']]
+        voters = ['7,G,7,12 1/2" ELM ST,CRANSTON,RI',  # A stray quote, which csv.writer wouldn't write
+            ['8', 'H "Jr"', '1', 'MAIN ST', 'PROVIDENCE', 'RI']] + VOTERS
+        for kwargs in self.METHODS:
+            self.assertSameAsBaseline(matches, voters, **kwargs)
+
+    def testBlankVoterLinesWithPrevious(self):
+
+        previous = self.writeCSV('previous.csv', VOTER_HEADER + MATCH_HEADER,
+            [row + MATCHES[0] for row in VOTERS[:3]])
+        for kwargs in [{}, {'method': 'hash'}, {'method': 'index'}]:
+            self.assertSameAsBaseline(MATCHES, VOTERS, blank_after=[1, 3], previous=previous,
+                id_field='VOTER_ID', **kwargs)
+
+    def testPreviousDoesNotBuildIndex(self):
+
+        previous = self.writeCSV('previous.csv', VOTER_HEADER + MATCH_HEADER,
+            [row + MATCHES[0] for row in VOTERS[:3]])
+        self.assertSameAsBaseline(MATCHES, VOTERS, previous=previous)
+        self.assertFalse(os.path.exists(matchGeo.getIndexName(
+            os.path.join(self.dir, 'match.csv'))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""Tests for uncontested/raceTable.py, comparing it with the original getUncRates.
+
+The expected rates are in data/baseline (see test_uncontested.py).
+
+Run from the top folder with:
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'uncontested'))
+
+import uncontested
+from helpers import quiet
+from raceTable import RaceTable, pivot
+from test_uncontested import readBaseline
+
+OFFICE_TYPES = ['Executive', 'Legislature', 'School Committee']
+
+
+class RaceTableTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.races_list = readBaseline('races.json')
+        self.rates = readBaseline('rates.json')
+        self.table = RaceTable(self.races_list)
+
+    def assertSameRates(self, table):
+        """Checks a table's getUncRates against the original's, for every grouping in rates.json."""
+
+        self.assertEqual(table.getUncRates(), self.rates['date'])
+        self.assertEqual(table.getUncRates('district'), self.rates['district'])
+        self.assertEqual(table.getUncRates(group_f=uncontested.getYearFromDate),
+            self.rates['year'])
+        for t in OFFICE_TYPES:
+            self.assertEqual(table.getUncRates(where={'office_type': t}), self.rates[t])
+
+    def testGetUncRatesMatchesBaseline(self):
+
+        self.assertSameRates(self.table)
+        self.assertEqual(uncontested.getUncRates(self.races_list), self.rates['date'])
+
+    def testRollupMatchesBaseline(self):
+
+        derived = {'year': ('date', uncontested.getYearFromDate)}
+        cubes = self.table.rollup([('location', 'date'), ('location', 'year'),
+            ('location', 'district')], derived)
+        self.assertEqual(pivot(cubes[('location', 'date')]), self.rates['date'])
+        self.assertEqual(pivot(cubes[('location', 'year')]), self.rates['year'])
+        self.assertEqual(pivot(cubes[('location', 'district')]), self.rates['district'])
+        for t in OFFICE_TYPES:
+            cubes = self.table.rollup([('location', 'date')], where={'office_type': t})
+            self.assertEqual(pivot(cubes[('location', 'date')]), self.rates[t])
+
+    def testRollupSubtotals(self):
+
+        cubes = self.table.rollup([('location', 'date')], subtotals=True)
+        self.assertEqual(cubes[()][()]['tot_races'], len(self.races_list))
+        self.assertEqual(cubes[()][()]['unc_races'],
+            sum(1 for r in self.races_list if not r['contested']))
+        self.assertEqual(sum(c['tot_races'] for c in cubes[('location',)].values()),
+            len(self.races_list))
+
+    def testSaveAndLoad(self):
+
+        folder = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(folder, 'races.table')
+            with quiet():
+                self.table.save(file_name)
+            for copy in [False, True]:
+                table = RaceTable.load(file_name, copy=copy)
+                self.assertSameRates(table)
+                for c in table.categories + ['contested']:
+                    self.assertEqual(table.column(c), self.table.column(c))
+                del table  # Closes the memory-mapped file before it's removed
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Tests for uncontested/seatIndex.py.
+
+Run from the top folder with:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'uncontested'))
+
+from seatIndex import SeatIndex, getNames
+
+SEAT = ('WARWICK', 'CITY COUNCIL', '4')
+
+
+def makeRace(date, candidates, contested=None):
+    """Returns a race dict like readCandidatesFile's, with the given Valid rows."""
+
+    return {
+        'date': date,
+        'location': SEAT[0],
+        'office': SEAT[1],
+        'district': SEAT[2],
+        'votefor': 1,
+        'candidates': {'Valid': candidates, 'Void': [], 'Withdrew': [], 'Under Review': []},
+        'contested': len(candidates) > 1 if contested is None else contested
+    }
+
+
+def makeIndex(*races):
+
+    seats = SeatIndex()
+    for race in races:
+        seats.addElection({'date': race['date']}, [race])
+    return seats
+
+
+class GetNamesTest(unittest.TestCase):
+
+    def testNames(self):
+
+        race = makeRace('2014-11-04', [{'NAME': ' Smith,  Jane '}, {'NAME': 'doe, john'}])
+        self.assertEqual(getNames(race), ('DOE, JOHN', 'SMITH, JANE'))
+
+    def testBlankNamesAreLeftOut(self):
+
+        race = makeRace('2014-11-04', [{'NAME': 'Smith, Jane'}, {'NAME': '  '}])
+        self.assertEqual(getNames(race), ('SMITH, JANE',))
+
+    def testNoNameColumn(self):
+
+        self.assertIsNone(getNames(makeRace('2014-11-04', [{'TOWN': 'WARWICK'}])))
+        self.assertIsNone(getNames({'candidates': None}))  # A Race record (lean mode)
+        self.assertEqual(getNames(makeRace('2014-11-04', [])), ())
+
+
+class AddElectionTest(unittest.TestCase):
+
+    def testSameDateKeepsOneRacePerSeat(self):
+
+        other = makeRace('2014-11-04', [{'NAME': 'Roe, Rick'}])
+        other['district'] = '5'
+        seats = SeatIndex()
+        seats.addElection({'date': '2014-11-04'},
+            [makeRace('2014-11-04', [{'NAME': 'Smith, Jane'}]), other])
+        self.assertEqual(len(seats), 2)
+        seats.addElection({'date': '2014-11-04'},
+            [makeRace('2014-11-04', [{'NAME': 'Smith, Jane'}, {'NAME': 'Doe, John'}])],
+            replace=False)  # A second file with the same date, as readAllElections does
+        self.assertEqual(seats.getHistory(SEAT), [('2014-11-04', 2, 1, True)])
+        self.assertEqual(seats.getHistory(SEAT[:2] + ('5',)), [('2014-11-04', 1, 1, False)])
+
+        seats.addElection({'date': '2014-11-04'}, [makeRace('2014-11-04', [])])
+        self.assertEqual(seats.getHistory(SEAT), [('2014-11-04', 0, 1, False)])
+        self.assertNotIn(SEAT[:2] + ('5',), seats)
+
+
+class IncumbentRunsTest(unittest.TestCase):
+
+    def testIncumbentRuns(self):
+
+        seats = makeIndex(
+            makeRace('2010-11-02', [{'NAME': 'Smith, Jane'}]),
+            makeRace('2012-11-06', [{'NAME': 'SMITH, JANE'}, {'NAME': 'Doe, John'}]),
+            makeRace('2014-11-04', [{'NAME': 'Roe, Rick'}]))
+        self.assertEqual(seats.getIncumbentRuns(SEAT), [('2012-11-06', ['SMITH, JANE'], True)])
+
+    def testBlankNamesArentIncumbents(self):
+
+        seats = makeIndex(
+            makeRace('2010-11-02', [{'NAME': ''}]),
+            makeRace('2012-11-06', [{'NAME': ''}, {'NAME': 'Doe, John'}]))
+        self.assertEqual(seats.getIncumbentRuns(SEAT), [])
+
+    def testNoNameColumn(self):
+
+        seats = makeIndex(
+            makeRace('2010-11-02', [{'TOWN': 'WARWICK'}]),
+            makeRace('2012-11-06', [{'TOWN': 'WARWICK'}]))
+        self.assertRaises(ValueError, seats.getIncumbentRuns, SEAT)
+        self.assertEqual(seats.getStreaks(SEAT), [('2010-11-02', '2012-11-06', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
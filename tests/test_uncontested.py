@@ -0,0 +1,228 @@
+"""Tests for uncontested/uncontested.py, comparing it with the original script.
+
+The files in data/baseline are what the original uncontested.py made from
+the candidate files in data: unc_rates.csv, every race of readAllElections
+(races.json, sorted by date, location, office and district) and
+getUncRates for a few groupings (rates.json).
+
+Run from the top folder with:
+    python -m unittest discover tests
+"""
+
+import csv
+import glob
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'uncontested'))
+
+import uncontested
+from helpers import quiet
+from runReport import RunReport
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+BASELINE_DIR = os.path.join(DATA_DIR, 'baseline')
+
+OFFICE_TITLES = [
+    'TOWN COUNCIL VOTE FOR 3',
+    'TOWN COUNCIL VOTE FOR 3 ',
+    'TOWN COUNCIL VOTE  FOR 3',
+    'COUNCIL VOTE FOR 2\t',
+    'VOTE FOR 2',
+    'CITY COUNCIL DISTRICT 4',
+    'CITY COUNCIL DISTRICT  4',
+    'CITY COUNCIL DISTRICT 4 VOTE FOR 2',
+    'DISTRICT 7',
+    'DEMOCRATIC DISTRICT COMMITTEE',
+    'DEMOCRATIC DISTRICT COMMITTEE VOTE FOR 5',
+    'SENATOR IN GENERAL ASSEMBLY',
+    'SCHOOL COMMITTEE WITHOUT PARTY MARKS OR DESIGNATION VOTE FOR 2',
+    'NON PARTISAN SCHOOL COMMITTEE',
+    'NON-PARTISAN TOWN MODERATOR',
+    'NON NON PARTISAN PARTISAN MODERATOR',
+    ' MAYOR',
+    'MAYOR',
+    '',
+]
+
+
+def baselineMapOffice(d):
+    """mapOffice as it was before parseOfficeTitle (the expected output)."""
+
+    def removeLastWords(text, n):
+        """Removes the last n words from text."""
+
+        return ' '.join(text.split(' ')[0:-n])
+
+    o = d['OFFICE']
+
+    if o.split()[-3:-1] == ['VOTE','FOR']:
+        d['votefor'] = o.split()[-1]
+        o = removeLastWords(o,3)
+    else:
+        d['votefor'] = 1
+
+    if ((o.split()[-2:-1] == ['DISTRICT']) and (o.split()[-1] != 'COMMITTEE')):
+        d['dist'] = o.split()[-1]
+        o = removeLastWords(o,2)
+    else:
+        d['dist'] = d['DIST#']
+
+    delete = ['WITHOUT PARTY MARKS OR DESIGNATION', 'NON PARTISAN ', 'NON-PARTISAN ']
+    for i in delete:
+        o = o.replace(i,'')
+    d['office'] = o
+
+    return d
+
+
+class ParseOfficeTest(unittest.TestCase):
+
+    def assertSameAsBaseline(self, office):
+
+        expected = baselineMapOffice({'OFFICE': office, 'DIST#': '9'})
+        d = uncontested.mapOffice({'OFFICE': office, 'DIST#': '9', 'CITY': 'WARWICK'})
+        self.assertEqual((d['office'], d['dist'], d['votefor']),
+            (expected['office'], expected['dist'], expected['votefor']), repr(office))
+
+    def testTitlesMatchBaseline(self):
+
+        for office in OFFICE_TITLES:
+            self.assertSameAsBaseline(office)
+
+    def testSpacingMatchesBaseline(self):
+
+        for (s1, s2, s3) in itertools.product([' ', '  ', '\t'], repeat=3):
+            for (start, end) in [('', ''), (' ', ''), ('', ' '), ('', '\t')]:
+                self.assertSameAsBaseline(start + 'CITY COUNCIL DISTRICT' + s1 + '4 VOTE' + s2 +
+                    'FOR' + s3 + '2' + end)
+
+    def testLocationAndType(self):
+
+        self.assertEqual(uncontested.parseOfficeTitle('CITY COUNCIL DISTRICT 4', '9', 'WARWICK'),
+            ('CITY COUNCIL', '4', 1, 'WARWICK', uncontested.getOfficeType('CITY COUNCIL')))
+        self.assertEqual(uncontested.parseOfficeTitle('SENATOR IN GENERAL ASSEMBLY', '12', None)[3],
+            'state')
+
+
+def readBaseline(file_name):
+    """Returns the contents of a file in BASELINE_DIR (a list of rows for a CSV)."""
+
+    with open(os.path.join(BASELINE_DIR, file_name), 'rb') as f:
+        if file_name.endswith('.csv'):
+            return list(csv.reader(f))
+        return json.load(f)
+
+
+def sortRaces(races_list):
+    """Sorts races the way races.json is sorted."""
+
+    return sorted(races_list, key=lambda r: (r['date'], r['location'], r['office'], r['district']))
+
+
+class ReadAllElectionsTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+        for file_name in glob.glob(os.path.join(DATA_DIR, '*.csv')):
+            shutil.copy(file_name, self.dir)
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)  # getDateFromName expects file names without folders
+
+    def tearDown(self):
+
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def readAll(self, **kwargs):
+
+        kwargs.setdefault('cache_dir', None)
+        with quiet():
+            result = uncontested.readAllElections(**kwargs)
+        with open('unc_rates.csv', 'rb') as f:
+            self.assertEqual(list(csv.reader(f)), readBaseline('unc_rates.csv'))
+        os.remove('unc_rates.csv')
+        return result
+
+    def testMatchesBaseline(self):
+
+        for kwargs in [{}, {'workers': 2}, {'background': True}]:
+            (elections_dict, races_list) = self.readAll(**kwargs)
+            self.assertEqual(sortRaces(races_list), readBaseline('races.json'))
+            self.assertEqual(sorted(elections_dict), ['2012-11-06', '2014-09-09', '2014-11-04'])
+
+    def testLeanMatchesBaseline(self):
+
+        (_, races_list) = self.readAll(lean=True)
+        self.assertEqual(uncontested.getUncRates(races_list), readBaseline('rates.json')['date'])
+
+    def testStrayQuote(self):
+
+        with open('cand_11042014_general.csv', 'rb') as f:
+            (header, rest) = f.read().split('\n', 1)
+        with open('cand_11042014_general.csv', 'wb') as f:
+            f.write(header + '\nDoe 12 1/2" Jr,WARWICK,MAYOR,,Valid,Democrat,WARWICK,\n' + rest)
+        with quiet():
+            (_, full) = uncontested.readAllElections(makeCSV=False, cache_dir=None)
+            (_, lean) = uncontested.readAllElections(makeCSV=False, cache_dir=None, lean=True)
+        self.assertEqual(uncontested.getUncRates(lean), uncontested.getUncRates(full))
+        self.assertNotEqual(uncontested.getUncRates(full), readBaseline('rates.json')['date'])
+
+    def testCachedMatchesBaseline(self):
+
+        cache_dir = os.path.join(self.dir, 'cache')
+        for (lean, hits) in [(False, 0), (False, 3), (True, 0), (True, 3)]:
+            report = RunReport()
+            (_, races_list) = self.readAll(cache_dir=cache_dir, lean=lean, report=report)
+            self.assertEqual(report.counts.get('cache_hits', 0), hits)
+            if not (lean):
+                self.assertEqual(sortRaces(races_list), readBaseline('races.json'))
+
+        # A touched but unchanged file is hashed once, then cached with its new mtime
+        os.utime('cand_11062012_general.csv', (time.time() + 10, time.time() + 10))
+        hashFile = uncontested.hashFile
+        hashed = []
+        uncontested.hashFile = lambda file_name: hashed.append(file_name) or hashFile(file_name)
+        try:
+            for expected in [['cand_11062012_general.csv'], []]:
+                del hashed[:]
+                report = RunReport()
+                self.readAll(cache_dir=cache_dir, report=report)
+                self.assertEqual(report.counts['cache_hits'], 3)
+                self.assertEqual(hashed, expected)
+        finally:
+            uncontested.hashFile = hashFile
+
+        # A changed file is read again, even if its size is the same
+        with open('cand_11042014_general.csv', 'rb') as f:
+            text = f.read()
+        with open('cand_11042014_general.csv', 'wb') as f:
+            f.write(text.replace('Smith', 'Smyth'))
+        os.utime('cand_11042014_general.csv', (time.time() + 10, time.time() + 10))
+        report = RunReport()
+        with quiet():
+            (_, races_list) = uncontested.readAllElections(makeCSV=False, cache_dir=cache_dir,
+                report=report)
+        self.assertEqual(report.counts['cache_hits'], 2)
+        self.assertIn('Smyth', json.dumps(races_list))
+
+    def testRunReport(self):
+
+        report = RunReport()
+        self.readAll(report=report)
+        self.assertEqual(report.counts['files'], 3)
+        self.assertEqual(report.counts['skipped_files'], 1)
+        self.assertEqual(report.counts['rows'], 110)
+        self.assertEqual(report.examples['skipped_files'], ['not_candidates_01012010_x.csv'])
+
+
+if __name__ == '__main__':
+    unittest.main()
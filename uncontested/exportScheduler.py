@@ -0,0 +1,196 @@
+import Queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+QUEUE_SIZE = 4  # Max. number of items waiting for each writer
+STOP = object()  # Tells a writer's thread that there are no more items
+
+
+class ExportScheduler(object):
+    """Runs exports (i.e. saving files) in background threads while elections are read.
+
+    Each writer gets its own thread and a bounded queue of items to write.
+    When a queue is full, put waits, so a slow writer can't make memory
+    grow without limit. One-off tasks (i.e. saving a CSV once everything
+    has been read) each get a thread of their own. Meanwhile, reading the
+    next files goes on, so a run takes about as long as its slowest stage
+    instead of all of them added up. Threads are enough for this because
+    Python lets other threads run while one writes to a file or waits for
+    worker processes.
+
+    If something fails in a writer or task, the error is raised by the
+    next put, or by join.
+
+    Example:
+        exports = ExportScheduler()
+        exports.submit('unc_rates_by_year', saveCSV, 'unc_rates_by_year.csv', data, header)
+        exports.submit('all_races', saveCSV, 'all_races.csv', races, races_header)
+        exports.join()
+    """
+
+    def __init__(self, background=True, maxsize=QUEUE_SIZE):
+        """
+        Args:
+            background: (Optional) If False, everything runs right away in
+                the calling thread instead (i.e. for debugging).
+            maxsize: (Optional) Max. number of items waiting for each writer.
+        """
+
+        self.background = background
+        self.maxsize = maxsize
+        self.writers = OrderedDict()  # Keys = names, values = dicts (see addWriter)
+        self.tasks = []  # Threads of tasks
+        self.seconds = OrderedDict()  # Keys = writer/task names, values = time spent working
+        self.errors = []  # sys.exc_info() of each failure
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def addWriter(self, name, make, write, close=None):
+        """Starts a writer, which will be sent every item that's put.
+
+        Args:
+            name: String name of the writer, i.e. 'json'.
+            make: Function that returns what the writer writes to (i.e. an
+                open file). It's called in the writer's thread, since some
+                things (like SQLite connections) only work in the thread
+                that made them.
+            write: Function called as write(target, item) for each item,
+                where target is what make returned.
+            close: (Optional) Function called as close(target) after the
+                last item.
+        """
+
+        if name in self.writers:
+            raise ValueError('There is already a writer named ' + repr(name))
+        writer = self.writers[name] = {'target': None, 'failed': False,
+            'make': make, 'write': write, 'close': close}
+        if (self.background):
+            writer['queue'] = Queue.Queue(self.maxsize)
+            writer['thread'] = self.startThread(name, self.runWriter, name)
+        else:
+            self.startWriter(name)
+            self.raiseErrors()
+
+    def put(self, item):
+        """Sends an item to every writer, waiting if a writer's queue is full."""
+
+        self.raiseErrors()
+        for (name, writer) in self.writers.items():
+            if (self.background):
+                writer['queue'].put(item)
+            elif not (writer['failed']):
+                writer['failed'] = not self.call(name, writer['write'], writer['target'], item)[0]
+        self.raiseErrors()
+
+    def submit(self, name, f, *args):
+        """Runs f(*args) as a task, i.e. saving a file from data that's ready."""
+
+        self.raiseErrors()
+        if (self.background):
+            self.tasks.append(self.startThread(name, self.call, name, f, *args))
+        else:
+            self.call(name, f, *args)
+            self.raiseErrors()
+
+    def join(self, report=None):
+        """Waits for every writer (which is then closed) and task to finish.
+
+        Args:
+            report: (Optional) A RunReport to add the time spent on each
+                writer and task to, as the stage 'export'.
+
+        Raises:
+            The first error from a writer or task, if any.
+        """
+
+        self.finish()
+        if report is not None:
+            for seconds in self.seconds.values():
+                report.add('export', seconds)
+        self.raiseErrors()
+
+    def cancel(self):
+        """Stops the writers (skipping items still waiting) and waits for the tasks.
+
+        Used when reading fails, so no threads are left running. Doesn't raise
+        errors from the writers or tasks.
+        """
+
+        self.cancelled = True
+        self.finish()
+
+    def finish(self):
+        """Closes the writers once their queues are empty, and waits for the tasks."""
+
+        for (name, writer) in self.writers.items():
+            if (self.background):
+                writer['queue'].put(STOP)
+                writer['thread'].join()
+            else:
+                self.closeWriter(name)
+        self.writers.clear()
+        for thread in self.tasks:
+            thread.join()
+        self.tasks = []
+
+    def startThread(self, name, f, *args):
+        """Starts a thread that runs f(*args)."""
+
+        thread = threading.Thread(target=f, args=args, name='export: ' + name)
+        thread.daemon = True  # Never keeps the program running if it's stopped
+        thread.start()
+        return thread
+
+    def runWriter(self, name):
+        """Writes each item in a writer's queue, until it gets STOP (in the writer's thread)."""
+
+        writer = self.writers[name]
+        self.startWriter(name)
+        while True:
+            item = writer['queue'].get()
+            if item is STOP:
+                break
+            if not ((writer['failed']) or (self.cancelled)):  # Otherwise just empties the queue
+                writer['failed'] = not self.call(name, writer['write'], writer['target'], item)[0]
+        self.closeWriter(name)
+
+    def startWriter(self, name):
+        """Makes a writer's target (in the writer's thread)."""
+
+        writer = self.writers[name]
+        (ok, writer['target']) = self.call(name, writer['make'])
+        writer['failed'] = not ok
+
+    def closeWriter(self, name):
+        """Closes a writer's target, unless the writer failed."""
+
+        writer = self.writers[name]
+        if (writer['close']) and not (writer['failed']):
+            self.call(name, writer['close'], writer['target'])
+
+    def call(self, name, f, *args):
+        """Runs f(*args), timing it and keeping any error.
+
+        Returns:
+            A tuple of whether f succeeded and what it returned (or None).
+        """
+
+        start = time.time()
+        try:
+            return (True, f(*args))
+        except Exception:
+            with self.lock:
+                self.errors.append(sys.exc_info())
+            return (False, None)
+        finally:
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + time.time() - start
+
+    def raiseErrors(self):
+        """Raises the first error from a writer or task, if there is one."""
+
+        if (self.errors) and not (self.cancelled):
+            (kind, value, traceback) = self.errors[0]
+            raise kind, value, traceback
@@ -0,0 +1,277 @@
+"""Makes the reports listed in a config file, reading the election files only once.
+
+Usage:
+    python makeReports.py list [--config FILE]
+    python makeReports.py run [REPORT ...] [--config FILE] [--workers N]
+        [--lean | --no-lean] [--table FILE] [--run-report FILE]
+    python makeReports.py ingest [--config FILE] [--workers N] [--lean | --no-lean]
+
+    'list' shows the reports in the config file, 'run' makes them (or only
+    the ones named), and 'ingest' only reads the files, i.e. to update the
+    cache and the files in the config's "ingest" settings. Run it from the
+    folder with the candidate CSVs. --table makes the reports from a
+    RaceTable saved earlier (see readAllElections) without reading any CSVs.
+
+Config file (JSON; by default, reports_config.json in the current folder,
+or else the one in the folder of this file):
+    {
+        "ingest": {"pattern": "*.csv", "workers": 1, "lean": true, "background": true},
+        "reports": [
+            {"name": "exe", "file": "unc_rates_exe.csv", "columns": "date",
+             "where": {"office_type": "Executive"}},
+            {"name": "by_year", "file": "unc_rates_by_year.csv", "columns": "year",
+             "header": ["2006", "2008", "2010", "2012", "2014"]},
+            {"name": "all_races", "file": "all_races.csv", "kind": "races",
+             "header": ["date", "location", "office", "candidates", "contested"]}
+        ]
+    }
+
+    "ingest" settings are passed to readAllElections. A "rates" report (the
+    default "kind") is a CSV with a row for each value of "rows" (by default,
+    'location') and a column for each value of "columns", holding "value"
+    ('unc_rate', 'unc_races' or 'tot_races'; by default, 'unc_rate'). Both
+    can be any race field, 'year', or 'type_short' (Primary/General, which
+    needs an "elections_file" of election types by date). "where" keeps only
+    races with the given values (or any of a list of values). "header" lists
+    the columns; by default, every value of "columns". A "races" report is
+    a CSV with a row for each race, where 'candidates' is the number of
+    valid candidates.
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict
+
+# uncontested.py (and everything it imports) is only imported once a report
+# needs it, so 'list' and --help start right away.
+
+CONFIG_FILE = 'reports_config.json'
+KINDS = ['rates', 'races']
+VALUES = ['unc_rate', 'unc_races', 'tot_races']
+INGEST_SETTINGS = ['pattern', 'cache_dir', 'workers', 'lean', 'background', 'makeJSON',
+    'json_layout', 'compact', 'compress', 'store_file', 'table_file', 'seat_file']
+
+
+def readConfig(config_file=None):
+    """Reads and checks a config file.
+
+    Args:
+        config_file: (Optional) String name of the file. By default,
+            CONFIG_FILE in the current folder, or else in this file's folder.
+
+    Returns:
+        An OrderedDict of the config, where every report has a "kind".
+    """
+
+    if config_file is None:
+        config_file = CONFIG_FILE
+        if not os.path.exists(config_file):
+            config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), CONFIG_FILE)
+    with open(config_file, 'r') as f:
+        config = json.load(f, object_pairs_hook=OrderedDict)
+
+    for (k, v) in config.get('ingest', {}).items():
+        if k not in INGEST_SETTINGS:
+            raise ValueError('Unknown ingest setting: ' + repr(k))
+    names = set()
+    for r in config.get('reports', []):
+        r.setdefault('kind', 'rates')
+        if r['kind'] not in KINDS:
+            raise ValueError('Report ' + repr(r.get('name')) + ' has an unknown kind: ' +
+                repr(r['kind']))
+        if r.get('value', 'unc_rate') not in VALUES:
+            raise ValueError('Report ' + repr(r.get('name')) + "'s value must be one of: " +
+                ', '.join(VALUES))
+        if ('name' not in r) or ('file' not in r) or (r['name'] in names):
+            raise ValueError('Every report needs a "file" and a unique "name".')
+        names.add(r['name'])
+    return config
+
+
+def getReports(config, names=None):
+    """Returns the reports in config with the given names (by default, all of them)."""
+
+    reports = config.get('reports', [])
+    if not names:
+        return reports
+    unknown = set(names) - set(r['name'] for r in reports)
+    if (unknown):
+        raise ValueError('No report named: ' + ', '.join(sorted(unknown)))
+    return [r for r in reports if r['name'] in names]
+
+
+def makeReports(config, names=None, table_file=None, run_report=None, **settings):
+    """Reads the election files once and makes each report from the results.
+
+    Rates reports with the same "where" are counted in a single pass over
+    the races (see RaceTable.rollup), and every CSV is saved in the
+    background while the next report is made (see ExportScheduler).
+
+    Args:
+        config: Dict of a config, as returned by readConfig.
+        names: (Optional) List of the names of the reports to make. By
+            default, all of them.
+        table_file: (Optional) String name of a RaceTable file to make the
+            reports from, instead of reading the election files. Reports of
+            kind "races" can't be made from one.
+        run_report: (Optional) A RunReport (see runReport.py) for the run.
+        settings: (Optional) Ingest settings that override the config's.
+
+    Returns:
+        A list of the new files' names.
+
+    Side effect:
+        Saves a new file (CSV) for each report, plus any files from the
+        ingest settings.
+    """
+
+    from exportScheduler import ExportScheduler
+    from raceTable import RaceTable, pivot
+    from uncontested import prepForCSV, saveCSV
+
+    reports = getReports(config, names)
+    if (table_file):
+        if any(r['kind'] == 'races' for r in reports):
+            raise ValueError('Reports of kind "races" need the races, not a RaceTable.')
+        table = RaceTable.load(table_file, copy=True)
+        elections_list = None
+    else:
+        elections_list = ingest(config, run_report, **settings)
+        table = RaceTable(elections_list)
+
+    exports = ExportScheduler(config.get('ingest', {}).get('background', True))
+    try:
+        for (where, rates_reports) in groupByWhere(r for r in reports if r['kind'] == 'rates'):
+            derived = getDerived(rates_reports)
+            cubes = table.rollup([(r.get('rows', 'location'), r['columns']) for r in rates_reports],
+                derived, getTests(where))
+            for r in rates_reports:
+                rows = r.get('rows', 'location')
+                header = r.get('header') or getColumnValues(table, r['columns'], derived)
+                data = prepForCSV(pivot(cubes[(rows, r['columns'])], r.get('value', 'unc_rate')),
+                    rows)
+                exports.submit(r['name'], saveCSV, r['file'], data, [rows] + header)
+        for r in reports:
+            if r['kind'] == 'races':
+                exports.submit(r['name'], saveCSV, r['file'],
+                    [getRaceRow(race, r['header']) for race in elections_list], r['header'])
+        exports.join(run_report)
+    except:
+        exports.cancel()
+        raise
+    return [r['file'] for r in reports]
+
+
+def ingest(config, run_report=None, **settings):
+    """Reads the election files with the config's ingest settings (see readAllElections).
+
+    Returns:
+        The list of races (elections_list).
+    """
+
+    from uncontested import readAllElections
+
+    kwargs = dict(config.get('ingest', {}))
+    kwargs.update((k, v) for (k, v) in settings.items() if v is not None)
+    (_, elections_list) = readAllElections(makeCSV=False, report=run_report, **kwargs)
+    return elections_list
+
+
+### REPORT UTILITIES
+
+
+def groupByWhere(reports):
+    """Groups reports by their "where", so each group is counted in one pass.
+
+    Returns:
+        A list of (where, reports) tuples, in the order each where first appears.
+    """
+
+    groups = OrderedDict()
+    for r in reports:
+        where = r.get('where') or {}
+        groups.setdefault(json.dumps(where, sort_keys=True), (where, []))[1].append(r)
+    return groups.values()
+
+
+def getTests(where):
+    """Turns a report's "where" into tests for RaceTable.rollup (lists become sets)."""
+
+    return dict((k, (lambda x, v=frozenset(v): x in v) if isinstance(v, list) else v)
+        for (k, v) in where.items())
+
+
+def getDerived(reports):
+    """Returns the derived dimensions (see RaceTable.rollup) that reports can use.
+
+    'year' is always available; 'type_short' is only made if a report uses
+    it, since it needs that report's "elections_file".
+    """
+
+    from uncontested import addPropFromJSON, getYearFromDate, isPrimaryOrGeneral
+
+    derived = {'year': ('date', getYearFromDate)}
+    for r in reports:
+        dims = [r.get('rows', 'location'), r['columns']] + list(r.get('where', {}))
+        if ('type_short' in dims) and ('type_short' not in derived):
+            type_long = addPropFromJSON(r['elections_file'])
+            derived['type_short'] = ('date', lambda d: isPrimaryOrGeneral(type_long(d)))
+    return derived
+
+
+def getColumnValues(table, name, derived):
+    """Returns the sorted values of a dimension over every race in a RaceTable."""
+
+    if name in derived:
+        (field, f) = derived[name]
+        return sorted(set(f(v) for v in table.labels[field]))
+    return sorted(table.labels[name])
+
+
+def getRaceRow(race, header):
+    """Returns a row of a "races" report: the race's fields, and its number of valid candidates."""
+
+    from seatIndex import getValid
+
+    return dict((k, getValid(race) if (k == 'candidates') else race.get(k)) for k in header)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', help='Config file (by default, ' + CONFIG_FILE + ').')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='List the reports in the config file.')
+    run = commands.add_parser('run', help='Make the reports (by default, all of them).')
+    run.add_argument('reports', nargs='*', help='Names of the reports to make.')
+    run.add_argument('--table', help='Make the reports from this RaceTable file.')
+    run.add_argument('--run-report', help='Save timings and counts for the run (JSON).')
+    read = commands.add_parser('ingest', help='Only read the election files.')
+    for p in [run, read]:
+        p.add_argument('--workers', type=int, help='Number of processes to read files with.')
+        lean = p.add_mutually_exclusive_group()
+        lean.add_argument('--lean', action='store_true', default=None,
+            help='Only keep what the reports need (see readAllElections).')
+        lean.add_argument('--no-lean', dest='lean', action='store_false',
+            help='Keep the candidates, even if the config says "lean".')
+    args = parser.parse_args()
+
+    config = readConfig(args.config)
+    if args.command == 'list':
+        for r in config.get('reports', []):
+            print r['name'], ' ' * (20 - len(r['name'])), r['file']
+        sys.exit(0)
+
+    run_report = None
+    if getattr(args, 'run_report', None):
+        from runReport import RunReport
+        run_report = RunReport()
+    if args.command == 'ingest':
+        ingest(config, run_report, workers=args.workers, lean=args.lean)
+    else:
+        makeReports(config, args.reports, args.table, run_report, workers=args.workers,
+            lean=args.lean)
+    if run_report is not None:
+        run_report.save(args.run_report)
@@ -0,0 +1,205 @@
+import json
+import sqlite3
+
+STORE_VERSION = '1'  # Stores saved by another version are emptied and refilled
+
+FIELDS = ['date', 'location', 'office', 'office_type', 'district', 'votefor',
+    'nonpartisan', 'contested']  # Race fields saved in the store
+INDEXED = ['date', 'location', 'office_type', 'district']
+GROUPS = {'year': 'substr(date, 1, 4)'}  # Groups that are calculated from a field
+
+
+class RaceStore(object):
+    """Races (and their candidates) saved in a SQLite file, for querying later.
+
+    Fill it with readAllElections(store_file=...), then ask questions of it
+    without reading any CSVs:
+
+    Example:
+        store = RaceStore('races.sqlite')
+        rates = store.getUncRates('year', since='2010-01-01',
+            where={'office_type': 'School Committee', 'location': 'PROVIDENCE'})
+        saveCSV('unc_rates_prov_sch.csv', prepForCSV(rates, 'location'),
+            ['location'] + sorted(rates.get('PROVIDENCE', {})))
+    """
+
+    def __init__(self, store_file):
+        """
+        Args:
+            store_file: String name of the SQLite file. It's created if it
+                doesn't exist.
+        """
+
+        self.store_file = store_file
+        self.conn = sqlite3.connect(store_file)
+        self.conn.text_factory = str  # Names are stored as-is, like the CSV's bytes
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        version = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if (version is None) or (version[0] != STORE_VERSION):
+            self.conn.execute('DROP TABLE IF EXISTS races')
+            self.conn.execute('DROP TABLE IF EXISTS candidates')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS races (id INTEGER PRIMARY KEY, ' +
+            'date TEXT, location TEXT, office TEXT, office_type TEXT, district TEXT, ' +
+            'votefor INTEGER, nonpartisan INTEGER, contested INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS candidates ' +
+            '(race_id INTEGER, declaration TEXT, data TEXT)')
+        for field in INDEXED:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS races_%s ON races (%s)' % (field, field))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS candidates_race ON candidates (race_id)')
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (STORE_VERSION,))
+        self.conn.commit()
+
+    def __len__(self):
+
+        return self.conn.execute('SELECT COUNT(*) FROM races').fetchone()[0]
+
+    def addElection(self, election, races_list, replace=True):
+        """Saves the races of an election, and their candidates.
+
+        Args:
+            election: Dict of an election, as returned by readCandidatesFile.
+            races_list: List of its races, as returned by readCandidatesFile
+                (dicts or, in lean mode, Race records; the candidates of
+                Race records aren't saved).
+            replace: (Optional) If True, races already saved for the
+                election's date are deleted first.
+        """
+
+        if (replace):
+            self.deleteElection(election['date'])
+        cursor = self.conn.cursor()
+        for race in races_list:
+            cursor.execute('INSERT INTO races (' + ', '.join(FIELDS) + ') VALUES (' +
+                ', '.join(['?'] * len(FIELDS)) + ')', [race[k] for k in FIELDS])
+            race_id = cursor.lastrowid
+            candidates = race.get('candidates') or {}
+            cursor.executemany('INSERT INTO candidates VALUES (?, ?, ?)',
+                [(race_id, declaration, json.dumps(row, sort_keys=True))
+                for declaration in sorted(candidates) for row in candidates[declaration]])
+        self.conn.commit()
+
+    def deleteElection(self, date):
+        """Deletes the races (and their candidates) of the election on date."""
+
+        self.conn.execute('DELETE FROM candidates WHERE race_id IN ' +
+            '(SELECT id FROM races WHERE date = ?)', (date,))
+        self.conn.execute('DELETE FROM races WHERE date = ?', (date,))
+        self.conn.commit()
+
+    def getDates(self):
+        """Returns a sorted list of the election dates in the store."""
+
+        return [r[0] for r in self.conn.execute('SELECT DISTINCT date FROM races ORDER BY date')]
+
+    def getRaces(self, where=None, since=None, until=None, candidates=False):
+        """Returns the races that match a query, like the races_list of readAllElections.
+
+        Args:
+            where: (Optional) Dict where keys = fields, values = the value to
+                keep, or a list of them, i.e. {'office_type': 'Executive'}.
+            since: (Optional) Earliest date to keep (YYYY-MM-DD), inclusive.
+            until: (Optional) Latest date to keep (YYYY-MM-DD), inclusive.
+            candidates: (Optional) If True, each race also has its 'candidates',
+                as in readCandidatesFile.
+
+        Returns:
+            A list of race dicts (see FIELDS), in order of date.
+        """
+
+        (sql, params) = getWhere(where, since, until)
+        races_list = []
+        ids = []
+        for row in self.conn.execute('SELECT id, ' + ', '.join(FIELDS) +
+                ' FROM races' + sql + ' ORDER BY date, id', params):
+            race = dict(zip(FIELDS, row[1:]))
+            race['nonpartisan'] = bool(race['nonpartisan'])
+            race['contested'] = bool(race['contested'])
+            races_list.append(race)
+            ids.append(row[0])
+        if (candidates):
+            for (race_id, race) in zip(ids, races_list):
+                race['candidates'] = self.getCandidates(race_id)
+        return races_list
+
+    def getCandidates(self, race_id):
+        """Returns a dict of a race's candidate rows, by 'DECLARATION' value."""
+
+        candidates = {'Valid': [], 'Void': [], 'Withdrew': [], 'Under Review': []}
+        for (declaration, data) in self.conn.execute(
+                'SELECT declaration, data FROM candidates WHERE race_id = ? ORDER BY rowid',
+                (race_id,)):
+            candidates.setdefault(declaration, []).append(json.loads(data))
+        return candidates
+
+    def getUncRates(self, group='date', where=None, since=None, until=None, value='unc_rate'):
+        """Calculates the share of races that were uncontested, by location and group.
+
+        Gives the same result as getUncRates in uncontested.py for the races
+        that match the query, ready for prepForCSV.
+
+        Args:
+            group: (Optional) Field to group each location's races by, or
+                a key of GROUPS (i.e. 'year').
+            where: (Optional) See getRaces.
+            since: (Optional) See getRaces.
+            until: (Optional) See getRaces.
+            value: (Optional) The statistic to return: 'unc_rate', 'unc_races'
+                or 'tot_races'.
+
+        Returns:
+            A dict where keys = locations, values = dicts where keys = groups,
+                values = the statistic.
+        """
+
+        if value not in ['unc_rate', 'unc_races', 'tot_races']:
+            raise ValueError("value must be 'unc_rate', 'unc_races' or 'tot_races'.")
+        (sql, params) = getWhere(where, since, until)
+        rates = {}
+        for (loc, g, tot, unc) in self.conn.execute('SELECT location, ' +
+                getColumn(group) + ', COUNT(*), SUM(contested = 0) FROM races' + sql +
+                ' GROUP BY 1, 2', params):
+            rates.setdefault(loc, {})[g] = {
+                'unc_rate': float(unc) / float(tot),
+                'unc_races': unc,
+                'tot_races': tot
+            }[value]
+        return rates
+
+    def close(self):
+
+        self.conn.close()
+
+
+def getColumn(name):
+    """Returns the SQL for a field (or a key of GROUPS)."""
+
+    if name in GROUPS:
+        return GROUPS[name]
+    if name not in FIELDS:
+        raise ValueError('Unknown field: ' + repr(name))
+    return name
+
+
+def getWhere(where=None, since=None, until=None):
+    """Returns the SQL WHERE clause (and its parameters) for a query (see getRaces)."""
+
+    tests = []
+    params = []
+    for (field, test) in sorted((where or {}).items()):
+        column = getColumn(field)
+        values = list(test) if isinstance(test, (list, tuple, set)) else [test]
+        parts = []
+        if None in values:  # i.e. races whose office_type is None
+            parts.append(column + ' IS NULL')
+        values = [v for v in values if v is not None]
+        if (values):
+            parts.append(column + ' IN (' + ', '.join(['?'] * len(values)) + ')')
+            params += values
+        tests.append('(' + ' OR '.join(parts) + ')')
+    if since is not None:
+        tests.append('date >= ?')
+        params.append(since)
+    if until is not None:
+        tests.append('date <= ?')
+        params.append(until)
+    return ((' WHERE ' + ' AND '.join(tests)) if (tests) else '', params)
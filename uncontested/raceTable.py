@@ -0,0 +1,330 @@
+import ctypes
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+CATEGORIES = ['date', 'location', 'office', 'office_type', 'district', 'nonpartisan']
+
+# Binary format (see RaceTable.save)
+MAGIC = 'RACETBL1'
+HEADER = struct.Struct('<Q')  # Length of the JSON header
+ALIGNMENT = 8  # Columns start at multiples of this many bytes
+CTYPES = {'i': ctypes.c_int, 'b': ctypes.c_byte}  # For zero-copy columns
+
+
+class RaceTable(object):
+    """Columnar table of races, for fast aggregation.
+
+    Each categorical field (date, location, etc.) is stored as an array of
+    int codes plus a list of the distinct values ('labels') the codes stand
+    for. The 'contested' field is stored as an array of 0/1 values.
+    Aggregating then only has to count codes, and functions of a field
+    (i.e. the year of a date) only have to run once per distinct value.
+    """
+
+    def __init__(self, races_list=(), categories=CATEGORIES):
+        """
+        Args:
+            races_list: (Optional) List of race dicts, as made by calculateContested.
+            categories: (Optional) List of the categorical fields to store.
+        """
+
+        self.categories = list(categories)
+        self.codes = dict((c, array('i')) for c in self.categories)
+        self.labels = dict((c, []) for c in self.categories)
+        self.lookup = dict((c, {}) for c in self.categories)  # Values -> codes
+        self.contested = array('b')
+        self.read_only = False
+        self.extend(races_list)
+
+    def __len__(self):
+
+        return len(self.contested)
+
+    def append(self, race):
+        """Adds a race (dict) to the table."""
+
+        if (self.read_only):
+            raise TypeError("Can't add races to a memory-mapped table; load it with copy=True.")
+        for c in self.categories:
+            value = race[c]
+            lookup = self.lookup[c]
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(self.labels[c])
+                self.labels[c].append(value)
+            self.codes[c].append(code)
+        self.contested.append(1 if race['contested'] else 0)
+
+    def extend(self, races_list):
+        """Adds a list of races (dicts) to the table."""
+
+        for race in races_list:
+            self.append(race)
+
+    def save(self, new_file_name):
+        """Saves the table in a compact binary file that load() can memory-map.
+
+        The file is a short JSON header (the categories, the labels of each,
+        and where each column starts) followed by each column's codes as
+        raw 4-byte ints, and 'contested' as 1-byte 0/1 values. Labels keep
+        their types, so booleans (i.e. 'nonpartisan') and None stay as they are.
+
+        Returns:
+            Nothing.
+
+        Side effect:
+            Saves a new file (binary).
+        """
+
+        columns = [(c, self.codes[c]) for c in self.categories] + [('contested', self.contested)]
+        header = {
+            'length': len(self),
+            'categories': self.categories,
+            'labels': self.labels,
+            'byteorder': sys.byteorder,
+            'columns': {}
+        }
+        offset = 0
+        for (name, values) in columns:
+            header['columns'][name] = [offset, values.typecode]
+            offset += padTo(len(values) * values.itemsize)
+        text = json.dumps(header, sort_keys=True)
+        start = padTo(len(MAGIC) + HEADER.size + len(text))
+
+        print '\nSaving file:', new_file_name, '...'
+        with open(new_file_name, 'wb') as f:
+            f.write(MAGIC + HEADER.pack(len(text)) + text)
+            f.write('\0' * (start - f.tell()))
+            for (name, values) in columns:
+                data = values.tostring()
+                f.write(data + '\0' * (padTo(len(data)) - len(data)))
+        print 'Saved file:', new_file_name
+
+    @classmethod
+    def load(cls, file_name, copy=False):
+        """Loads a table saved by save().
+
+        Args:
+            file_name: String name of the file.
+            copy: (Optional) If False, the columns are read straight from
+                the memory-mapped file, so loading takes about the same time
+                however many races there are, but the table can't be added
+                to. If True, the columns are copied into arrays, which also
+                makes looping over every race about three times as fast.
+
+        Returns:
+            A RaceTable.
+        """
+
+        with open(file_name, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(file_name + ' is not a RaceTable file.')
+            header = json.loads(f.read(HEADER.unpack(f.read(HEADER.size))[0]),
+                object_hook=toStr)
+            start = padTo(f.tell())
+            if header['byteorder'] != sys.byteorder:
+                copy = True  # The columns need their bytes swapped
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        table = cls(categories=header['categories'])
+        table.labels = dict((c, [toStr(v) for v in header['labels'][c]])
+            for c in table.categories)
+        table.lookup = dict((c, dict((v, i) for (i, v) in enumerate(table.labels[c])))
+            for c in table.categories)
+        n = header['length']
+        for (name, (offset, typecode)) in header['columns'].items():
+            offset += start
+            if (copy):
+                values = array(typecode)
+                values.fromstring(buf[offset:offset + n * values.itemsize])
+                if header['byteorder'] != sys.byteorder:
+                    values.byteswap()
+            else:
+                values = (CTYPES[typecode] * n).from_buffer(buf, offset)
+            if name == 'contested':
+                table.contested = values
+            else:
+                table.codes[name] = values
+        if (copy):
+            buf.close()
+        else:
+            table.buffer = buf  # Keeps the file mapped as long as the table is used
+            table.read_only = True
+        return table
+
+    def column(self, name):
+        """Returns a list of the values of a field, one per race."""
+
+        if name == 'contested':
+            return [bool(x) for x in self.contested]
+        labels = self.labels[name]
+        return [labels[i] for i in self.codes[name]]
+
+    def getUncRates(self, group='date', group_f=None, where=None):
+        """Calculates the share of races that were uncontested, by location and group.
+
+        Gives the same result as getUncRates in uncontested.py, in a single
+        pass over the table.
+
+        Args:
+            group: (Optional) Field to group races by within each location.
+            group_f: (Optional) Function applied to the values of group to
+                get the groups, i.e. getYearFromDate to group dates by year.
+            where: (Optional) Dict of field: value; only races that match
+                all of them are counted, i.e. {'office_type': 'Executive'}.
+
+        Returns:
+            A dict where keys = locations, values = dicts where keys = groups,
+                values = uncontested rates (floats).
+        """
+
+        # Maps each code of 'group' to the code of its (derived) group
+        groups = []
+        group_codes = {}
+        remap = array('i')
+        for value in self.labels[group]:
+            g = group_f(value) if group_f else value
+            if g not in group_codes:
+                group_codes[g] = len(groups)
+                groups.append(g)
+            remap.append(group_codes[g])
+
+        # Only races whose codes match every field in 'where' are counted
+        tests = []
+        for (field, value) in (where or {}).items():
+            code = self.lookup[field].get(value)
+            if code is None:
+                return {}
+            tests.append((self.codes[field], code))
+
+        n = len(groups)
+        locations = self.labels['location']
+        tot = [0] * (len(locations) * n)
+        unc = [0] * (len(locations) * n)
+        for (i, (loc, g, contested)) in enumerate(
+                zip(self.codes['location'], self.codes[group], self.contested)):
+            if (tests) and not all(codes[i] == code for (codes, code) in tests):
+                continue
+            k = loc * n + remap[g]
+            tot[k] += 1
+            if not contested:
+                unc[k] += 1
+
+        rates = {}
+        for (k, t) in enumerate(tot):
+            if (t):
+                rates.setdefault(locations[k // n], {})[groups[k % n]] = (
+                    float(unc[k]) / float(t))
+        return rates
+
+    def rollup(self, cubes, derived=None, where=None, subtotals=False):
+        """Counts contested and uncontested races for several groupings at once.
+
+        Every cube is computed in the same pass over the table, and derived
+        dimensions are computed once per distinct value of their field, so
+        nothing is copied per race (unlike chaining addProp and getType).
+
+        Example:
+            table.rollup([('location', 'year')],
+                derived={'year': ('date', getYearFromDate)},
+                where={'office_type': 'School Committee'}, subtotals=True)
+            Returns cubes for ('location', 'year'), ('location',) and ().
+
+        Args:
+            cubes: List of tuples of dimension names. A dimension is a field
+                of the table or a key of derived.
+            derived: (Optional) Dict where keys = new dimension names, values =
+                (field, function) tuples; the function takes the value of the
+                field and returns the value of the new dimension.
+            where: (Optional) Dict where keys = dimension names, values = the
+                value to keep, or a function that takes a value and returns
+                True to keep it. Only races that pass every test are counted.
+            subtotals: (Optional) If True, also computes every leading subset
+                of each cube (as SQL's ROLLUP does), down to the grand total ().
+
+        Returns:
+            A dict where keys = cubes (tuples), values = dicts where keys = tuples
+                of dimension values, values = dicts with 'tot_races', 'unc_races'
+                and 'unc_rate'.
+        """
+
+        derived = derived or {}
+
+        def dimension(name):
+            """Returns the codes of a dimension and the value of each code."""
+
+            if name in derived:
+                (field, f) = derived[name]
+                return (self.codes[field], [f(v) for v in self.labels[field]])
+            return (self.codes[name], self.labels[name])
+
+        all_cubes = []
+        for cube in cubes:
+            for k in (range(len(cube), -1, -1) if (subtotals) else [len(cube)]):
+                if tuple(cube[:k]) not in all_cubes:
+                    all_cubes.append(tuple(cube[:k]))
+
+        tests = []
+        for (name, test) in (where or {}).items():
+            (codes, values) = dimension(name)
+            keep = test if callable(test) else (lambda v, test=test: v == test)
+            tests.append((codes, set(c for (c, v) in enumerate(values) if keep(v))))
+
+        dims = dict((name, dimension(name)) for cube in all_cubes for name in cube)
+        counts = dict((cube, {}) for cube in all_cubes)
+        for (i, contested) in enumerate(self.contested):
+            if (tests) and not all(codes[i] in keep for (codes, keep) in tests):
+                continue
+            for cube in all_cubes:
+                key = tuple(dims[name][1][dims[name][0][i]] for name in cube)
+                c = counts[cube].get(key)
+                if c is None:
+                    c = counts[cube][key] = [0, 0]
+                c[0] += 1
+                if not contested:
+                    c[1] += 1
+
+        return dict((cube, dict((key, {
+            'tot_races': tot,
+            'unc_races': unc,
+            'unc_rate': float(unc) / float(tot)
+        }) for (key, (tot, unc)) in cells.items())) for (cube, cells) in counts.items())
+
+
+def padTo(n):
+    """Rounds n up to a multiple of ALIGNMENT."""
+
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def toStr(x):
+    """Turns unicode from the JSON header back into str (and does the same inside dicts)."""
+
+    if isinstance(x, unicode):
+        return x.encode('utf-8')
+    if isinstance(x, dict):
+        return dict((toStr(k), v) for (k, v) in x.items())
+    return x
+
+
+def pivot(cells, value='unc_rate'):
+    """Turns one cube from RaceTable.rollup into a dict of dicts for prepForCSV.
+
+    Args:
+        cells: Dict of a one- or two-dimensional cube, as returned by rollup.
+        value: (Optional) The statistic to keep: 'unc_rate', 'unc_races' or 'tot_races'.
+
+    Returns:
+        A dict where keys = values of the first dimension, values = dicts where
+            keys = values of the second dimension (or value itself, for a
+            one-dimensional cube), values = the statistic.
+    """
+
+    table = {}
+    for (key, stats) in cells.items():
+        column = key[1] if (len(key) > 1) else value
+        table.setdefault(key[0], {})[column] = stats[value]
+    return table
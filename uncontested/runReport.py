@@ -0,0 +1,225 @@
+import json
+import time
+from contextlib import contextmanager
+
+MAX_EXAMPLES = 10  # Max. number of examples kept for each count
+
+
+class RunReport(object):
+    """Collects timings and counts for a run of readAllElections.
+
+    Stages are timed with a context manager, and things like rows, cache
+    hits and skipped files are counted. Both are kept in total and for
+    whichever file is being read at the time, so the report shows which
+    files and stages take the longest.
+
+    Stages can be nested (i.e. 'mapOffice' runs inside 'parse', which runs
+    inside 'read'); a stage's time includes the stages inside it.
+
+    Hooks are functions called as f(kind, name, value, file_name) whenever a
+    stage finishes (kind 'stage', value = seconds) or something is counted
+    (kind 'count', value = the amount added), i.e. to log progress. They're
+    only called in the process where it happens, not for files read by
+    other workers.
+
+    readAllElections only records into the report while it runs. To count
+    things afterwards (i.e. unknown election types in isPrimaryOrGeneral),
+    make it the current report with setReport.
+
+    Example:
+        report = RunReport()
+        readAllElections(report=report)
+        report.save('run_report.json')
+    """
+
+    def __init__(self):
+
+        self.stages = {}  # Keys = stage names, values = dicts of 'seconds', 'calls'
+        self.counts = {}
+        self.examples = {}  # Keys = count names, values = lists of examples
+        self.files = {}  # Keys = file names, values = dicts of 'stages', 'counts'
+        self.hooks = []
+        self.file_name = None  # File being read, if any
+        self.start = time.time()
+
+    @contextmanager
+    def stage(self, name, file_name=None):
+        """Times the code in a with block as a stage.
+
+        Args:
+            name: String name of the stage.
+            file_name: (Optional) The file the stage is for. Stages and counts
+                inside the block are then also recorded for that file.
+        """
+
+        outer = self.file_name
+        if file_name is not None:
+            self.file_name = file_name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+            self.file_name = outer
+
+    def timed(self, name, f):
+        """Returns a version of f that times each call as a stage."""
+
+        def timedF(*args):
+
+            start = time.time()
+            try:
+                return f(*args)
+            finally:
+                self.add(name, time.time() - start)
+
+        return timedF
+
+    def add(self, name, seconds, calls=1):
+        """Adds time to a stage (see stage)."""
+
+        for stages in self.getTargets('stages'):
+            s = stages.get(name)
+            if s is None:
+                s = stages[name] = {'seconds': 0.0, 'calls': 0}
+            s['seconds'] += seconds
+            s['calls'] += calls
+        for hook in self.hooks:
+            hook('stage', name, seconds, self.file_name)
+
+    def count(self, name, n=1, example=None):
+        """Adds n to a count, optionally keeping an example of what was counted.
+
+        Args:
+            name: String name of the count, i.e. 'rows' or 'skipped_files'.
+            n: (Optional) Amount to add.
+            example: (Optional) A value to keep as an example, i.e. the name
+                of a skipped file. Up to MAX_EXAMPLES distinct ones are kept.
+        """
+
+        for counts in self.getTargets('counts'):
+            counts[name] = counts.get(name, 0) + n
+        if example is not None:
+            examples = self.examples.setdefault(name, [])
+            if (example not in examples) and (len(examples) < MAX_EXAMPLES):
+                examples.append(example)
+        for hook in self.hooks:
+            hook('count', name, n, self.file_name)
+
+    def getTargets(self, kind):
+        """Returns the dicts a stage/count is recorded in: the totals, and the file's."""
+
+        if self.file_name is None:
+            return [getattr(self, kind)]
+        f = self.files.get(self.file_name)
+        if f is None:
+            f = self.files[self.file_name] = {'stages': {}, 'counts': {}}
+        return [getattr(self, kind), f[kind]]
+
+    def merge(self, data):
+        """Adds the stages and counts from another report (as returned by toDict).
+
+        Used to combine the reports of worker processes. Hooks aren't called.
+        """
+
+        for (target, source) in [(self, data)] + [
+                (self.files.setdefault(f, {'stages': {}, 'counts': {}}), d)
+                for (f, d) in data['files'].items()]:
+            stages = target.stages if (target is self) else target['stages']
+            counts = target.counts if (target is self) else target['counts']
+            for (name, s) in source['stages'].items():
+                t = stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                t['seconds'] += s['seconds']
+                t['calls'] += s['calls']
+            for (name, n) in source['counts'].items():
+                counts[name] = counts.get(name, 0) + n
+        for (name, examples) in data.get('examples', {}).items():
+            mine = self.examples.setdefault(name, [])
+            mine += [e for e in examples if (e not in mine)][:MAX_EXAMPLES - len(mine)]
+
+    def toDict(self):
+        """Returns the report as a dict that can be saved as JSON.
+
+        Returns:
+            A dict with:
+                'seconds': Time since the report was made.
+                'stages': Dict where keys = stage names, values = dicts of
+                    'seconds' and 'calls'.
+                'counts': Dict where keys = count names, values = ints.
+                'examples': Dict where keys = count names, values = lists.
+                'rows_per_second': Rows parsed per second of 'parse' time.
+                'files': Dict where keys = file names, values = dicts of
+                    'stages', 'counts' and 'rows_per_second'.
+                'slowest_files': List of the file names, by time spent in 'read'.
+        """
+
+        def rate(stages, counts):
+            seconds = stages.get('parse', {}).get('seconds')
+            return (counts.get('rows', 0) / seconds) if (seconds) else None
+
+        files = dict((f, {
+            'stages': d['stages'],
+            'counts': d['counts'],
+            'rows_per_second': rate(d['stages'], d['counts'])
+        }) for (f, d) in self.files.items())
+        return {
+            'seconds': time.time() - self.start,
+            'stages': self.stages,
+            'counts': self.counts,
+            'examples': self.examples,
+            'rows_per_second': rate(self.stages, self.counts),
+            'files': files,
+            'slowest_files': sorted(files, reverse=True,
+                key=lambda f: files[f]['stages'].get('read', {}).get('seconds', 0))
+        }
+
+    def save(self, new_file_name):
+        """Saves the report (see toDict) as JSON at new_file_name."""
+
+        print '\nSaving file:', new_file_name, '...'
+        with open(new_file_name, 'w') as f:
+            json.dump(self.toDict(), f, indent=4, sort_keys=True)
+        print 'Saved file:', new_file_name
+
+
+class NullReport(RunReport):
+    """A report that records nothing, used when a run isn't being reported on."""
+
+    @contextmanager
+    def stage(self, name, file_name=None):
+
+        yield
+
+    def timed(self, name, f):
+
+        return f
+
+    def add(self, name, seconds, calls=1):
+
+        pass
+
+    def count(self, name, n=1, example=None):
+
+        pass
+
+
+_report = NullReport()  # The report for the current run (see getReport)
+
+
+def getReport():
+    """Returns the report that stages and counts are currently recorded in."""
+
+    return _report
+
+
+def setReport(report):
+    """Makes report the current report (or stops reporting, if None).
+
+    Returns:
+        The previous report, so it can be restored.
+    """
+
+    global _report
+    previous = _report
+    _report = report if (report is not None) else NullReport()
+    return previous
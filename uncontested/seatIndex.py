@@ -0,0 +1,346 @@
+import bisect
+import cPickle
+import os
+from array import array
+
+INDEX_VERSION = 2  # Index files saved by another version are rebuilt
+
+
+class SeatHistory(object):
+    """Every election of one seat, as date-sorted columns.
+
+    dates are ints (YYYYMMDD, see dateToInt), valid is the number of valid
+    candidates, and contested is 0/1. names is a list of tuples of the
+    valid candidates' names, or None if they aren't known (see getNames).
+    """
+
+    __slots__ = ('dates', 'valid', 'votefor', 'contested', 'names')
+
+    def __init__(self):
+
+        self.dates = array('i')
+        self.valid = array('i')
+        self.votefor = array('i')
+        self.contested = array('b')
+        self.names = []
+
+    def __len__(self):
+
+        return len(self.dates)
+
+    def __getstate__(self):
+
+        return [getattr(self, k) for k in self.__slots__]
+
+    def __setstate__(self, state):
+
+        for (k, v) in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+    def add(self, date, valid, votefor, contested, names=None):
+        """Adds (or replaces) the seat's race on date, keeping the dates sorted."""
+
+        i = bisect.bisect_left(self.dates, date)
+        if (i < len(self.dates)) and (self.dates[i] == date):
+            self.remove(i)
+        self.dates.insert(i, date)
+        self.valid.insert(i, valid)
+        self.votefor.insert(i, votefor)
+        self.contested.insert(i, 1 if (contested) else 0)
+        self.names.insert(i, names)
+
+    def remove(self, i):
+        """Removes the race at position i."""
+
+        for k in self.__slots__:
+            del getattr(self, k)[i]
+
+    def getRange(self, since=None, until=None):
+        """Returns the (start, end) positions of the races between two dates (inclusive)."""
+
+        start = 0 if since is None else bisect.bisect_left(self.dates, dateToInt(since))
+        end = len(self.dates) if until is None else bisect.bisect_right(self.dates, dateToInt(until))
+        return (start, end)
+
+
+class SeatIndex(object):
+    """Index of every seat's races across elections, for following a seat over time.
+
+    A seat is a (location, office, district) tuple, as in the races dicts of
+    readCandidatesFile. Each seat's races are kept in order of date (see
+    SeatHistory), so asking about one seat only looks at its own races
+    instead of every election.
+
+    Fill it with readAllElections(seat_file=...), then ask questions of it
+    without reading any CSVs:
+
+    Example:
+        seats = SeatIndex('seats.pickle')
+        seat = ('PROVIDENCE', 'CITY COUNCIL', '2')
+        seats.getStreaks(seat)  # i.e. [('2006-11-07', '2010-11-02', 3)]
+        seats.getUncRate(seat, since='2010-01-01')
+        seats.getIncumbentRuns(seat)
+    """
+
+    def __init__(self, index_file=None):
+        """
+        Args:
+            index_file: (Optional) String name of the file the index is saved
+                in. If it exists, the index is loaded from it.
+        """
+
+        self.index_file = index_file
+        self.seats = {}  # Keys = seats, values = SeatHistory
+        if (index_file) and os.path.exists(index_file):
+            with open(index_file, 'rb') as f:
+                saved = cPickle.load(f)
+            if saved.get('version') == INDEX_VERSION:
+                self.seats = saved['seats']
+
+    def __len__(self):
+
+        return len(self.seats)
+
+    def __contains__(self, seat):
+
+        return getSeat(*seat) in self.seats
+
+    def keys(self):
+        """Returns a sorted list of the seats."""
+
+        return sorted(self.seats)
+
+    def addElection(self, election, races_list, replace=True):
+        """Adds the races of an election.
+
+        Args:
+            election: Dict of an election, as returned by readCandidatesFile.
+            races_list: List of its races, as returned by readCandidatesFile
+                (dicts or, in lean mode, Race records; candidates' names
+                aren't known for Race records).
+            replace: (Optional) If True, races already indexed for the
+                election's date are deleted first. Otherwise, they're kept,
+                except that a seat has at most one race on each date, so a
+                seat's race in races_list replaces the one it already had
+                on that date. This differs from RaceStore.addElection (and
+                the rates of readAllElections), which keep both races when
+                two files with the same date have the same seat.
+        """
+
+        if (replace):
+            self.deleteElection(election['date'])
+        for race in races_list:
+            seat = getSeat(race['location'], race['office'], race['district'])
+            history = self.seats.get(seat)
+            if history is None:
+                history = self.seats[seat] = SeatHistory()
+            history.add(dateToInt(race['date']), getValid(race), race['votefor'],
+                race['contested'], getNames(race))
+
+    def deleteElection(self, date):
+        """Deletes the races of the election on date."""
+
+        date = dateToInt(date)
+        for seat in list(self.seats):
+            history = self.seats[seat]
+            i = bisect.bisect_left(history.dates, date)
+            if (i < len(history)) and (history.dates[i] == date):
+                history.remove(i)
+                if not len(history):
+                    del self.seats[seat]
+
+    def getSeats(self, location=None, office=None):
+        """Returns a sorted list of the seats in a location and/or for an office."""
+
+        return sorted(s for s in self.seats
+            if ((location is None) or (s[0] == location)) and ((office is None) or (s[1] == office)))
+
+    def getHistory(self, seat, since=None, until=None):
+        """Returns a seat's races, in order of date.
+
+        Args:
+            seat: A (location, office, district) tuple.
+            since: (Optional) Earliest date to include (YYYY-MM-DD), inclusive.
+            until: (Optional) Latest date to include (YYYY-MM-DD), inclusive.
+
+        Returns:
+            A list of (date, valid, votefor, contested) tuples, where valid is
+                the number of valid candidates. Empty if the seat isn't indexed.
+        """
+
+        h = self.seats.get(getSeat(*seat))
+        if h is None:
+            return []
+        (start, end) = h.getRange(since, until)
+        return [(intToDate(h.dates[i]), h.valid[i], h.votefor[i], bool(h.contested[i]))
+            for i in range(start, end)]
+
+    def getStreaks(self, seat, since=None, until=None, min_length=1):
+        """Finds the runs of consecutive elections in which a seat was uncontested.
+
+        Args:
+            seat: A (location, office, district) tuple.
+            since: (Optional) See getHistory.
+            until: (Optional) See getHistory.
+            min_length: (Optional) Shortest run to include.
+
+        Returns:
+            A list of (first date, last date, number of elections) tuples,
+                in order of date. If the last one ends on the seat's latest
+                election, it's the seat's current streak.
+        """
+
+        h = self.seats.get(getSeat(*seat))
+        if h is None:
+            return []
+        (start, end) = h.getRange(since, until)
+        streaks = []
+        first = None
+        for i in range(start, end + 1):
+            if (i < end) and not (h.contested[i]):
+                if first is None:
+                    first = i
+            elif first is not None:
+                if i - first >= min_length:
+                    streaks.append((intToDate(h.dates[first]), intToDate(h.dates[i - 1]), i - first))
+                first = None
+        return streaks
+
+    def getUncRate(self, seat, since=None, until=None):
+        """Calculates the share of a seat's elections that were uncontested.
+
+        Returns:
+            A dict with 'unc_rate', 'unc_races' and 'tot_races' (as in
+                getUncontestedRates), or None if the seat has no races then.
+        """
+
+        h = self.seats.get(getSeat(*seat))
+        if h is None:
+            return None
+        (start, end) = h.getRange(since, until)
+        if start >= end:
+            return None
+        tot = float(end - start)
+        unc = tot - sum(h.contested[start:end])
+        return {'tot_races': tot, 'unc_races': unc, 'unc_rate': unc / tot}
+
+    def getUncRates(self, location=None, office=None, since=None, until=None, value='unc_rate'):
+        """Calculates getUncRate for every seat in a location and/or for an office.
+
+        Args:
+            value: (Optional) The statistic to return: 'unc_rate', 'unc_races'
+                or 'tot_races'.
+
+        Returns:
+            A dict where keys = seats, values = the statistic. Seats without
+                races between since and until are left out.
+        """
+
+        if value not in ['unc_rate', 'unc_races', 'tot_races']:
+            raise ValueError("value must be 'unc_rate', 'unc_races' or 'tot_races'.")
+        rates = {}
+        for seat in self.getSeats(location, office):
+            rate = self.getUncRate(seat, since, until)
+            if rate is not None:
+                rates[seat] = rate[value]
+        return rates
+
+    def getIncumbentRuns(self, seat, since=None, until=None):
+        """Finds the elections in which someone ran again for the same seat.
+
+        The candidate files don't say who won, so a candidate counts as an
+        incumbent if they were a valid candidate in the seat's previous
+        election too (which they won for sure if that race was uncontested).
+        Names are compared in upper case, without extra spaces.
+
+        Args:
+            seat: A (location, office, district) tuple.
+            since: (Optional) See getHistory.
+            until: (Optional) See getHistory.
+
+        Returns:
+            A list of (date, names, won) tuples, where names is a sorted list
+                of the candidates who ran again, and won is True if the
+                previous race was uncontested. Empty if the seat isn't indexed.
+
+        Raises:
+            ValueError if the candidates' names aren't known for the seat's
+                races (i.e. they were read in lean mode; see getNames).
+        """
+
+        h = self.seats.get(getSeat(*seat))
+        if h is None:
+            return []
+        (start, end) = h.getRange(since, until)
+        runs = []
+        for i in range(max(start, 1), end):
+            (before, now) = (h.names[i - 1], h.names[i])
+            if (before is None) or (now is None):
+                raise ValueError("Candidates' names aren't known (lean mode, or no NAME column).")
+            names = sorted(set(before) & set(now))
+            if (names):
+                runs.append((intToDate(h.dates[i]), names, not h.contested[i - 1]))
+        return runs
+
+    def save(self, new_file_name=None):
+        """Saves the index (by default, to the file it was loaded from).
+
+        Side effect:
+            Saves a new file (pickle).
+        """
+
+        new_file_name = new_file_name or self.index_file
+        print '\nSaving file:', new_file_name, '...'
+        tmp_file = new_file_name + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump({'version': INDEX_VERSION, 'seats': self.seats}, f,
+                cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(new_file_name):
+            os.remove(new_file_name)  # os.rename can't overwrite on Windows
+        os.rename(tmp_file, new_file_name)
+        print 'Saved file:', new_file_name
+
+
+def getSeat(location, office, district):
+    """Returns the key of a seat, with extra spaces removed from each part."""
+
+    return tuple(' '.join(str(x).split()) if x is not None else None
+        for x in (location, office, district))
+
+
+def getValid(race):
+    """Returns the number of valid candidates in a race (dict or Race record)."""
+
+    valid = race.get('valid')
+    if valid is None:
+        return len(race['candidates']['Valid'])
+    return valid
+
+
+def getNames(race):
+    """Returns a sorted tuple of a race's valid candidates' names (without blank ones).
+
+    Returns None if the names aren't known, as for a Race record (lean
+    mode) or a file without a NAME column, so no incumbents are guessed.
+    """
+
+    if race.get('candidates') is None:
+        return None
+    rows = race['candidates']['Valid']
+    if any('NAME' not in row for row in rows):
+        return None
+    names = (' '.join(row['NAME'].upper().split()) for row in rows)
+    return tuple(sorted(n for n in names if (n)))
+
+
+def dateToInt(date):
+    """Converts a date in YYYY-MM-DD format to an int (YYYYMMDD)."""
+
+    return int(date.replace('-', ''))
+
+
+def intToDate(n):
+    """Converts an int from dateToInt back to YYYY-MM-DD format."""
+
+    s = str(n)
+    return '-'.join([s[0:4], s[4:6], s[6:8]])
@@ -1,13 +1,150 @@
+import cPickle
 import csv
 import glob
+import gzip
+import hashlib
 import json
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # For csvScan.py
+from csvScan import CSVScanner, hashFile
+from exportScheduler import ExportScheduler
+from raceStore import RaceStore
+from raceTable import RaceTable, pivot
+from runReport import NullReport, RunReport, getReport, setReport
+from seatIndex import SeatIndex
+
+CACHE_DIR = '.uncontested_cache'  # Where readAllElections caches parsed files
+CACHE_VERSION = 2  # Cached results from another version are re-parsed
+OFFICE_CACHE_SIZE = 4096  # Max. number of distinct offices parseOffice remembers
+CATALOG_MEMORY = 512 * 1024 ** 2  # Bytes; ElectionCatalog forgets elections above this
+ELECTION_OVERHEAD = 10  # Approx. bytes in memory per byte of candidates CSV
+LEAN_ELECTION_OVERHEAD = 1  # Same, in lean mode
+EXPORT_BUFFER = 1024 ** 2  # Bytes each saved file collects before writing them out
+
+EXTRANEOUS = ['WITHOUT PARTY MARKS OR DESIGNATION', 'NON PARTISAN ', 'NON-PARTISAN ']
+    # Removed from office titles, in this order (see parseOfficeTitle)
+
+DECLARATIONS = ['Valid', 'Void', 'Withdrew', 'Under Review']  # 'DECLARATION' values
+LEAN_FIELDS = ['OFFICE', 'DIST#', 'CITY', 'PARTY', 'DECLARATION']  # The only fields lean mode reads
+
+
+class MemoCache(object):
+    """Memoizes a function, counting how often a result is reused.
+
+    The cache holds at most maxsize results; when it's full, it's emptied
+    and starts over, which keeps lookups as cheap as a dict lookup.
+    """
+
+    def __init__(self, f, maxsize):
+
+        self.f = f
+        self.maxsize = maxsize
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+
+        try:
+            value = self.cache[args]
+        except KeyError:
+            self.misses += 1
+            value = self.f(*args)
+            if len(self.cache) >= self.maxsize:
+                self.cache.clear()
+            self.cache[args] = value
+        else:
+            self.hits += 1
+        return value
+
+    def info(self):
+        """Returns a dict with the cache's hits, misses, size and maxsize."""
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.cache),
+            'maxsize': self.maxsize
+        }
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class Race(object):
+    """Compact record of a race, used in place of a race dict in lean mode.
+
+    Can be read like a race dict (race['contested'], race.get('office')),
+    but only counts the valid candidates instead of keeping every
+    candidate's row.
+    """
+
+    __slots__ = ('date', 'location', 'office', 'office_type', 'district',
+                 'votefor', 'nonpartisan', 'valid', 'contested')
+
+    def __init__(self, votefor, nonpartisan):
+
+        self.date = None
+        self.location = None
+        self.office = None
+        self.office_type = None
+        self.district = None
+        self.votefor = votefor
+        self.nonpartisan = nonpartisan
+        self.valid = 0  # Number of candidates with a 'Valid' declaration
+        self.contested = None  # later gets replaced with True/False
+
+    def __getitem__(self, key):
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
+    def __getstate__(self):
 
-def readAllElections(pattern='*.csv', makeCSV=True, makeJSON=False):
+        return self.items()
+
+    def __setstate__(self, state):
+
+        for (k, v) in state:
+            setattr(self, k, v)
+
+    def get(self, key, default=None):
+
+        return getattr(self, key, default)
+
+    def keys(self):
+
+        return list(self.__slots__)
+
+    def items(self):
+
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+
+def readAllElections(pattern='*.csv', makeCSV=True, makeJSON=False, cache_dir=CACHE_DIR,
+                     workers=1, lean=False, json_layout='json', compact=False, compress=False,
+                     report=None, store_file=None, table_file=None, seat_file=None,
+                     background=False):
     """Runs the readCandidatesFile function on all CSVs in the current folder.
 
     Ignores CSVs that don't have the required fields (TOWN, OFFICE, DIST#).
 
+    Results for each file are cached, so files that haven't changed since
+    the last run aren't parsed again (see readCandidatesFileCached).
+
+    Files are combined in order of election date (and file name, for files
+    with the same date), whether they're read serially or in parallel.
+
     Args:
         pattern: (Optional) String that specifies which files to read. 
             By default, it's all files with a CSV extension.
@@ -15,7 +152,34 @@ def readAllElections(pattern='*.csv', makeCSV=True, makeJSON=False):
             location for each election. Election dates are column headers and 
             each location is a row.
         makeJSON: (Optional) If True, saves a JSON file with the results ('elections_dict'). 
-            File may be huge.
+            File may be huge, so each election is written as soon as it's read
+            (see ElectionsJSONWriter).
+        cache_dir: (Optional) Folder for the cached results. If None,
+            every file is parsed and nothing is cached.
+        workers: (Optional) Number of processes to read the files with.
+        lean: (Optional) If True, races are Race records that only count
+            valid candidates, which takes far less memory. For summary-only
+            runs; can't be combined with makeJSON.
+        json_layout: (Optional) 'json' for elections.json, 'ndjson' for
+            elections.ndjson, or 'shards' for a folder named 'elections'
+            with one file per election. See ElectionsJSONWriter.
+        compact: (Optional) If True, the JSON isn't indented.
+        compress: (Optional) If True, the JSON is gzipped.
+        report: (Optional) A RunReport to record the time each stage takes
+            (for each file and in total) and counts of rows, cache hits,
+            skipped files, etc. See runReport.py.
+        store_file: (Optional) String name of a SQLite file to save the races
+            and candidates in, for querying later (see raceStore.py). Races
+            already in it for the same election dates are replaced.
+        table_file: (Optional) String name of a binary file to save the races
+            in as a RaceTable, which reports can load back in moments
+            (see RaceTable.save and RaceTable.load).
+        seat_file: (Optional) String name of a file to keep a SeatIndex in,
+            for following each seat across elections (see seatIndex.py).
+            Like store_file, it's updated rather than replaced.
+        background: (Optional) If True, files are saved in background
+            threads while the rest of the files are read, instead of one
+            after another (see ExportScheduler). The files are the same.
 
     Returns:
         A tuple containing:
@@ -25,34 +189,250 @@ def readAllElections(pattern='*.csv', makeCSV=True, makeJSON=False):
                 information about the race.
 
     Side effect:
-        Saves up to two new files (CSV, JSON).
+        Saves up to three new files (CSV, JSON, RaceTable), and updates store_file
+        and seat_file.
     """
 
-    elections_dict = {}
-    elections_list = []
-    for file_name in glob.glob(pattern): # For each CSV in the current folder
-        (races, races_list) = readCandidatesFile(file_name)
-        if (races): # If the CSV didn't get skipped for not having the required fields
-            elections_dict[races['date']] = races
-            elections_list += races_list
-
-    if (makeCSV):
-        header = ['location'] + [e for e in sorted(elections_dict)]
-        data = prepForCSV(getUncRates(elections_list), 'location')
-        saveCSV('unc_rates.csv', data, header)
-    if (makeJSON):
-        saveJSON('elections.json', elections_dict)
+    if (lean) and (makeJSON):
+        raise ValueError("makeJSON needs the candidates, which lean mode doesn't keep.")
+
+    previous = setReport(report) if (report is not None) else None
+    try:
+        with getReport().stage('total'):
+            exports = ExportScheduler(background)
+            try:
+                # Each writer gets (races, races_list, replace) for every file read
+                if (makeJSON):
+                    new_file_name = getJSONName('elections', json_layout, compress)
+                    exports.addWriter('json',
+                        lambda: ElectionsJSONWriter(new_file_name, json_layout, compact, compress),
+                        lambda writer, item: writer.write(item[0]), ElectionsJSONWriter.close)
+                if (store_file):  # Files with the same date add to each other
+                    exports.addWriter('store', lambda: RaceStore(store_file),
+                        lambda store, item: store.addElection(*item), RaceStore.close)
+                if (seat_file):
+                    exports.addWriter('seats', lambda: SeatIndex(seat_file),
+                        lambda seats, item: seats.addElection(*item), SeatIndex.save)
+                if (table_file):
+                    exports.addWriter('table', RaceTable,
+                        lambda table, item: table.extend(item[1]),
+                        lambda table: table.save(table_file))
+
+                elections_dict = {}
+                elections_list = []
+                for (races, races_list) in iterElections(pattern, cache_dir, workers, lean):
+                    exports.put((races, races_list, races['date'] not in elections_dict))
+                    elections_dict[races['date']] = races
+                    elections_list += races_list
+
+                if (makeCSV):
+                    header = ['location'] + [e for e in sorted(elections_dict)]
+                    with getReport().stage('aggregate'):
+                        data = prepForCSV(getUncRates(elections_list), 'location')
+                    exports.submit('unc_rates', saveCSV, 'unc_rates.csv', data, header)
+                exports.join(getReport())
+            except:
+                exports.cancel()
+                raise
+    finally:
+        if report is not None:
+            setReport(previous)
 
     return (elections_dict, elections_list)
 
 
-def readCandidatesFile(file_name, makeJSON=False):
+def iterElections(pattern='*.csv', cache_dir=CACHE_DIR, workers=1, lean=False):
+    """Reads election files one at a time, in order of election date.
+
+    Files with the same date are read in order of file name. Since nothing
+    is kept between files, this can be used to process every election
+    without holding all of them in memory.
+
+    Args:
+        pattern: (Optional) String that specifies which files to read.
+        cache_dir: (Optional) Folder for the cached results, or None.
+        workers: (Optional) Number of processes to read the files with.
+        lean: (Optional) See readCandidatesFile.
+
+    Yields:
+        A (races, races_list) tuple, as returned by readCandidatesFile, for
+        each file that has the required fields.
+    """
+
+    file_names = sorted(glob.glob(pattern),
+        key=lambda f: (convertDate(getDateFromName(f)), f))
+    tasks = [(file_name, cache_dir, lean) for file_name in file_names]
+    if workers > 1:
+        report = getReport()
+        reported = not isinstance(report, NullReport)
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap(readElectionFileReported if (reported) else readElectionFile,
+                    tasks):  # In order of tasks
+                if (reported):
+                    (result, data) = result
+                    report.merge(data)
+                if (result[0]):
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+    else:
+        for task in tasks:
+            result = readElectionFile(task)
+            if (result[0]):  # If the CSV didn't get skipped for not having the required fields
+                yield result
+
+
+class ElectionCatalog(object):
+    """Dict-like catalog of elections by date, where each is read when first used.
+
+    Making a catalog only looks at file names, so it's quick no matter how
+    many files there are. An election is read the first time it's looked
+    up and then kept, but the least recently used elections are forgotten
+    (and read again if needed) once the ones kept would take more than
+    max_memory.
+
+    Example:
+        elections = ElectionCatalog()
+        elections.keys()  # Dates, i.e. ['2012-09-11', '2012-11-06', ...]
+        elections['2014-11-04']['unc_rates']  # Only reads the 2014 general
+        getUncRates(elections.getRaces('2014-11-04'))
+    """
+
+    def __init__(self, pattern='*.csv', cache_dir=CACHE_DIR, lean=False,
+                 max_memory=CATALOG_MEMORY):
+        """
+        Args:
+            pattern: (Optional) String that specifies which files to include.
+            cache_dir: (Optional) Folder for the cached results, or None
+                (see readCandidatesFileCached).
+            lean: (Optional) See readCandidatesFile.
+            max_memory: (Optional) Approximate number of bytes the elections
+                kept may take (estimated from the sizes of their files). The
+                most recently used election is always kept.
+        """
+
+        self.cache_dir = cache_dir
+        self.lean = lean
+        self.max_memory = max_memory
+        self.overhead = LEAN_ELECTION_OVERHEAD if (lean) else ELECTION_OVERHEAD
+        self.files = {}  # Keys = dates, values = lists of file names
+        for file_name in sorted(glob.glob(pattern)):
+            self.files.setdefault(convertDate(getDateFromName(file_name)), []).append(file_name)
+        self.loaded = OrderedDict()  # Keys = dates, values = (election, races_list, size)
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+
+        return len(self.files)
+
+    def __contains__(self, date):
+
+        return date in self.files
+
+    def __iter__(self):
+
+        return iter(self.keys())
+
+    def __getitem__(self, date):
+        """Returns the election on date (a dict as returned by readCandidatesFile).
+
+        If several files have the same date, the last one (by file name) is
+        returned, as in readAllElections; getRaces has the races from all of them.
+
+        Raises:
+            KeyError if there's no file for date, or none that has the required fields.
+        """
+
+        return self.load(date)[0]
+
+    def get(self, date, default=None):
+
+        try:
+            return self[date]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """Returns a sorted list of the election dates (whether or not they've been read)."""
+
+        return sorted(self.files)
+
+    def items(self):
+        """Yields (date, election) tuples in order of date, reading each as needed."""
+
+        for date in self.keys():
+            if date in self.files:  # Dates whose files all get skipped are dropped
+                try:
+                    yield (date, self[date])
+                except KeyError:
+                    pass
+
+    def getDates(self, since=None, until=None):
+        """Returns a sorted list of the dates between since and until (inclusive)."""
+
+        return [d for d in self.keys()
+            if ((since is None) or (d >= since)) and ((until is None) or (d <= until))]
+
+    def getRaces(self, date):
+        """Returns the races_list of the election on date (see readCandidatesFile)."""
+
+        return self.load(date)[1]
+
+    def load(self, date):
+        """Returns the (election, races_list) on date, reading it if it isn't kept."""
+
+        if date in self.loaded:
+            self.hits += 1
+            value = self.loaded.pop(date)
+            self.loaded[date] = value  # Now the most recently used
+            return value[:2]
+
+        if date not in self.files:
+            raise KeyError(date)
+        self.misses += 1
+        (election, races_list) = (None, [])
+        for file_name in self.files[date]:
+            result = readElectionFile((file_name, self.cache_dir, self.lean))
+            if (result[0]):
+                (election, races_list) = (result[0], races_list + result[1])
+        if election is None:
+            del self.files[date]
+            raise KeyError(date)
+
+        size = self.overhead * sum(os.path.getsize(f) for f in self.files[date])
+        self.loaded[date] = (election, races_list, size)
+        self.memory += size
+        while (self.memory > self.max_memory) and (len(self.loaded) > 1):
+            (_, (_, _, old_size)) = self.loaded.popitem(last=False)
+            self.memory -= old_size
+        return (election, races_list)
+
+    def info(self):
+        """Returns a dict with the catalog's hits, misses, and elections kept."""
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'loaded': list(self.loaded),
+            'memory': self.memory,
+            'max_memory': self.max_memory
+        }
+
+
+def readCandidatesFile(file_name, makeJSON=False, lean=False):
     """Reads a CSV with candidate data and compiles a dict with the info.
 
     Args:
         file_name: A string file name of a CSV with data on all the 
             candidates for a given election.
         makeJSON: (Optional) If True, saves the result as a JSON file.
+        lean: (Optional) If True, each race is a Race record instead of a dict
+            (see compileCandidates), and only the LEAN_FIELDS of the file
+            are read. Can't be combined with makeJSON.
 
     Returns:
         A tuple containing:
@@ -63,34 +443,164 @@ def readCandidatesFile(file_name, makeJSON=False):
         Returns (None, None) if the CSV doesn't have all required fields.
     """
 
-    f = open(file_name, 'r')
+    if (lean) and (makeJSON):
+        raise ValueError("makeJSON needs the candidates, which lean mode doesn't keep.")
+
+    report = getReport()
     date = convertDate(getDateFromName(file_name))
+    if (lean):  # Only reads the fields it needs (see CSVScanner)
+        f = CSVScanner(file_name)
+        reader = f.dicts([k for k in LEAN_FIELDS if k in f.fieldnames])
+    else:
+        f = open(file_name, 'r')
+        reader = csv.DictReader(f)
     try:
-        (races, races_list) = compileCandidates(csv.DictReader(f), date)
+        (races, races_list) = compileCandidates(reader, date, lean)
     except KeyError:
         print ("\n" + file_name + "\ndoes not have all the required fields: " +
             "'TOWN', 'OFFICE', and 'DIST#'." + "\nFile ignored.\n")
+        report.count('skipped_files', example=file_name)
         return (None, None)
     else:
         print 'Reading:', file_name
+        report.count('files')
         if (makeJSON):
             new_name = file_name.replace('.csv','.json')
-            saveJSON(new_name, races) # in same directory as CSV
+            with report.stage('export'):
+                saveJSON(new_name, races) # in same directory as CSV
+        with report.stage('aggregate'):
+            unc_rates = getUncontestedRates(races)
         return ({
             'races': races,
             'date': date,
-            'unc_rates': getUncontestedRates(races)
+            'unc_rates': unc_rates
         }, races_list)
     finally:
         f.close()
 
 
-def compileCandidates(reader, date):
+def readElectionFile(task):
+    """Reads one file for readAllElections (possibly in a worker process).
+
+    Args:
+        task: A tuple of the file name, the cache folder (or None), and
+            whether to read it in lean mode.
+
+    Returns:
+        Same as readCandidatesFile.
+    """
+
+    (file_name, cache_dir, lean) = task
+    with getReport().stage('read', file_name):
+        if cache_dir is None:
+            return readCandidatesFile(file_name, lean=lean)
+        return readCandidatesFileCached(file_name, cache_dir, lean)
+
+
+def readElectionFileReported(task):
+    """Like readElectionFile, but also reports on it (for worker processes).
+
+    Returns:
+        A tuple of the result of readElectionFile and its RunReport (as a dict).
+    """
+
+    report = RunReport()
+    previous = setReport(report)
+    try:
+        result = readElectionFile(task)
+    finally:
+        setReport(previous)
+    return (result, report.toDict())
+
+
+def readCandidatesFileCached(file_name, cache_dir=CACHE_DIR, lean=False):
+    """Like readCandidatesFile, but reuses the saved result if the file hasn't changed.
+
+    A file counts as unchanged if its size and modification time are the
+    same as when it was cached or, if only the modification time differs,
+    if its contents still have the same hash. Files that get ignored for
+    not having the required fields aren't cached.
+
+    Args:
+        file_name: A string file name of a CSV with data on all the
+            candidates for a given election.
+        cache_dir: (Optional) Folder for the cached results.
+        lean: (Optional) See readCandidatesFile. Lean and full results are
+            cached separately.
+
+    Returns:
+        Same as readCandidatesFile.
+
+    Side effect:
+        Saves (or replaces) a pickle file in cache_dir when file_name is
+        parsed, or when only its modification time has changed.
+    """
+
+    cache_file = getCacheName(cache_dir, file_name, lean)
+    stat = os.stat(file_name)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime, 'version': CACHE_VERSION}
+
+    report = getReport()
+    cached = None
+    if os.path.exists(cache_file):
+        try:
+            with report.stage('loadCache'):
+                with open(cache_file, 'rb') as f:
+                    cached = cPickle.load(f)
+        except Exception:
+            pass  # Unreadable cache file; parse the CSV again
+    if (cached) and all(cached.get(k) == source[k] for k in ['size', 'version']):
+        if cached['mtime'] != source['mtime']:
+            source['md5'] = hashFile(file_name)
+            if cached.get('md5') != source['md5']:
+                cached = None
+            else:  # Touched but unchanged; saved with the new mtime so it isn't hashed again
+                cached['mtime'] = source['mtime']
+                saveCache(cache_file, cached)
+        if (cached):
+            print 'Reading (cached):', file_name
+            report.count('cache_hits')
+            report.count('files')
+            return cached['result']
+
+    report.count('cache_misses')
+    result = readCandidatesFile(file_name, lean=lean)
+    if result[0] is not None:
+        if 'md5' not in source:
+            source['md5'] = hashFile(file_name)
+        source['result'] = result
+        saveCache(cache_file, source)
+    return result
+
+
+def saveCache(cache_file, entry):
+    """Saves a cache entry (see readCandidatesFileCached), replacing the old one.
+
+    Side effect:
+        Saves (or replaces) a pickle file, creating its folder if needed.
+    """
+
+    cache_dir = os.path.dirname(cache_file)
+    if (cache_dir) and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_file = cache_file + '.tmp'
+    with getReport().stage('saveCache'):
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)  # os.rename can't overwrite on Windows
+        os.rename(tmp_file, cache_file)
+
+
+def compileCandidates(reader, date, lean=False):
     """Compiles a dict of races and candidates based on raw spreadsheet data.
 
     Args:
         reader: A csv.DictReader with info about candidates.
         date: The str date of the election (YYYY-MM-DD).
+        lean: (Optional) If True, each race is a Race record that only counts
+            its valid candidates, and each row is dropped once it's counted.
+            The same Race records are used in both the dict and the list.
 
     Returns:
         A tuple containing:
@@ -99,16 +609,56 @@ def compileCandidates(reader, date):
             A list of dicts, where each dict represnts a race.
     """
 
+    report = getReport()
+    parse = report.timed('mapOffice', parseOffice)
+    (hits, misses) = (parseOffice.hits, parseOffice.misses)
+    with report.stage('parse'):
+        try:
+            races = compileRows(reader, parse, lean)
+        finally:
+            report.count('office_cache_hits', parseOffice.hits - hits)
+            report.count('office_cache_misses', parseOffice.misses - misses)
+    with report.stage('calculateContested'):
+        return calculateContested(races, date)
+
+
+def compileRows(reader, parse, lean=False):
+    """Sorts the rows of a candidates file into races (see compileCandidates).
+
+    Args:
+        reader: A csv.DictReader with info about candidates.
+        parse: The function used to parse offices (parseOffice, or a timed version).
+        lean: (Optional) See compileCandidates.
+
+    Returns:
+        A dict where keys = locations, values = dicts of offices, whose
+            values = dicts of districts, whose values = races.
+    """
+
     races = {}
-    for row_ in reader:
-        row = mapOffice(row_)
-        loc = findLocation(row)
-        o = row['office']
-        d = row['dist']
+    rows = 0
+    for row in reader:
+        rows += 1
+        (o, d, votefor, loc, _) = parse(row['OFFICE'], row['DIST#'], row.get('CITY'))
+        if loc is None:
+            raise KeyError('CITY')
         if loc not in races: # if location is not in election's list of locations
             races[loc] = {}
         if o not in races[loc]: # if office is not in location's list of offices
             races[loc][o] = {}
+        if (lean):
+            race = races[loc][o].get(d)
+            if race is None:
+                race = races[loc][o][d] = Race(int(votefor),
+                    (row['PARTY'] == 'Non-Partisan Local Office'))
+            if row['DECLARATION'] not in DECLARATIONS:
+                raise KeyError(row['DECLARATION'])
+            if row['DECLARATION'] == 'Valid':
+                race.valid += 1
+            continue
+        row['office'] = o
+        row['dist'] = d
+        row['votefor'] = votefor
         if d not in races[loc][o]: # if district is not already in office's list of districts
             races[loc][o][d] = {
                 'votefor': int(row['votefor']),
@@ -122,7 +672,8 @@ def compileCandidates(reader, date):
                 'contested': None # later gets replaced with True/False
             }
         races[loc][o][d]['candidates'][row['DECLARATION']].append(row)
-    return calculateContested(races, date)
+    getReport().count('rows', rows)
+    return races
 
 
 def mapOffice(d):
@@ -138,38 +689,65 @@ def mapOffice(d):
         Input dict with additional keys: 'office', 'dist', 'votefor'.
     """
 
-    def removeLastWords(text, n):
-        """Removes the last n words from text."""
-        
-        return ' '.join(text.split(' ')[0:-n])
+    (d['office'], d['dist'], d['votefor'], _, _) = parseOffice(
+        d['OFFICE'], d['DIST#'], d.get('CITY'))
 
-    # Some of these operations could be replaced with regex, but they also work fine as-is
+    return d
+
+
+def parseOfficeTitle(office, dist, city):
+    """Parses an office title, along with its district and municipality.
+
+    Cleans the office title, finds the district number, and finds the
+    number of candidates you can vote for (for that office). Use the
+    memoized version, parseOffice, since the same few hundred offices
+    repeat throughout a file.
+
+    Args:
+        office: The str office title ('OFFICE' field).
+        dist: The str district ('DIST#' field).
+        city: The str municipality ('CITY' field), or None if there isn't one.
+
+    Returns:
+        A tuple of (office, dist, votefor, location, office_type), where
+        location is as given by findLocation and office_type by getOfficeType.
+        The location is None if it would be the municipality but city is None.
+    """
+
+    o = office
 
-    o = d['OFFICE']
-    
     # 'votefor': the number of candidates you're supposed to vote for
     # default is 1; overridden if office title says 'VOTE FOR #' at the end
-    if o.split()[-3:-1] == ['VOTE','FOR']:
-        d['votefor'] = o.split()[-1]
-        o = removeLastWords(o,3)
+    words = o.split()
+    if words[-3:-1] == ['VOTE', 'FOR']:
+        votefor = words[-1]
+        o = removeLastWords(o, 3)
     else:
-        d['votefor'] = 1
-    
+        votefor = 1
+
     # 'dist': the district number
     # default is the number in the DIST# field; overriden if given in office title
-    if ((o.split()[-2:-1] == ['DISTRICT']) and (o.split()[-1] != 'COMMITTEE')):
-        d['dist'] = o.split()[-1]
-        o = removeLastWords(o,2)
-    else:
-        d['dist'] = d['DIST#']
+    words = o.split()
+    if (words[-2:-1] == ['DISTRICT']) and (words[-1] != 'COMMITTEE'):
+        dist = words[-1]
+        o = removeLastWords(o, 2)
 
     # 'office': the name of the office the candidate is running for (minus extraneous info)
-    delete = ['WITHOUT PARTY MARKS OR DESIGNATION', 'NON PARTISAN ', 'NON-PARTISAN ']
-    for i in delete:
-        o = o.replace(i,'')
-    d['office'] = o
+    for i in EXTRANEOUS:
+        o = o.replace(i, '')
+
+    location = findLocation({'office': o, 'dist': dist, 'CITY': city})
+
+    return (o, dist, votefor, location, getOfficeType(o))
+
+
+parseOffice = MemoCache(parseOfficeTitle, OFFICE_CACHE_SIZE)
 
-    return d
+
+def removeLastWords(text, n):
+    """Removes the last n words from text."""
+
+    return ' '.join(text.split(' ')[0:-n])
 
 
 def findLocation(d):
@@ -228,6 +806,12 @@ def calculateContested(races, date):
         for office in races[loc]:
             for district in races[loc][office]:
                 d = races[loc][office][district]
+                if isinstance(d, Race):  # Lean mode; the record itself goes in the list
+                    d.contested = isContested(d)
+                    (d.date, d.location, d.office, d.district) = (date, loc, office, district)
+                    d.office_type = getOfficeType(office)
+                    races_list.append(d)
+                    continue
                 d['contested'] = isContested(d)
                 other_race_info = {
                     'date': date,
@@ -247,12 +831,15 @@ def isContested(d):
     Calculated by seeing if the number of valid candidates exceeds the number to vote for.
 
     Args:
-        d: A dict representing a race, with keys including 'candidates', 'votefor'.
+        d: A dict representing a race, with keys including 'candidates', 'votefor'
+            (or a Race record).
 
     Returns:
         A bool indicating whether or not the race is contested.
     """
 
+    if isinstance(d, Race):
+        return (d.valid > d.votefor)
     return (len(d['candidates']['Valid']) > d['votefor'])
 
 
@@ -302,6 +889,13 @@ def getDateFromName(file_name):
     return file_name.split('\\')[-1].split('_')[1]
 
 
+def getCacheName(cache_dir, file_name, lean=False):
+    """Returns the name of the cache file for a CSV (based on its full path)."""
+
+    key = hashlib.md5(os.path.abspath(file_name)).hexdigest()
+    return os.path.join(cache_dir, key + ('_lean' if (lean) else '') + '.pickle')
+
+
 def getUncontestedRates(races, printr=False):
 
     def getWhere(to_filter, property_, test):
@@ -381,27 +975,23 @@ def addProp(list_of_dicts, current_prop, new_prop_name, new_prop_f):
 
     return map(propMap, list_of_dicts)
 
-# To-do: Rename, improve readability:
 def getUncRates(races_list, group='date'):
+    """Calculates the share of races that were uncontested, by location and group.
+
+    Args:
+        races_list: List of race dicts, each with 'location', 'contested'
+            and group as keys (or a RaceTable, i.e. from RaceTable.load).
+        group: (Optional) Key to group each location's races by.
+
+    Returns:
+        A dict where keys = locations, values = dicts where keys = groups
+            (i.e. dates), values = uncontested rates.
+    """
 
-    all_locs = {}  # Keys = unique locations
-    for i in races_list:  # For each race
-        if i['location'] not in all_locs:
-            all_locs[i['location']] = {}
-    dg = group
-    for j in all_locs:  # For each location
-        # loc_list = filter(lambda x: x['location']==j, races_list)
-        loc_list = [x for x in races_list if (x['location']==j)]
-        loc_dict = {}  # Keys = dates, values = races
-        for k in loc_list:
-            if k[dg] not in loc_dict:
-                loc_dict[k[dg]] = []
-            loc_dict[k[dg]].append(k)
-        for date in loc_dict:  # For each date or date group
-            unc = float(len(filter(lambda x: x['contested']==False, loc_dict[date])))
-            tot = float(len(loc_dict[date]))
-            all_locs[j][date] = unc/tot
-    return all_locs
+    if isinstance(races_list, RaceTable):
+        return races_list.getUncRates(group)
+    categories = ['location'] + ([group] if (group != 'location') else [])
+    return RaceTable(races_list, categories).getUncRates(group)
 
 
 def getType(races_list, office_type):
@@ -426,6 +1016,7 @@ def isPrimaryOrGeneral(elec_type):
         return 'General'
     else:
         print ('Type "' + elec_type + '" unknown.')
+        getReport().count('unknown_election_types', example=elec_type)
         return 'Unknown'
 
 
@@ -508,7 +1099,7 @@ def saveCSV(new_file_name, data, header):
     """
 
     print '\nSaving file:', new_file_name, '...'
-    with open(new_file_name, 'wb') as csvfile:
+    with open(new_file_name, 'wb', EXPORT_BUFFER) as csvfile:
         writer = csv.DictWriter(csvfile, header)
         writer.writeheader()
         for d in data:
@@ -542,27 +1133,167 @@ def saveJSON(new_file_name, data):
     return
 
 
+class ElectionsJSONWriter(object):
+    """Saves elections as JSON one at a time, so they never all need to be in memory.
+
+    Layouts:
+        'json': One object where keys = dates, values = elections (the same
+            as saveJSON would save for elections_dict).
+        'ndjson': One line per location in each election, as an object with
+            'date', 'location', 'races' and 'unc_rates'.
+        'shards': A folder with one file per election (named by its date) and
+            an 'index.json' where keys = dates, values = file names.
+
+    Elections should be written in order of date. If two have the same date,
+    both are saved, and a JSON parser will keep the later one.
+    """
+
+    def __init__(self, new_file_name, layout='json', compact=False, compress=False):
+        """
+        Args:
+            new_file_name: String name of the file (or folder, for 'shards').
+            layout: (Optional) 'json', 'ndjson' or 'shards'.
+            compact: (Optional) If True, the JSON isn't indented. Lines of
+                'ndjson' are always compact.
+            compress: (Optional) If True, files are gzipped.
+        """
+
+        if layout not in ['json', 'ndjson', 'shards']:
+            raise ValueError("layout must be 'json', 'ndjson' or 'shards'.")
+        self.new_file_name = new_file_name
+        self.layout = layout
+        self.compact = compact
+        self.compress = compress
+        self.count = 0
+        if (compact):
+            self.encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+        else:
+            self.encoder = json.JSONEncoder(sort_keys=True, indent=4)
+        self.line_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+        print '\nSaving file:', new_file_name, '...'
+        if layout == 'shards':
+            if not os.path.exists(new_file_name):
+                os.makedirs(new_file_name)
+            self.index = {}
+        else:
+            self.f = openOutput(new_file_name, compress)
+            if layout == 'json':
+                self.f.write('{')
+
+    def write(self, election):
+        """Saves an election (a dict as returned by readCandidatesFile)."""
+
+        date = election['date']
+        if self.layout == 'json':
+            if (self.compact):
+                self.f.write((',' if (self.count) else '') + json.dumps(date) + ':')
+                for chunk in self.encoder.iterencode(election):
+                    self.f.write(chunk)
+            else:
+                self.f.write((', ' if (self.count) else '') + '\n    ' + json.dumps(date) + ': ')
+                for chunk in self.encoder.iterencode(election):
+                    self.f.write(chunk.replace('\n', '\n    '))  # One level deeper
+        elif self.layout == 'ndjson':
+            for loc in sorted(election['races']):
+                self.f.write(self.line_encoder.encode({
+                    'date': date,
+                    'location': loc,
+                    'races': election['races'][loc],
+                    'unc_rates': election['unc_rates'].get(loc)
+                }) + '\n')
+        else:
+            shard_name = getJSONName(date, 'json', self.compress)
+            f = openOutput(os.path.join(self.new_file_name, shard_name), self.compress)
+            for chunk in self.encoder.iterencode(election):
+                f.write(chunk)
+            f.close()
+            self.index[date] = shard_name
+        self.count += 1
+
+    def close(self):
+        """Finishes the file(s)."""
+
+        if self.layout == 'json':
+            self.f.write('\n}' if ((self.count) and not (self.compact)) else '}')
+        if self.layout == 'shards':
+            with open(os.path.join(self.new_file_name, 'index.json'), 'w') as f:
+                json.dump(self.index, f, indent=4, sort_keys=True)
+        else:
+            self.f.close()
+        print 'Saved file:', self.new_file_name
+
+
+def saveElectionsJSON(new_file_name, elections, layout='json', compact=False, compress=False):
+    """Saves elections as JSON as they're produced, with bounded memory.
+
+    Example:
+        saveElectionsJSON('elections.ndjson', (r for (r, _) in iterElections()), 'ndjson')
+
+    Args:
+        new_file_name: String name of the file (or folder, for 'shards').
+        elections: Iterable of elections (dicts as returned by readCandidatesFile).
+        layout: (Optional) 'json', 'ndjson' or 'shards'; see ElectionsJSONWriter.
+        compact: (Optional) If True, the JSON isn't indented.
+        compress: (Optional) If True, files are gzipped.
+
+    Returns:
+        Nothing.
+
+    Side effect:
+        Saves a new file (JSON), or a folder of them.
+    """
+
+    writer = ElectionsJSONWriter(new_file_name, layout, compact, compress)
+    for election in elections:
+        writer.write(election)
+    writer.close()
+
+
+def getJSONName(name, layout='json', compress=False):
+    """Adds the extension for a JSON layout (and gzip) to a file name."""
+
+    if layout == 'shards':
+        return name
+    return name + ('.ndjson' if (layout == 'ndjson') else '.json') + ('.gz' if (compress) else '')
+
+
+def openOutput(new_file_name, compress=False):
+    """Opens a file for writing, gzipped if compress is True."""
+
+    if (compress):
+        return gzip.open(new_file_name, 'wb')
+    return open(new_file_name, 'w', EXPORT_BUFFER)
+
+
 if __name__ == '__main__':
 
-    (elections_dict, elections_list) = readAllElections()
+    (elections_dict, elections_list) = readAllElections(background=True)
 
-    # The following code was used for specific CSV exports:
+    # The following code was used for specific CSV exports (saved in the
+    # background, as each one's data is ready):
 
+    # exports = ExportScheduler()
+    # table = RaceTable(elections_list)
     # for t in ['Executive', 'Legislature', 'School Committee']:
     #     header = ['location'] + [e for e in sorted(elections_dict)]
-    #     data = prepForCSV(getUncRates(getType(elections_list, t)), 'location')
-    #     saveCSV('unc_rates_'+t[0:3].lower()+'.csv', data, header)
-    
+    #     cubes = table.rollup([('location', 'date')], where={'office_type': t})
+    #     data = prepForCSV(pivot(cubes[('location', 'date')]), 'location')
+    #     exports.submit(t, saveCSV, 'unc_rates_'+t[0:3].lower()+'.csv', data, header)
+
+    # type_long = addPropFromJSON('list_of_elections.json')
+    # cubes = table.rollup([('location', 'year'), ('location', 'type_short')], derived={
+    #     'year': ('date', getYearFromDate),
+    #     'type_short': ('date', lambda d: isPrimaryOrGeneral(type_long(d)))
+    # })
+
     # header = ['location', '2006', '2008', '2010', '2012', '2014']
-    # res = addProp(elections_list, 'date', 'year', getYearFromDate)
-    # data = prepForCSV(getUncRates(res, 'year'), 'location')
-    # saveCSV('unc_rates_by_year.csv', data, header)
+    # data = prepForCSV(pivot(cubes[('location', 'year')]), 'location')
+    # exports.submit('by_year', saveCSV, 'unc_rates_by_year.csv', data, header)
 
     # header = ['location', 'Primary', 'General']
-    # temp = addProp(elections_list, 'date', 'type_long', addPropFromJSON('list_of_elections.json'))
-    # res = addProp(temp, 'type_long', 'type_short', isPrimaryOrGeneral)
-    # data = prepForCSV(getUncRates(res, 'type_short'), 'location')
-    # saveCSV('unc_rates_by_elec_type.csv', data, header)
+    # data = prepForCSV(pivot(cubes[('location', 'type_short')]), 'location')
+    # exports.submit('by_elec_type', saveCSV, 'unc_rates_by_elec_type.csv', data, header)
 
     # def mapRace(race):
 
@@ -579,4 +1310,6 @@ if __name__ == '__main__':
     # header = ['date', 'location', 'office', 'office_type', 'district', 'nonpartisan',
     #     'candidates', 'votefor', 'contested']
     # # header = [contested, office, district, office_type, candidates, date, nonpartisan, votefor]
-    # saveCSV('all_races.csv', data, header)
\ No newline at end of file
+    # exports.submit('all_races', saveCSV, 'all_races.csv', data, header)
+
+    # exports.join()
\ No newline at end of file